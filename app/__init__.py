@@ -7,9 +7,77 @@ def create_app(config_class=Config):
     app = Flask(__name__)
     app.config.from_object(config_class)
     
+    # Stream uploads to disk, hashing and checking them on the way in
+    from app.utils.file_handler import UploadRequest
+    app.request_class = UploadRequest
+    
+    # Behind reverse proxies, take the client address from their X-Forwarded-* headers
+    if app.config['TRUSTED_PROXIES']:
+        from werkzeug.middleware.proxy_fix import ProxyFix
+        hops = app.config['TRUSTED_PROXIES']
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=hops, x_proto=hops, x_host=hops)
+    
     # Ensure upload folder exists
     os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
     
+    # An UPLOAD_FOLDER outside app/static is still served at /static/uploads/
+    if os.path.abspath(app.config['UPLOAD_FOLDER']) != os.path.join(app.static_folder, 'uploads'):
+        from flask import send_from_directory
+        app.add_url_rule('/static/uploads/<path:filename>', 'uploads',
+                         lambda filename: send_from_directory(app.config['UPLOAD_FOLDER'], filename))
+    
+    # Request and stage timing, aggregated across workers
+    from app.services.metrics import init_metrics
+    init_metrics(app)
+    
+    # Upload storage lifecycle (sharding, TTL and quota sweeping)
+    from app.services.storage import init_upload_storage
+    init_upload_storage(app)
+    
+    # Display-size previews of uploads, rendered in the background
+    from app.services.previews import init_previews
+    init_previews(app)
+    
+    # Shared analysis result cache
+    from app.services.result_cache import init_result_cache
+    init_result_cache(app)
+    
+    # Perceptual hashes for spotting re-scans of analyzed images
+    from app.services.perceptual_index import init_perceptual_index
+    init_perceptual_index(app)
+    
+    # Coalescing of concurrent identical analyses
+    from app.services.single_flight import init_single_flight
+    init_single_flight(app)
+    
+    # Priority lanes for model calls within this worker
+    from app.services.admission import init_admission_control
+    init_admission_control(app)
+    
+    # Outbound rate limiting shared by all workers
+    from app.services.rate_limiter import init_rate_limiter
+    init_rate_limiter(app)
+    
+    # Prompt templates, read once
+    from app.services.prompt_service import init_prompt_library
+    init_prompt_library(app)
+    
+    # Gemini clients are created lazily and reused across requests
+    from app.services.gemini_service import init_gemini_services
+    init_gemini_services(app)
+    
+    # Background analysis jobs
+    from app.services.job_queue import init_job_queue
+    init_job_queue(app)
+    
+    # Analyses started at upload time, for the analyze request that follows
+    from app.services.speculation import init_speculation
+    init_speculation(app)
+    
+    # Concurrent batch analysis
+    from app.services.batch import init_batch_runner
+    init_batch_runner(app)
+    
     # Register blueprints
     from app.main.routes import main_bp
     from app.api.routes import api_bp
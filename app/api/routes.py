@@ -1,10 +1,102 @@
-from flask import Blueprint, request, jsonify, current_app, url_for
-from app.utils.file_handler import allowed_file, save_file, cleanup_file
-from app.services.gemini_service import GeminiService
+from flask import Blueprint, Response, request, jsonify, current_app, url_for, send_file, stream_with_context
+from app.utils.file_handler import (
+    allowed_file, save_file, cleanup_file, ingest_upload, upload_path, upload_url_path, UploadRejected
+)
+from app.services.admission import LANES, get_admission_controller
+from app.services.batch import get_batch_runner
+from app.services.gemini_service import get_gemini_service, classify_error
+from app.services.job_queue import get_job_queue, TERMINAL_STATUSES
+from app.services.perceptual_index import get_perceptual_index
+from app.services.previews import get_previews, is_digest
+from app.services.prompt_service import get_prompt_library
+from app.services.rate_limiter import get_rate_limiter
+from app.services.result_cache import get_result_cache
+from app.services.single_flight import get_single_flight
+from app.services.speculation import get_speculator
+from app.services.storage import get_upload_storage
+from app.utils.image_processing import OUTPUT_FORMATS, tiling_settings
+from app.utils.result_parser import FieldStream, csv_lines, jsonl_lines
+import hmac
+import json
+import os
+import time
 import traceback
 
 api_bp = Blueprint('api', __name__)
 
+def _client_id():
+    """Who an analysis is for, for per-client concurrency caps: the remote address
+
+    X-Client-Id is used instead only from a caller (e.g. a gateway) that proves
+    it may name clients by sending X-Client-Secret equal to CLIENT_ID_SECRET.
+    """
+    secret = current_app.config['CLIENT_ID_SECRET']
+    client = request.headers.get('X-Client-Id')
+    if client and secret and hmac.compare_digest(request.headers.get('X-Client-Secret', ''), secret):
+        return client
+    return request.remote_addr
+
+def _admit(lane):
+    """Reject up front (AdmissionRejected) when lane's queue is too long to meet its deadline"""
+    admission = get_admission_controller()
+    if admission is not None:
+        admission.check(lane)
+
+def _job_accepted(job_id, status='queued'):
+    """202 response pointing at an analysis job"""
+    return jsonify({
+        'success': True,
+        'job_id': job_id,
+        'status': status,
+        'status_url': url_for('api.job_status', job_id=job_id),
+        'events_url': url_for('api.job_events', job_id=job_id)
+    }), 202
+
+def _claim_speculation(filename, use_cache):
+    """The analysis of filename started at upload time, if any and the request may use it"""
+    speculator = get_speculator()
+    if speculator is None or not use_cache:
+        return None
+    return speculator.claim(filename)
+
+def _await_speculation(job):
+    """Wait for a claimed speculative job; returns it once done, or None if it failed or was cancelled"""
+    if job['status'] != 'done':
+        job = get_job_queue().wait(job['job_id'], current_app.config['JOB_EVENTS_POLL_INTERVAL'])
+    if job is None or job['status'] != 'done':
+        return None
+    job['result'] = dict(job['result'], speculative=True)
+    return job
+
+def _error_response(error):
+    """JSON error response for an analysis exception, with Retry-After when the server is busy"""
+    message, status_code = classify_error(error)
+    response = jsonify({'error': message})
+    retry_after = getattr(error, 'retry_after', None)
+    if retry_after:
+        response.headers['Retry-After'] = str(retry_after)
+    return response, status_code
+
+@api_bp.route('/config', methods=['GET'])
+def client_config():
+    """Upload limits and the size the server scales images to, so browsers can shrink them before uploading"""
+    config = current_app.config
+    # With tiling, large images are analyzed at full resolution: the browser must not downscale them
+    max_side = 0 if tiling_settings(config) else config['PREPROCESS_MAX_SIZE']
+    response = jsonify({
+        'max_upload_bytes': config['MAX_CONTENT_LENGTH'],
+        'max_upload_pixels': config['UPLOAD_MAX_PIXELS'],
+        'allowed_extensions': sorted(config['ALLOWED_EXTENSIONS']),
+        'client_resize': {
+            'max_side': max_side,
+            'format': OUTPUT_FORMATS.get(config['PREPROCESS_FORMAT'].upper(), 'image/jpeg'),
+            # A notch above the server's own encode, so encoding twice costs little detail
+            'quality': max(config['PREPROCESS_MAX_QUALITY'], 90) / 100,
+        },
+    })
+    response.headers['Cache-Control'] = 'public, max-age=300'
+    return response, 200
+
 @api_bp.route('/upload', methods=['POST'])
 def upload_file():
     """Handle file upload and return file info"""
@@ -22,23 +114,81 @@ def upload_file():
             return jsonify({'error': 'File type not allowed. Please upload an image.'}), 400
         
         # Save file
+        digest = ingest_upload(file).digest
         filepath, unique_filename = save_file(file)
         
         if not filepath:
             return jsonify({'error': 'Error saving file'}), 500
         
-        return jsonify({
+        response = {
             'success': True,
             'filename': unique_filename,
-            'file_url': url_for('static', filename=f'uploads/{unique_filename}', _external=True)
-        }), 200
+            'file_url': url_for('static', filename=upload_url_path(unique_filename), _external=True)
+        }
         
+        # Render the preview and placeholder off the request path; the URLs are valid at once
+        previews = get_previews()
+        if previews is not None:
+            previews.schedule(digest)
+            response.update(previews.urls(digest))
+        
+        # Start analyzing before it is asked for; /api/analyze picks up the result
+        speculator = get_speculator()
+        if speculator is not None:
+            speculator.start(filepath, unique_filename, client=_client_id())
+        
+        # Flag re-scans of an already analyzed image before any quota is spent
+        if get_perceptual_index() is not None:
+            match = get_gemini_service().find_near_duplicate(filepath, digest)
+            response['near_duplicate'] = {'distance': match['distance']} if match else None
+        
+        return jsonify(response), 200
+        
+    except UploadRejected as e:
+        return jsonify({'error': str(e)}), e.status_code
     except Exception as e:
         return jsonify({'error': f'Upload failed: {str(e)}'}), 500
 
+@api_bp.route('/previews/<digest>/<kind>', methods=['GET'])
+def upload_preview(digest, kind):
+    """Serve an upload's display-size preview or placeholder, cacheable forever
+
+    The URL names the image by content hash (and the render settings), so it
+    never changes meaning: responses are immutable and revalidate by ETag.
+    """
+    previews = get_previews()
+    if previews is None or kind not in previews.sizes or not is_digest(digest):
+        return jsonify({'error': 'Preview not found'}), 404
+    
+    etag = previews.etag(digest, kind)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        try:
+            path = previews.path(digest, kind)
+        except Exception as e:
+            traceback.print_exc()
+            return jsonify({'error': f'Preview failed: {str(e)}'}), 500
+        if path is None:
+            return jsonify({'error': 'Preview not found'}), 404
+        response = send_file(path, mimetype='image/webp', etag=etag, conditional=True, max_age=365 * 24 * 3600)
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = 365 * 24 * 3600
+    response.cache_control.immutable = True
+    return response
+
 @api_bp.route('/analyze', methods=['POST'])
 def analyze_file():
-    """Analyze uploaded image with Gemini AI"""
+    """Queue analysis of an uploaded image and return a job ID
+
+    Send {"wait": true} to block until the analysis finishes instead.
+    A multipart body with a 'file' field is analyzed in the same request.
+    {"priority": "batch"} queues the analysis behind interactive ones.
+    """
+    if request.mimetype == 'multipart/form-data':
+        return _analyze_upload()
+    
     try:
         data = request.get_json()
         
@@ -46,47 +196,397 @@ def analyze_file():
             return jsonify({'error': 'Filename not provided'}), 400
         
         filename = data['filename']
-        filepath = current_app.config['UPLOAD_FOLDER'] + '/' + filename
+        filepath = upload_path(filename)
         
         # Check if file exists
-        import os
-        if not os.path.exists(filepath):
+        if not filepath or not os.path.exists(filepath):
             return jsonify({'error': 'File not found'}), 404
+        get_upload_storage().touch(filepath)
+        
+        # Clients can skip the result cache with {"no_cache": true} or Cache-Control: no-cache
+        use_cache = not data.get('no_cache') and 'no-cache' not in request.headers.get('Cache-Control', '')
+        
+        lane = data.get('priority', 'interactive')
+        if lane not in LANES:
+            return jsonify({'error': f"Unknown priority. Use one of: {', '.join(LANES)}"}), 400
+        
+        # Attach to the analysis started at upload time; a blocking request waits
+        # for it, and only analyzes the image itself if that job failed
+        job = _claim_speculation(filename, use_cache)
+        if job is not None:
+            if not data.get('wait'):
+                return _job_accepted(job['job_id'], job['status'])
+            job = _await_speculation(job)
+            if job is not None:
+                return jsonify({'success': True, 'result': job['result']}), 200
+        _admit(lane)
         
-        # Initialize Gemini service
-        gemini_service = GeminiService()
+        if not data.get('wait'):
+            job_id = get_job_queue().submit(filepath, filename, use_cache=use_cache, lane=lane, client=_client_id())
+            return _job_accepted(job_id)
+        
+        # Shared Gemini service for this worker
+        gemini_service = get_gemini_service()
         
         # Analyze file with timeout handling
-        result = gemini_service.analyze_file(filepath)
+        result = gemini_service.analyze_file(filepath, use_cache=use_cache, lane=lane, client=_client_id())
         
         if not result or 'content' not in result:
             return jsonify({'error': 'No content extracted from image'}), 500
         
+        get_job_queue().record(filename, result)
+        
         return jsonify({
             'success': True,
             'result': result
         }), 200
         
-    except TimeoutError:
+    except Exception as e:
         traceback.print_exc()
-        return jsonify({'error': 'Analysis timed out. Please try again with a smaller or clearer image.'}), 504
+        return _error_response(e)
+
+def _analyze_upload():
+    """Upload and analyze in one round trip, decoding the image from memory
+
+    The file is only written to the upload folder when the form sets persist=true.
+    """
+    try:
+        if 'file' not in request.files:
+            return jsonify({'error': 'No file provided'}), 400
+        
+        file = request.files['file']
+        
+        if file.filename == '':
+            return jsonify({'error': 'No file selected'}), 400
+        
+        if not allowed_file(file.filename):
+            return jsonify({'error': 'File type not allowed. Please upload an image.'}), 400
+        
+        _admit('interactive')
+        stream = ingest_upload(file)
+        response = {'success': True}
+        
+        if request.form.get('persist', '').lower() in ('1', 'true'):
+            filepath, unique_filename = save_file(file)
+            response['filename'] = unique_filename
+            response['file_url'] = url_for('static', filename=upload_url_path(unique_filename), _external=True)
+            previews = get_previews()
+            if previews is not None:
+                previews.schedule(stream.digest)
+                response.update(previews.urls(stream.digest))
+        
+        use_cache = request.form.get('no_cache', '').lower() not in ('1', 'true') \
+            and 'no-cache' not in request.headers.get('Cache-Control', '')
+        
+        result = get_gemini_service().analyze_file(stream, use_cache=use_cache, digest=stream.digest,
+                                                   client=_client_id())
+        
+        if not result or 'content' not in result:
+            return jsonify({'error': 'No content extracted from image'}), 500
+        
+        get_job_queue().record(response.get('filename', file.filename), result)
+        response['result'] = result
+        return jsonify(response), 200
+        
+    except UploadRejected as e:
+        return jsonify({'error': str(e)}), e.status_code
+    except Exception as e:
+        traceback.print_exc()
+        return _error_response(e)
+
+@api_bp.route('/analyze/stream', methods=['POST'])
+def analyze_stream():
+    """Analyze an image, streaming the answer as server-sent events while it is generated
+
+    Accepts the same JSON body as /analyze or a multipart 'file' upload. Events:
+    "delta" (raw text), "field" (one completed bullet, parsed), "done" (the full
+    result) and "error".
+    """
+    try:
+        if request.mimetype == 'multipart/form-data':
+            file = request.files.get('file')
+            if file is None or file.filename == '':
+                return jsonify({'error': 'No file provided'}), 400
+            if not allowed_file(file.filename):
+                return jsonify({'error': 'File type not allowed. Please upload an image.'}), 400
+            source = ingest_upload(file)
+            digest = source.digest
+            filename = None
+            export_name = file.filename
+            use_cache = request.form.get('no_cache', '').lower() not in ('1', 'true')
+        else:
+            data = request.get_json(silent=True)
+            if not data or 'filename' not in data:
+                return jsonify({'error': 'Filename not provided'}), 400
+            source = upload_path(data['filename'])
+            if not source or not os.path.exists(source):
+                return jsonify({'error': 'File not found'}), 404
+            get_upload_storage().touch(source)
+            digest = None
+            filename = export_name = data['filename']
+            use_cache = not data.get('no_cache')
+        use_cache = use_cache and 'no-cache' not in request.headers.get('Cache-Control', '')
+        
+        # The analysis from upload time is replayed in the stream, once finished
+        job = _claim_speculation(filename, use_cache) if filename else None
+        if job is None:
+            # Turn the request away before the event stream starts, while a 503 can still be sent
+            _admit('interactive')
+        gemini_service = get_gemini_service()
+        job_queue = get_job_queue()
+        client = _client_id()
+    except UploadRejected as e:
+        return jsonify({'error': str(e)}), e.status_code
     except Exception as e:
-        error_msg = str(e)
         traceback.print_exc()
+        return _error_response(e)
+    
+    def generate():
+        fields = FieldStream()
+        try:
+            claimed = _await_speculation(job) if job is not None else None
+            if claimed is not None:
+                result = claimed['result']
+                events = [{'type': 'delta', 'text': result['content']}, {'type': 'done', 'result': result}]
+            else:
+                events = gemini_service.analyze_file_stream(source, use_cache=use_cache, digest=digest, client=client)
+            for event in events:
+                if event['type'] == 'delta':
+                    yield f"event: delta\ndata: {json.dumps({'text': event['text']})}\n\n"
+                    completed = fields.feed(event['text'])
+                else:
+                    completed = fields.close()
+                for field in completed:
+                    yield f"event: field\ndata: {json.dumps(field.as_dict())}\n\n"
+                if event['type'] == 'done':
+                    # A replayed speculative job has its own record
+                    if claimed is None:
+                        job_queue.record(export_name, event['result'])
+                    yield f"event: done\ndata: {json.dumps({'success': True, 'result': event['result']})}\n\n"
+        except Exception as e:
+            traceback.print_exc()
+            message, status_code = classify_error(e)
+            yield f"event: error\ndata: {json.dumps({'error': message, 'status': status_code})}\n\n"
+    
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@api_bp.route('/analyze/batch', methods=['POST'])
+def analyze_batch():
+    """Analyze many images concurrently, streaming one NDJSON line per finished item
+
+    Accepts JSON {"filenames": [...]} for already uploaded files, or a multipart
+    body with several "files" parts. A failed item is reported in its own line
+    and never aborts the rest of the batch.
+    """
+    try:
+        max_items = current_app.config['BATCH_MAX_ITEMS']
+        items = []
         
-        # Return appropriate status codes
-        if 'quota' in error_msg.lower() or '429' in error_msg:
-            return jsonify({'error': 'API quota exceeded. Please try again later.'}), 429
-        elif 'timeout' in error_msg.lower() or 'deadline' in error_msg.lower():
-            return jsonify({'error': 'Analysis timed out. Please try again.'}), 504
+        if request.files:
+            files = request.files.getlist('files')
+            if len(files) > max_items:
+                return jsonify({'error': f'Too many files. Maximum batch size is {max_items}.'}), 400
+            for file in files:
+                # Rejected files still get a line in the response
+                try:
+                    filepath, unique_filename = save_file(file)
+                except UploadRejected as e:
+                    items.append((file.filename, None, e))
+                    continue
+                if not filepath:
+                    items.append((file.filename, None, UploadRejected('File type not allowed. Please upload an image.')))
+                    continue
+                items.append((unique_filename, filepath, None))
+            use_cache = request.form.get('no_cache', '').lower() not in ('1', 'true')
         else:
-            return jsonify({'error': f'Analysis failed: {error_msg}'}), 500
+            data = request.get_json(silent=True)
+            if not data or not isinstance(data.get('filenames'), list):
+                return jsonify({'error': 'Filenames not provided'}), 400
+            if len(data['filenames']) > max_items:
+                return jsonify({'error': f'Too many files. Maximum batch size is {max_items}.'}), 400
+            for filename in data['filenames']:
+                filepath = upload_path(filename) if isinstance(filename, str) else None
+                items.append((filename, filepath, None))
+            use_cache = not data.get('no_cache')
+        
+        if not items:
+            return jsonify({'error': 'No files provided'}), 400
+        
+        results = get_batch_runner().run(items, use_cache=use_cache, client=_client_id())
+        job_queue = get_job_queue()
+        
+        def generate():
+            for item in results:
+                if item.get('success'):
+                    job_queue.record(item['filename'], item['result'])
+                yield json.dumps(item) + '\n'
+        
+        lines = generate()
+        return Response(stream_with_context(lines), mimetype='application/x-ndjson', headers={
+            'X-Accel-Buffering': 'no'
+        })
+        
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({'error': f'Batch analysis failed: {str(e)}'}), 500
+
+def _job_payload(job):
+    """Public view of a job record"""
+    payload = {
+        'job_id': job['job_id'],
+        'status': job['status'],
+        'filename': job['filename']
+    }
+    if job['status'] == 'done':
+        payload['result'] = job['result']
+    elif job['status'] == 'failed':
+        payload['error'] = job['error']
+        payload['error_status'] = job['error_status']
+    return payload
+
+@api_bp.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """Return the current status of an analysis job"""
+    job = get_job_queue().get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(_job_payload(job)), 200
+
+@api_bp.route('/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    """Stream job progress as server-sent events until the job finishes"""
+    job_queue = get_job_queue()
+    if job_queue.get(job_id) is None:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    poll_interval = current_app.config['JOB_EVENTS_POLL_INTERVAL']
+    
+    def generate():
+        last_status = None
+        last_sent = time.monotonic()
+        while True:
+            job = job_queue.get(job_id)
+            if job is None:
+                return
+            if job['status'] != last_status:
+                last_status = job['status']
+                last_sent = time.monotonic()
+                yield f"event: progress\ndata: {json.dumps(_job_payload(job))}\n\n"
+                if job['status'] in TERMINAL_STATUSES:
+                    return
+            elif time.monotonic() - last_sent > 15:
+                # Comment line keeps proxies from closing an idle stream
+                last_sent = time.monotonic()
+                yield ': keep-alive\n\n'
+            time.sleep(poll_interval)
+    
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@api_bp.route('/export', methods=['GET'])
+def export_results():
+    """Export finished analyses as JSONL (one per line) or CSV (one field per row)
+
+    Covers queued jobs and analyses answered in their request alike (blocking,
+    streamed, multipart and batch); unclaimed speculative jobs are left out.
+    Query parameters: format=jsonl|csv, since=<unix time> to export only analyses
+    finished after it, and limit.
+    """
+    export_format = request.args.get('format', 'jsonl').lower()
+    if export_format not in ('jsonl', 'csv'):
+        return jsonify({'error': 'Format must be jsonl or csv'}), 400
+    try:
+        since = float(request.args.get('since', 0))
+        limit = int(request.args.get('limit', current_app.config['EXPORT_MAX_ROWS']))
+    except ValueError:
+        return jsonify({'error': 'since and limit must be numbers'}), 400
+    
+    records = get_job_queue().store.finished(since=since, limit=min(limit, current_app.config['EXPORT_MAX_ROWS']))
+    if export_format == 'csv':
+        lines, mimetype = csv_lines(records, ('job_id', 'filename', 'finished_at')), 'text/csv'
+    else:
+        lines, mimetype = jsonl_lines(records), 'application/x-ndjson'
+    return Response(stream_with_context(lines), mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename=results.{export_format}'
+    })
+
+@api_bp.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    """Return result cache and single-flight counters for this worker"""
+    cache = get_result_cache()
+    flights = get_single_flight()
+    stats = {'enabled': False} if cache is None else {'enabled': True, **cache.stats()}
+    stats['single_flight'] = {'enabled': True, **flights.stats()} if flights is not None else {'enabled': False}
+    return jsonify(stats), 200
+
+@api_bp.route('/limiter/stats', methods=['GET'])
+def limiter_stats():
+    """Return the shared rate limiter's state"""
+    limiter = get_rate_limiter()
+    if limiter is None:
+        return jsonify({'enabled': False}), 200
+    return jsonify({'enabled': True, **limiter.stats()}), 200
+
+@api_bp.route('/router/stats', methods=['GET'])
+def router_stats():
+    """Return each API key/model route's health as this worker sees it"""
+    try:
+        router = get_gemini_service().router
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    return jsonify({'routes': router.stats()}), 200
+
+@api_bp.route('/admission/stats', methods=['GET'])
+def admission_stats():
+    """Return this worker's model slots and priority lane queues"""
+    admission = get_admission_controller()
+    if admission is None:
+        return jsonify({'enabled': False}), 200
+    return jsonify({'enabled': True, **admission.stats()}), 200
+
+@api_bp.route('/storage/stats', methods=['GET'])
+def storage_stats():
+    """Return upload folder usage and the most recent sweep report"""
+    storage = get_upload_storage()
+    return jsonify({
+        'usage': storage.usage(),
+        'max_age': storage.max_age,
+        'quota_bytes': storage.quota_bytes,
+        'last_sweep': storage.last_report()
+    }), 200
+
+@api_bp.route('/prompts', methods=['GET'])
+def prompt_stats():
+    """Return the prompt templates, the active one and how it is sent"""
+    library = get_prompt_library()
+    service = None
+    try:
+        service = get_gemini_service()
+        if request.args.get('measure', 'false').lower() == 'true':
+            library.measure(service.backend)
+    except Exception as e:
+        print(f"Could not measure prompts: {e}")
+    return jsonify({
+        'active': service.prompt.id if service else current_app.config['PROMPT_VARIANT'],
+        'mode': service.prompt_mode if service else None,
+        'templates': [template.describe() for template in library.templates()]
+    }), 200
 
 @api_bp.route('/delete/<filename>', methods=['DELETE'])
 def delete_file(filename):
     """Delete uploaded file"""
     try:
-        filepath = current_app.config['UPLOAD_FOLDER'] + '/' + filename
+        filepath = upload_path(filename)
+        
+        # Stop (or forget the result of) an analysis started when it was uploaded
+        speculator = get_speculator()
+        if speculator is not None and filepath:
+            speculator.cancel(filename)
         
         if cleanup_file(filepath):
             return jsonify({'success': True, 'message': 'File deleted'}), 200
@@ -1,4 +1,5 @@
-from flask import Blueprint, render_template
+from flask import Blueprint, Response, abort, render_template
+from app.services.metrics import get_metrics
 
 main_bp = Blueprint('main', __name__)
 
@@ -6,3 +7,11 @@ main_bp = Blueprint('main', __name__)
 def index():
     """Main SPA page"""
     return render_template('index.html')
+
+@main_bp.route('/metrics')
+def metrics():
+    """Prometheus metrics for all workers on this host"""
+    registry = get_metrics()
+    if registry is None:
+        abort(404)
+    return Response(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,231 @@
+import math
+import os
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager, nullcontext
+from flask import current_app
+from app.services.metrics import count, record_stage
+
+LANES = ('interactive', 'batch')
+# Weight of the newest analysis in the average slot hold time
+SERVICE_TIME_ALPHA = 0.2
+
+
+class AdmissionRejected(Exception):
+    """An analysis could not start within its lane's deadline"""
+
+    status_code = 503
+    # Turns away this caller only: an identical analysis waiting on it takes over (single-flight)
+    shared = False
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class _Lane:
+    __slots__ = ('name', 'weight', 'deadline', 'waiting', 'stride', 'admitted', 'rejected')
+
+    def __init__(self, name, weight, deadline):
+        self.name = name
+        self.weight = weight
+        self.deadline = deadline  # seconds of projected wait before rejecting, 0 = wait as long as it takes
+        self.waiting = deque()
+        self.stride = 0.0  # virtual time: grows by 1/weight per admission
+        self.admitted = 0
+        self.rejected = 0
+
+
+class _Ticket:
+    __slots__ = ('client', 'granted')
+
+    def __init__(self, client):
+        self.client = client
+        self.granted = False
+
+
+class AdmissionController:
+    """Hands out this worker's model slots to analyses waiting in priority lanes
+
+    Interactive requests and bulk (batch) work queue in separate lanes. A
+    freed slot goes to the waiting lane that is furthest behind its weighted
+    share (stride scheduling), so batch work keeps moving without crowding out
+    interactive users. Within a lane, the oldest request goes first,
+    skipping clients already holding client_max slots. A request whose
+    projected wait exceeds its lane's deadline is rejected at once, with a
+    retry hint, rather than tying up a worker thread until it times out.
+    """
+
+    def __init__(self, slots, weights, deadlines, client_max=0):
+        self.slots = slots
+        self.client_max = client_max
+        self.lanes = {name: _Lane(name, weights[name], deadlines.get(name, 0)) for name in LANES}
+        self.service_time = None  # average seconds a slot is held, once measured
+        self._in_flight = 0
+        self._clients = Counter()
+        self._virtual_time = 0.0
+        self._condition = threading.Condition()
+
+    def _projected_wait(self, lane):
+        """Seconds until a new request in lane would get a slot, at the current pace"""
+        if self.service_time is None:
+            return 0.0
+        waiting = [other for other in self.lanes.values() if other.waiting]
+        if self._in_flight < self.slots and not waiting:
+            return 0.0
+        share = lane.weight / sum(other.weight for other in self.lanes.values() if other.waiting or other is lane)
+        return (len(lane.waiting) + 1) * self.service_time / (self.slots * share)
+
+    def _reject(self, lane, wait):
+        lane.rejected += 1
+        count('image_analyzer_admissions_total', lane=lane.name, outcome='rejected')
+        return AdmissionRejected('Server is busy. Please try again shortly.', retry_after=max(1, math.ceil(wait)))
+
+    def check(self, lane_name):
+        """Raise AdmissionRejected now if a request in this lane would miss its deadline"""
+        lane = self.lanes[lane_name]
+        with self._condition:
+            wait = self._projected_wait(lane)
+            if lane.deadline and wait > lane.deadline:
+                raise self._reject(lane, wait)
+
+    def has_free_slot(self):
+        """Whether an analysis would start now, with nothing queued ahead of it"""
+        with self._condition:
+            return self._in_flight < self.slots and not any(lane.waiting for lane in self.lanes.values())
+
+    def _eligible(self, lane):
+        for ticket in lane.waiting:
+            if not self.client_max or ticket.client is None or self._clients[ticket.client] < self.client_max:
+                return ticket
+        return None
+
+    def _dispatch(self):
+        """Grant free slots to waiting tickets, lane by weighted share"""
+        granted = False
+        while self._in_flight < self.slots:
+            candidates = [(lane.stride, lane, ticket) for lane in self.lanes.values()
+                          if (ticket := self._eligible(lane)) is not None]
+            if not candidates:
+                break
+            _, lane, ticket = min(candidates, key=lambda candidate: candidate[0])
+            lane.waiting.remove(ticket)
+            lane.stride += 1 / lane.weight
+            lane.admitted += 1
+            self._virtual_time = lane.stride
+            self._in_flight += 1
+            if ticket.client is not None:
+                self._clients[ticket.client] += 1
+            ticket.granted = True
+            granted = True
+        if granted:
+            self._condition.notify_all()
+
+    @contextmanager
+    def slot(self, lane_name, client=None):
+        """Hold a model slot for the enclosed analysis, waiting for one in lane_name's queue"""
+        lane = self.lanes[lane_name]
+        ticket = _Ticket(client)
+        started = time.monotonic()
+        with self._condition:
+            wait = self._projected_wait(lane)
+            if lane.deadline and wait > lane.deadline:
+                raise self._reject(lane, wait)
+            if not lane.waiting:
+                # A lane returning from idle does not get credit for the time it was away
+                lane.stride = max(lane.stride, self._virtual_time)
+            lane.waiting.append(ticket)
+            self._dispatch()
+            while not ticket.granted:
+                remaining = lane.deadline - (time.monotonic() - started) if lane.deadline else None
+                if remaining is not None and remaining <= 0:
+                    lane.waiting.remove(ticket)
+                    raise self._reject(lane, self._projected_wait(lane))
+                self._condition.wait(remaining)
+        count('image_analyzer_admissions_total', lane=lane.name, outcome='admitted')
+        record_stage('analyze.admission_wait', time.monotonic() - started)
+
+        held = time.monotonic()
+        try:
+            yield
+        finally:
+            seconds = time.monotonic() - held
+            with self._condition:
+                self._in_flight -= 1
+                if client is not None:
+                    self._clients[client] -= 1
+                    if not self._clients[client]:
+                        del self._clients[client]
+                self.service_time = seconds if self.service_time is None else (
+                    SERVICE_TIME_ALPHA * seconds + (1 - SERVICE_TIME_ALPHA) * self.service_time)
+                self._dispatch()
+
+    def stats(self):
+        """Slots, queues and projected waits of this worker"""
+        with self._condition:
+            return {
+                'slots': self.slots,
+                'in_flight': self._in_flight,
+                'service_time': round(self.service_time, 3) if self.service_time is not None else None,
+                'clients': len(self._clients),
+                'lanes': {
+                    lane.name: {
+                        'weight': lane.weight,
+                        'deadline': lane.deadline,
+                        'queued': len(lane.waiting),
+                        'admitted': lane.admitted,
+                        'rejected': lane.rejected,
+                        'projected_wait': round(self._projected_wait(lane), 2),
+                    } for lane in self.lanes.values()
+                },
+            }
+
+
+def default_slots(config):
+    """Model calls per worker the shared rate limit sustains, for when ADMISSION_SLOTS is not set
+
+    Each key gets GEMINI_RPM calls a minute; at ADMISSION_MODEL_LATENCY
+    seconds per call that keeps rpm * latency / 60 calls in flight (Little's
+    law), shared by the Gunicorn workers. Without a rate limit the threads
+    are the only bound.
+    """
+    threads = int(os.environ.get('GUNICORN_THREADS', 200))
+    rpm = config['GEMINI_RPM']
+    if not rpm:
+        return threads
+    keys = len({key for key in [config['GEMINI_API_KEY'], *config['GEMINI_API_KEYS']] if key}) or 1
+    workers = int(os.environ.get('GUNICORN_WORKERS') or os.cpu_count() or 1)
+    return min(threads, max(1, math.ceil(rpm * keys * config['ADMISSION_MODEL_LATENCY'] / 60 / workers)))
+
+
+def init_admission_control(app):
+    """Attach the admission controller (None when ADMISSION_SLOTS is 0)"""
+    slots = app.config['ADMISSION_SLOTS']
+    if slots is None:
+        slots = default_slots(app.config)
+    if not slots:
+        app.extensions['admission'] = None
+        return
+    app.extensions['admission'] = AdmissionController(
+        slots,
+        weights={'interactive': app.config['ADMISSION_INTERACTIVE_WEIGHT'], 'batch': 1},
+        deadlines={
+            'interactive': app.config['ADMISSION_INTERACTIVE_DEADLINE'],
+            'batch': app.config['ADMISSION_BATCH_DEADLINE'],
+        },
+        client_max=app.config['ADMISSION_CLIENT_MAX'],
+    )
+
+
+def get_admission_controller():
+    """Return the app's admission controller (None when admission control is off)"""
+    return current_app.extensions.get('admission')
+
+
+def admission_slot(lane='interactive', client=None):
+    """A slot from the app's admission controller, or a no-op when it is off"""
+    admission = get_admission_controller()
+    if admission is None:
+        return nullcontext()
+    return admission.slot(lane, client)
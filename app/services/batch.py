@@ -0,0 +1,105 @@
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from flask import current_app
+
+
+class BatchRunner:
+    """Fans batch items out over one shared pool per worker
+
+    The pool size is the worker-wide cap on in-flight analyses: concurrent
+    batch requests queue behind each other instead of multiplying model calls.
+    """
+
+    def __init__(self, app, max_in_flight=8):
+        self.app = app
+        self.max_in_flight = max_in_flight
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        if self._executor is None or self._pid != os.getpid():
+            with self._lock:
+                if self._executor is None or self._pid != os.getpid():
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.max_in_flight,
+                        thread_name_prefix='batch'
+                    )
+                    self._pid = os.getpid()
+        return self._executor
+
+    def run(self, items, use_cache=True, client=None):
+        """Analyze (filename, filepath, error) items, yielding one result dict per item as it finishes
+
+        Items that already carry an error (e.g. a rejected upload) are reported
+        straight away without touching the model. Model calls go through the
+        batch admission lane, so interactive requests are served first.
+        """
+        started = time.monotonic()
+        executor = self._get_executor()
+        futures = {}
+        rejected = []
+        succeeded = failed = 0
+
+        for index, (filename, filepath, error) in enumerate(items):
+            if error is not None:
+                rejected.append({'index': index, 'filename': filename, 'success': False,
+                                 'error': str(error), 'error_status': getattr(error, 'status_code', 400)})
+            else:
+                futures[executor.submit(self._analyze, filepath, use_cache, client)] = (index, filename)
+
+        try:
+            for item in rejected:
+                failed += 1
+                yield item
+
+            for future in as_completed(futures):
+                index, filename = futures[future]
+                item = {'index': index, 'filename': filename}
+                item.update(future.result())
+                if item['success']:
+                    succeeded += 1
+                else:
+                    failed += 1
+                yield item
+        finally:
+            # Client went away: don't spend quota on items nobody will read
+            for future in futures:
+                future.cancel()
+
+        yield {
+            'done': True,
+            'total': len(items),
+            'succeeded': succeeded,
+            'failed': failed,
+            'elapsed': round(time.monotonic() - started, 3)
+        }
+
+    def _analyze(self, filepath, use_cache, client):
+        """Analyze one item; errors are returned, never raised, so siblings keep going"""
+        from app.services.gemini_service import get_gemini_service, classify_error
+
+        with self.app.app_context():
+            try:
+                if not filepath or not os.path.exists(filepath):
+                    return {'success': False, 'error': 'File not found', 'error_status': 404}
+                result = get_gemini_service().analyze_file(filepath, use_cache=use_cache, lane='batch', client=client)
+                if not result or 'content' not in result:
+                    return {'success': False, 'error': 'No content extracted from image', 'error_status': 500}
+                return {'success': True, 'result': result}
+            except Exception as e:
+                traceback.print_exc()
+                message, status_code = classify_error(e)
+                return {'success': False, 'error': message, 'error_status': status_code}
+
+
+def init_batch_runner(app):
+    """Attach the batch runner to the app"""
+    app.extensions['batch_runner'] = BatchRunner(app, max_in_flight=app.config['BATCH_MAX_IN_FLIGHT'])
+
+
+def get_batch_runner():
+    return current_app.extensions['batch_runner']
@@ -1,510 +1,666 @@
-import google.generativeai as genai
+from dotenv import dotenv_values
 from flask import current_app
 from PIL import Image
+import math
+import os
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from app.services.admission import AdmissionRejected, admission_slot
+from app.services.rate_limiter import (
+    RateLimitTimeout, get_rate_limiter, is_quota_error, is_transient_error, parse_retry_after, backoff_delay,
+    register_rate_limiters
+)
+from app.services.metrics import count, record_stage, timed
+from app.services.model_backends import create_backend
+from app.services.model_router import ModelRouter, Route
+from app.services.perceptual_index import get_perceptual_index
+from app.services.prompt_service import get_active_prompt
+from app.services.result_cache import get_result_cache, hash_file, make_cache_key, fingerprint
+from app.services.single_flight import Flight, get_single_flight
+from app.utils.concurrency import run_blocking
+from app.utils.image_processing import dhash, preprocess_image, preprocess_settings, preprocess_tiles, tiling_settings
+from app.utils.result_parser import FieldText, fields_from_json, merge_results, parse_fields
+
+# Generation settings shared by every analysis call
+GENERATION_CONFIG = {
+    "temperature": 0.4,
+    "top_p": 1,
+    "top_k": 32,
+    "max_output_tokens": 8192,
+}
+_GENERATION_CONFIG_FINGERPRINT = fingerprint(GENERATION_CONFIG)
+
+
+class EmptyResponse(Exception):
+    """The model answered without any text"""
+
 
 class GeminiService:
-    """Service class for Gemini AI operations"""
-    
-    def __init__(self):
-        self.model = None
-        self._configure()
+    """Service class for Gemini AI operations
+
+    Model calls go through a ModelBackend: the Gemini API itself, or the
+    local fake (MODEL_BACKEND=fake) for benchmarks and offline runs. There is
+    one backend per API key and model (GEMINI_API_KEYS, GEMINI_FALLBACK_MODELS),
+    and a ModelRouter picks the one each call goes to; self.backend is the
+    primary key and model.
+    """
     
-    def _configure(self):
-        """Configure Gemini API"""
-        genai.configure(api_key=current_app.config['GEMINI_API_KEY'])
+    def __init__(self, api_key=None, model_name=None, prompt=None, backend=None, api_keys=None,
+                 fallback_models=None):
+        config = current_app.config
+        self.api_key = api_key or config['GEMINI_API_KEY']
+        self.model_name = model_name or config['GEMINI_MODEL']
+        self.prompt = prompt or get_active_prompt()
+        api_keys = config['GEMINI_API_KEYS'] if api_keys is None else api_keys
+        fallback_models = config['GEMINI_FALLBACK_MODELS'] if fallback_models is None else fallback_models
+        keys = list(dict.fromkeys([self.api_key, *api_keys]))
+        models = list(dict.fromkeys([self.model_name, *fallback_models]))
         
-        # Configure generation settings
-        generation_config = {
-            "temperature": 0.4,
-            "top_p": 1,
-            "top_k": 32,
-            "max_output_tokens": 8192,
-        }
-        
-        self.model = genai.GenerativeModel(
-            current_app.config['GEMINI_MODEL'],
-            generation_config=generation_config
+        routes = [
+            Route(f'key-{number}', key, model,
+                  create_backend(config, key, model, self.prompt, GENERATION_CONFIG, name=backend,
+                                 primary=key == self.api_key),
+                  tier)
+            for tier, model in enumerate(models)
+            for number, key in enumerate(keys, start=1)
+        ]
+        self.router = ModelRouter(
+            routes,
+            budget=self._route_budget,
+            breaker_threshold=config['ROUTER_BREAKER_THRESHOLD'],
+            breaker_cooldown=config['ROUTER_BREAKER_COOLDOWN'],
+            slow_after=config['ROUTER_SLOW_AFTER']
         )
+        self.backend = self.router.primary.backend
     
-    def _get_analysis_prompt(self):
-        """Get the comprehensive analysis prompt for Gemini"""
-        return """You are an elite handwriting recognition and OCR specialist with decades of forensic document analysis experience. Your accuracy is CRITICAL - errors could cause serious problems.
-
-## 🧠 MANDATORY MULTI-PASS THINKING PROCESS
-
-You MUST perform ALL these thinking passes internally before producing output. Take your time - accuracy over speed.
-
-### ═══════════════════════════════════════════════════════════
-### PASS 1: GLOBAL DOCUMENT SCAN (Think about the big picture)
-### ═══════════════════════════════════════════════════════════
-
-**Ask yourself:**
-- What type of document is this? (form, receipt, check, note, letter, table, invoice, application, etc.)
-- What is the expected content based on document type?
-- What fields would typically appear on this document type?
-- Is there a mix of printed and handwritten text?
-- What is the overall quality? (clear, faded, damaged, rotated, skewed)
-- Are there multiple writing styles suggesting multiple authors?
-
-### ═══════════════════════════════════════════════════════════
-### PASS 2: STRUCTURAL MAPPING (Understand the layout)
-### ═══════════════════════════════════════════════════════════
-
-**Map every region:**
-- Headers, titles, logos at the top
-- Form fields with labels and boxes
-- Tables with rows and columns
-- Free-form writing areas
-- Signatures and dates at bottom
-- Margins with notes or stamps
-- Any watermarks or background text
-
-**Identify spatial relationships:**
-- Which text belongs to which field?
-- Text that spans multiple lines in one field
-- Text written OUTSIDE designated boxes
-- Arrows or lines connecting elements
-- Strikethroughs and corrections
-
-### ═══════════════════════════════════════════════════════════
-### PASS 3: CHARACTER-BY-CHARACTER ANALYSIS (The critical pass)
-### ═══════════════════════════════════════════════════════════
-
-**For EVERY handwritten character, ask:**
-
-**Digit vs Letter Confusion Matrix - THINK CAREFULLY:**
-| Character | Could be | Decision factors |
-|-----------|----------|-------------------|
-| 0 | O, o, D | Field type (numeric?), roundness, closure |
-| 1 | I, l, 7, | | Field type, serifs, height, angle |
-| 2 | Z, z | Field type, bottom stroke direction |
-| 3 | E, 8 | Number of curves, closure |
-| 4 | A, 9, H | Top closure, vertical stroke |
-| 5 | S, s | Field type, top stroke |
-| 6 | G, b | Loop direction, tail |
-| 7 | 1, T, F | Top bar, angle of stroke |
-| 8 | B, 3, & | Symmetry, curves |
-| 9 | g, q, 4 | Loop position, tail direction |
-
-**Similar Letter Confusion - EXAMINE STROKE PATTERNS:**
-- **a vs o vs u**: Check if closed, open top, or has tail
-- **c vs e**: Look for middle horizontal stroke
-- **n vs m vs r**: Count humps, check connections
-- **rn vs m**: VERY COMMON - look for pen lift between r and n
-- **u vs v vs n**: Check if rounded or pointed bottom
-- **h vs b vs k**: Check loop presence and position
-- **i vs j vs l**: Check dots and descenders
-- **t vs f vs l**: Check crossbars and length
-- **d vs cl vs a**: Check for loop or two separate strokes
-- **w vs uu vs vv**: Count strokes and valleys
-- **P vs R vs B**: Check for leg and loops
-
-**Cursive-Specific Issues:**
-- Letters connected in unexpected ways
-- Loops that look like different letters
-- Missing dots on i and j
-- Missing crossbars on t
-- Letter combinations that merge: th, sh, ch, tion
-
-### ═══════════════════════════════════════════════════════════
-### PASS 4: CONTEXTUAL VALIDATION (Does it make sense?)
-### ═══════════════════════════════════════════════════════════
-
-**Semantic Checks:**
-- Does the name look like a real name? (proper capitalization, reasonable length)
-- Is the date valid? (not Feb 30, not in the future for historical docs)
-- Does the phone number have correct digit count for the region?
-- Does the ZIP/postal code match expected format?
-- Do monetary amounts make sense in context?
-- Are account/reference numbers the expected length?
-- Is the address structure logical? (number, street, city, state)
-
-**Cross-Reference Checks:**
-- If same info appears twice, do they match?
-- Does the signature name match the printed name?
-- Are dates consistent throughout the document?
-- Do totals add up correctly if there are calculations?
-
-### ═══════════════════════════════════════════════════════════
-### PASS 5: EDGE CASE DEEP DIVE (Catch the tricky stuff)
-### ═══════════════════════════════════════════════════════════
-
-**⚠️ CRITICAL: BOX LINES & GRID INTERFERENCE ⚠️**
-Form boxes, table grids, and underlines can DRASTICALLY change how digits/letters appear!
-
-**Digits Distorted by Horizontal Lines:**
-| Digit | + Line = Looks like | How to tell the difference |
-|-------|---------------------|---------------------------|
-| 0 | 4, 8, θ | Check if line is part of form or the digit - 0 has no internal strokes |
-| 0 | 6, 9 | Line at top/bottom can create false loop tail - check roundness |
-| 1 | 4, 7 | Horizontal line crossing = false top bar - check if line continues beyond digit |
-| 3 | 8 | Line through middle creates false closure - trace the actual ink |
-| 6 | 8 | Line through top creates false upper loop - check if 6's top is open |
-| C | G, O | Line through middle creates false bar - check stroke continuity |
-| c | e, o | Line creates false crossbar - examine actual handwritten stroke |
-
-**Digits Distorted by Vertical Lines:**
-| Digit | + Line = Looks like | How to tell the difference |
-|-------|---------------------|---------------------------|
-| 0 | 8, 10 | Vertical through middle = false figure-8 look - check actual curves |
-| O | D, 0 | Vertical line on right = false straight edge - trace the curve |
-| C | ( , [ | Can look like bracket with vertical line - check closure |
-| 3 | B | Vertical line on left = false closed loops - check right side |
-
-**Digits Distorted by Box Corners:**
-- **0 at corner** → Can look like 4 (corner creates angular appearance)
-- **0 touching edges** → Can look like D, O with flat side
-- **8 at corner** → Upper or lower loop may be cut off
-- **6 or 9 at edge** → Loop may appear clipped or angular
-
-**Grid/Table Cell Issues:**
-- Digit written across cell boundary → May appear split or have false stroke
-- Multiple digits per cell → Don't mistake cell divider for digit
-- Digit touching all four walls → Creates rectangular appearance, ignore box lines
-- Very small boxes → Writing compressed, strokes merge with box lines
-
-**MASTER RULE FOR BOX INTERFERENCE:**
-1. First, mentally REMOVE all printed form lines (boxes, grids, underlines)
-2. Look ONLY at the ink that was handwritten
-3. Trace the handwritten strokes independently
-4. Then determine the character
-5. If a "stroke" continues perfectly beyond the character, it's a form line, not part of the digit
-
-**Writing Quality Issues:**
-- Faded/light ink: Mentally enhance, look for pressure patterns
-- Smeared/smudged: Use context from visible portions
-- Overwritten/corrected: Extract BOTH original and correction if visible
-- Cramped writing: Slow down, trace each stroke
-- Excessively large writing: Check for spillover into other fields
-- Writing over printed text: Separate the layers mentally
-- Ink bleeding through from other side of paper
-- Photocopied/scanned artifacts (shadows, dark edges)
-- Carbon copy faintness
-
-**Physical Form Issues:**
-- Text outside boxes: CAPTURE IT - people often overflow
-- Text on top of lines: Common - don't ignore
-- Checkboxes: ✓, X, filled circle, or left blank?
-- Multiple items circled or underlined
-- Ditto marks (") or "same as above"
-- Abbreviations: St., Ave., Apt., etc.
-- Pre-printed text that was crossed out and written over
-- Stamps overlapping handwriting
-- Staple holes or punch holes near text
-
-**Numbers - Special Attention:**
-- Decimal points vs commas (1,000 vs 1.000)
-- Currency symbols ($, €, £, ₹)
-- Leading zeros (007, 0123)
-- Dashes in numbers (SSN: 123-45-6789)
-- Fractions (1/2, 3/4)
-- Written numbers (one, two, three)
-- Superscript/subscript numbers
-- Numbers in circles or squares (like ① ② ③)
-
-**More Tricky Character Confusions:**
-- **4 vs 9**: Both have a loop-like top - check if closed (9) or open angular (4)
-- **4 vs A**: In numbers likely 4, check for crossbar position
-- **7 vs 1**: Check for horizontal top stroke (7 has it, 1 doesn't)
-- **7 vs F**: In numbers likely 7, in text likely F
-- **5 vs 6**: Check top - 5 has horizontal, 6 has curve
-- **Dollar sign $ vs 5 or S**: Check for vertical line through
-- **Percent % vs 96 or %**: Context matters - look for the slash
-- **Ampersand & vs 8**: Ampersand has tail extending down-left
-- **@ vs a or 2**: Check for encircling stroke
-
-**Underline vs Character Parts:**
-- Underline below text can look like: g tail, y tail, underscore part of email
-- Double underline can appear as = equals sign
-- Wavy underline can merge with letters like g, j, y, q
-
-**Multi-Digit Sequences - Watch For:**
-- 10 vs IO vs 1O vs l0 (one-zero vs letter combinations)
-- 11 vs II vs ll vs 77 (ones vs letters vs sevens)
-- 00 vs OO vs oo (zeros vs letters)
-- 01 vs OI vs 0l (zero-one vs letter combinations)
-- rn vs m, vv vs w, cl vs d (letter combinations that merge)
-
-### ═══════════════════════════════════════════════════════════
-### PASS 6: FINAL VERIFICATION (Triple-check before output)
-### ═══════════════════════════════════════════════════════════
-
-**Before finalizing each extracted value:**
-1. Re-examine the original image region
-2. Consider alternative interpretations
-3. Check if your reading makes logical sense
-4. Verify spelling of common words
-5. Ensure numbers have correct digit count
-6. Confirm you haven't missed anything
-
-**Confidence Assessment:**
-- High confidence: Output directly
-- Medium confidence: Double-check context
-- Low confidence: Mark with [?] ONLY after exhausting all analysis
-
-### ═══════════════════════════════════════════════════════════
-### SPECIAL HANDLING RULES (INDIA-SPECIFIC)
-### ═══════════════════════════════════════════════════════════
-
-**Dates - Indian Formats:**
-- DD/MM/YYYY (PRIMARY - most common in India)
-- DD-MM-YYYY, DD.MM.YYYY
-- Written out: 5 January 2024, 5th Jan 2024
-- Hindi months: जनवरी, फरवरी, etc.
-- Watch for 1 vs / (slashes can look like ones)
-
-**Indian Names:**
-- First name + Last name OR First + Middle + Last
-- South Indian: Initial(s) + Name (e.g., K. Ramesh, S.R. Kumar)
-- North Indian: Full first name + surname
-- Titles: Shri, Smt, Sri, Dr., Mr., Mrs., Ms.
-- Suffixes: Jr., Sr. (rare in India)
-- Common prefixes in names: Kumar, Singh, Sharma, Patel, Reddy, etc.
-- Handle transliteration variations (Sharma/Sarma, Krishna/Krishnan)
-
-**Indian Addresses:**
-- House/Flat No., Building/Society Name
-- Street/Road Name, Area/Locality
-- City/Town/Village
-- District (important in India)
-- State (full name or abbreviation)
-- PIN Code: 6 digits exactly (e.g., 400001, 110001)
-- Landmarks often included: "Near X", "Opp. Y", "Behind Z"
-- Common abbreviations: Rd., St., Nagar, Colony, Enclave, Vihar
-
-**Indian Phone Numbers:**
-- Mobile: 10 digits starting with 6/7/8/9 (e.g., 9876543210)
-- With country code: +91 98765 43210
-- Landline: STD code + number (e.g., 022-12345678, 011-23456789)
-- Common formats: 98765-43210, 98765 43210, 9876543210
-
-**Indian Financial/Banking:**
-- Account numbers: 9-18 digits (varies by bank)
-- IFSC Code: 11 characters (4 letters + 0 + 6 alphanumeric) e.g., SBIN0001234
-- UPI ID: name@bankhandle (e.g., name@upi, name@paytm)
-- PAN Card: 10 characters (AAAAA0000A format - 5 letters, 4 digits, 1 letter)
-- Aadhaar: 12 digits (often written as 0000 0000 0000)
-- GST Number: 15 characters (state code + PAN + entity + Z + checksum)
-- Indian Rupee: ₹ symbol, Rs., INR
-- Indian numbering: Lakhs (1,00,000) and Crores (1,00,00,000)
-- Amount in words: "Rupees One Lakh Twenty Thousand Only"
-
-**Indian Government IDs & Documents:**
-- Aadhaar Card: 12-digit UID, name in English + regional language
-- PAN Card: Permanent Account Number (AAAAA0000A)
-- Voter ID (EPIC): 10 characters alphanumeric
-- Driving License: State code + numbers (format varies by state)
-- Passport: Letter + 7 digits (e.g., A1234567)
-- Ration Card: Format varies by state
-- Birth/Death Certificate: Registration number formats vary
-
-**Indian Bank Documents:**
-- Cheque: Account number, IFSC, MICR code (9 digits)
-- Demand Draft: DD number, date, amount in figures and words
-- Passbook: Account details, transaction entries
-- Bank statements: Date, narration, debit/credit, balance
-
-**Common Indian Form Fields:**
-- Father's/Husband's Name (common requirement)
-- Date of Birth (DOB)
-- Gender: Male/Female/Other
-- Marital Status
-- Religion, Caste, Category (SC/ST/OBC/General)
-- Occupation/Profession
-- Annual Income
-- Nominee details
-- Witness signatures
-
-**Indian Languages in Documents:**
-- Hindi (Devanagari script): हिंदी
-- Tamil: தமிழ்
-- Telugu: తెలుగు
-- Kannada: ಕನ್ನಡ
-- Malayalam: മലയാളം
-- Bengali: বাংলা
-- Gujarati: ગુજરાતી
-- Marathi: मराठी
-- Punjabi (Gurmukhi): ਪੰਜਾਬੀ
-- Odia: ଓଡ଼ିଆ
-- Bilingual forms: English + Regional language
-- Transliterated text: English letters for Indian words
-
-**Indian Handwriting Peculiarities:**
-- Mixing English and regional scripts
-- Numbers often in international format (not Devanagari numerals)
-- Signatures may be in English or regional script
-- Thumbprints (अंगूठा/Left Thumb Impression) instead of signatures
-- Common short forms: S/o (Son of), D/o (Daughter of), W/o (Wife of), C/o (Care of)
-- "Shri" before male names, "Smt" before married female names
-
-**Indian Stamps & Seals:**
-- Revenue stamps on affidavits
-- Notary stamps/seals
-- Bank stamps with branch details
-- Official stamps: "RECEIVED", "VERIFIED", "APPROVED"
-- Date stamps in DD/MM/YYYY format
-
-### ═══════════════════════════════════════════════════════════
-### ADDITIONAL EDGE CASES CHECKLIST
-### ═══════════════════════════════════════════════════════════
-
-**Writing Instruments & Ink Issues:**
-- Ballpoint pen: May have gaps where ink skipped
-- Fountain pen: Variable line thickness, may have blots
-- Pencil: Light, may be smudged, eraser marks visible
-- Marker/Sharpie: Thick strokes, may bleed through
-- Multiple pen colors: Different sections in different colors
-- Pen running out of ink mid-word
-
-**Paper & Document Conditions:**
-- Wrinkled/folded paper: Text may be distorted along fold lines
-- Torn edges: Partial characters at edges
-- Coffee/water stains: Obscured text underneath
-- Yellowed/aged paper: Reduced contrast
-- Glossy paper: Glare spots hiding text
-- Lined paper: Don't confuse ruled lines with underscores or dashes
-- Graph paper: Grid can interfere massively with digits
-
-**Orientation & Perspective:**
-- Rotated text (90°, 180°, 270°): Mentally rotate before reading
-- Skewed/tilted scanning: Characters may appear slanted
-- Perspective distortion: Text at edges may be warped
-- Upside-down writing: Some people write upside down accidentally
-- Sideways marginal notes: Common in forms
-
-**Cultural & Regional Variations (India Focus):**
-- Indian numbering system: Lakhs (1,00,000) and Crores (1,00,00,000)
-- Decimal format: 1,00,000.00 (Indian) vs 100,000.00 (Western)
-- Date format: DD/MM/YYYY (Indian standard)
-- Slashed zero (Ø): Sometimes used to distinguish from O
-- Regional script numerals: ० १ २ ३ (Devanagari), ౦ ౧ ౨ (Telugu), etc.
-- Mixed script: English letters with Indian language words
-
-**Handwriting Styles:**
-- ALL CAPS: May lack usual lowercase cues
-- all lowercase: Names may not be capitalized
-- Mixed case randomly: MiXeD cAsE
-- Architectural/engineer lettering: Very uniform, may look printed
-- Doctor's handwriting: Notoriously difficult, use extra context
-- Elderly handwriting: May be shaky/trembling
-- Left-handed writing: May have different slant, smudging on right
-- Child's handwriting: Inconsistent sizing, reversed letters possible
-
-**Special Characters & Symbols:**
-- Slashes: / vs 1 vs l vs | (vertical line)
-- Hyphens vs dashes vs minus: - – —
-- Periods vs commas vs dots: . , · 
-- Apostrophe vs single quote vs accent: ' ' ´ `
-- Colon vs semicolon: : ;
-- Parentheses vs brackets: () [] {}
-- Plus sign vs t: + vs t
-- Asterisk vs star vs x: * ✱ × x
-- Hash/pound vs number: # № No.
-- Degree symbol vs superscript o: ° ᵒ
-
-**Email & Digital Content:**
-- @ symbol: Can look like a, 2, or swirl
-- Dots in emails: Easy to miss or confuse with smudges
-- Underscores: _ can merge with underlines
-- Domain extensions: .com, .org may be abbreviated
-- Mixed case in emails: Technically case-insensitive but preserve as written
-
-**Phone Numbers - Indian Formats:**
-- Mobile: 10 digits (9876543210)
-- With spaces: 98765 43210
-- With dashes: 98765-43210
-- With country code: +91 98765 43210
-- Landline with STD: 022-12345678
-
-**Common Indian Abbreviations:**
-- Months: Jan/Jun confusion, Mar/May
-- States: MH (Maharashtra), KA (Karnataka), TN (Tamil Nadu), DL (Delhi), UP, MP, etc.
-- Titles: Shri/Sri/Smt/Dr/Mr/Mrs
-- Address: Rd/St/Nagar/Colony/Sector/Phase/Block
-- Relations: S/o, D/o, W/o, C/o
-- Documents: DOB, PAN, UID, DL, RC
-
-**Checkboxes & Selection Marks:**
-- ✓ (checkmark)
-- X or x (cross)
-- ● (filled circle)
-- ○ (empty circle - NOT selected)
-- ■ (filled square)
-- □ (empty square - NOT selected)
-- Scribbled fill (messy but means selected)
-- Circle around option (selection method)
-- Underline under option (selection method)
-
-**Corrections & Modifications:**
-- Single strikethrough: ~~word~~
-- Double strikethrough: More emphatic deletion
-- Scribbled out: Completely obscured
-- White-out/correction tape: Look for text underneath or on top
-- Carets (^) for insertions: Text may be added above line
-- Arrows pointing to inserted text
-- "VOID" or "CANCELLED" stamps
-- Initials next to corrections (for verification)
-
-## 📋 OUTPUT FORMAT - CLEAN AND PRECISE
-
-Extract ONLY the essential information in this format:
-
-- **Field Name:** Extracted value
-- **Another Field:** Its value
-
-**Rules:**
-- Use **bold** for field labels
-- One bullet point per field
-- NO section headers like "Document Type" or "Observations"
-- NO commentary about handwriting quality
-- If there are corrections, note briefly: "~~crossed out~~ corrected to X"
-- Use [?] ONLY when truly unreadable after all passes
-- Keep output SHORT - just the data
-
-Now perform all 6 passes mentally, then output ONLY the extracted information:"""
+    @staticmethod
+    def _route_budget(route):
+        """Calls the route's key and model may make right now, by its shared rate limiter"""
+        limiter = get_rate_limiter(route.api_key, route.model_name)
+        return limiter.available() if limiter is not None else math.inf
+    
+    @property
+    def prompt_mode(self):
+        return self.backend.prompt_mode
+    
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def analysis_fingerprint(model_name, prompt_fingerprint, preprocessing=None, backend='gemini',
+                             output_format='markdown'):
+        """Fingerprint of everything besides the image that shapes a result"""
+        if backend != 'gemini':
+            model_name = f'{backend}:{model_name}'  # fake answers must never be served as real ones
+        if output_format != 'markdown':
+            prompt_fingerprint = f'{prompt_fingerprint}:{output_format}'
+        return fingerprint(model_name, GENERATION_CONFIG, prompt_fingerprint, preprocessing)
+    
+    @staticmethod
+    def _result(content, cached, **extra):
+        """The result dict returned for an analysis: the answer text and its fields
 
-    def analyze_image(self, image_path):
-        """Analyze a single image with Gemini with retry logic"""
-        max_retries = 2
-        retry_delay = 3
+        A fresh structured answer brings its fields along; any other text is parsed.
+        """
+        fields = content.fields if isinstance(content, FieldText) else parse_fields(content)
+        return {
+            'type': 'image',
+            'content': str(content),
+            'fields': [field.as_dict() for field in fields],
+            'cached': cached,
+            **extra
+        }
+    
+    def analyze_image(self, image_path, progress=None, served=None, prepared=None):
+        """Analyze a single image with Gemini with retry logic
+
+        Calls are shaped by the shared rate limiter. Quota (429) and transient
+        errors are retried with jittered exponential backoff that honours any
+        retry-after hint in the error, or at once on another key or model.
+        Large images are analyzed in tiles when tiling is enabled. The routes
+        that answered are appended to served, if given. Pass prepared (a
+        PreparedImage, or a list of them as tiles) to send an image that was
+        already preprocessed, e.g. in another process; image_path is then unused.
+        """
+        if progress:
+            progress('uploading')
+        
+        if isinstance(prepared, list):
+            tiles = prepared
+        elif prepared is not None:
+            tiles, image_part = None, prepared.as_part()
+        else:
+            with timed('analyze.prepare'):
+                tiles = self._prepare_tiles(image_path)
+                if tiles is None:
+                    image_part = self._prepare_image(image_path)
+        
+        if tiles is not None:
+            if progress:
+                progress('model-running')
+            return self._analyze_tiles(tiles, served)
+        
+        return self._call_model(lambda backend: self._generate(backend, image_part, required=True),
+                                'analyze.model', progress, served)
+    
+    @staticmethod
+    def _generate(backend, image_part, required=False):
+        """One model call; a structured (JSON) answer comes back as the usual bullets, fields attached"""
+        text = backend.generate(image_part)
+        if not text:
+            if required:
+                raise EmptyResponse("Empty response from Gemini API")
+            return ''
+        if backend.output_format == 'json':
+            try:
+                fields = fields_from_json(text)
+            except ValueError as e:
+                raise Exception(f"Model returned invalid JSON: {e}")
+            text = FieldText.render(fields)
+        return text
+    
+    def analyze_image_stream(self, image_path, served=None):
+        """Like analyze_image, but yield the answer text in pieces as it is generated
+
+        Errors before the first piece are retried as usual; once text has been
+        handed out, a failure part-way through the answer is raised as is.
+        A tiled or structured (JSON) analysis arrives in one piece, once complete.
+        """
+        with timed('analyze.prepare'):
+            tiles = self._prepare_tiles(image_path)
+            if tiles is None:
+                image_part = self._prepare_image(image_path)
+        
+        if tiles is not None:
+            yield self._analyze_tiles(tiles, served)
+            return
+        if self.backend.output_format == 'json':
+            yield self._call_model(lambda backend: self._generate(backend, image_part, required=True),
+                                   'analyze.model', served=served)
+            return
+        
+        def first_chunk(backend):
+            chunks = backend.generate_stream(image_part)
+            for chunk in chunks:
+                if chunk:
+                    return chunk, chunks
+            raise EmptyResponse("Empty response from Gemini API")
+        
+        first, rest = self._call_model(first_chunk, 'analyze.first_chunk', served=served)
+        yield first
+        yield from rest
+    
+    def _analyze_tiles(self, tiles, served=None):
+        """Analyze all tiles at once and merge their answers
+
+        Each tile goes through the rate limiter and retries on its own, so the
+        whole takes about as long as the slowest tile. A tile with no text
+        (e.g. a blank margin) is fine as long as some tile has an answer.
+        """
+        app = current_app._get_current_object()
+        
+        def analyze(tile):
+            part = tile.as_part()
+            with app.app_context():
+                return self._call_model(lambda backend: self._generate(backend, part), 'analyze.model', served=served)
+        
+        with ThreadPoolExecutor(max_workers=len(tiles), thread_name_prefix='tile') as pool:
+            texts = list(pool.map(analyze, tiles))
+        
+        with timed('analyze.merge'):
+            text = merge_results(texts)
+        if not text:
+            raise EmptyResponse("Error analyzing image: Empty response from Gemini API")
+        return text
+    
+    def _call_model(self, call, stage, progress=None, served=None):
+        """Run call(backend) on a route picked by the router, under that route's rate limiter
+
+        Quota and transient errors are retried: at once when the router now
+        prefers another key or model, otherwise after a backoff. The route
+        that answered is appended to served, if given.
+        """
+        config = current_app.config
+        max_retries = config['GEMINI_MAX_RETRIES']
         
         for attempt in range(max_retries):
+            route = self.router.choose()
+            limiter = get_rate_limiter(route.api_key, route.model_name)
+            started = None
             try:
-                img = Image.open(image_path)
+                if limiter is not None:
+                    with timed('analyze.rate_limit_wait'):
+                        limiter.acquire(cost=self.estimated_request_tokens())
                 
-                # Resize large images to reduce processing time
-                max_size = 1536
-                if max(img.size) > max_size:
-                    img.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+                if progress:
+                    progress('model-running')
                 
-                prompt = self._get_analysis_prompt()
+                started = time.perf_counter()
+                with timed(stage):
+                    result = call(route.backend)
                 
-                # Generate content (timeout handled by server/gunicorn)
-                response = self.model.generate_content([prompt, img])
-                
-                if not response or not response.text:
-                    raise Exception("Empty response from Gemini API")
+                self.router.release(route, 'success', time.perf_counter() - started)
+                count('image_analyzer_model_calls_total', outcome='success')
+                if limiter is not None:
+                    limiter.record_success()
+                if served is not None:
+                    served.append(route)
                     
-                return response.text
+                return result
                 
+            except RateLimitTimeout:
+                self.router.release(route)
+                raise
             except Exception as e:
                 error_msg = str(e)
-                if "429" in error_msg or "quota" in error_msg.lower():
-                    raise Exception("API quota exceeded. Please try again later.")
+                quota_error = is_quota_error(e)
+                transient_error = is_transient_error(e)
+                retry_after = parse_retry_after(e) if quota_error else None
+                
+                if quota_error:
+                    outcome = 'quota_error'
+                elif transient_error:
+                    outcome = 'transient_error'
+                else:
+                    outcome = 'empty' if isinstance(e, EmptyResponse) else 'error'
+                count('image_analyzer_model_calls_total', outcome=outcome)
+                self.router.release(route, outcome, time.perf_counter() - started if started else None, retry_after)
                 
-                if attempt < max_retries - 1:
-                    if "deadline" in error_msg.lower() or "timeout" in error_msg.lower():
-                        time.sleep(retry_delay)
-                        retry_delay *= 2  # Exponential backoff
-                        continue
+                if quota_error:
+                    count('image_analyzer_quota_errors_total')
+                    if limiter is not None:
+                        limiter.record_throttle(retry_after)
                 
+                if attempt < max_retries - 1 and (quota_error or transient_error):
+                    count('image_analyzer_model_retries_total', reason='quota' if quota_error else 'transient')
+                    if not self.router.has_alternative(route):
+                        with timed('analyze.retry_sleep'):
+                            time.sleep(backoff_delay(
+                                attempt,
+                                base=config['GEMINI_RETRY_BASE_DELAY'],
+                                cap=config['GEMINI_RETRY_MAX_DELAY'],
+                                retry_after=retry_after
+                            ))
+                    continue
+                
+                if quota_error:
+                    raise Exception("API quota exceeded. Please try again later.")
                 raise Exception(f"Error analyzing image: {error_msg}")
     
-    def analyze_file(self, filepath):
-        """Main method to analyze image file"""
-        content = self.analyze_image(filepath)
-        return {
-            'type': 'image',
-            'content': content
-        }
+    @staticmethod
+    def _preprocessing_fingerprint():
+        """Hashable summary of the preprocessing settings, part of the cache key"""
+        config = current_app.config
+        if not config['PREPROCESS_ENABLED']:
+            return ('legacy', config['PREPROCESS_MAX_SIZE'])
+        tiling = tiling_settings(config)
+        if tiling is not None:
+            return ('tiled',) + tuple(sorted(tiling.items()))
+        return tuple(sorted(preprocess_settings(config).items()))
+    
+    @staticmethod
+    def _prepare_image(image_path):
+        """Return the image content part to send with the prompt"""
+        config = current_app.config
+        
+        try:
+            if config['PREPROCESS_ENABLED']:
+                return run_blocking(preprocess_image, image_path, **preprocess_settings(config)).as_part()
+            return run_blocking(GeminiService._thumbnail, image_path, config['PREPROCESS_MAX_SIZE'])
+        except Exception as e:
+            raise Exception(f"Error analyzing image: {e}")
+    
+    @staticmethod
+    def _prepare_tiles(image_path):
+        """Return the tiles to analyze separately, or None to send the image whole"""
+        settings = tiling_settings(current_app.config)
+        if settings is None:
+            return None
+        
+        try:
+            tiles = run_blocking(preprocess_tiles, image_path, **settings)
+        except Exception as e:
+            raise Exception(f"Error analyzing image: {e}")
+        if hasattr(image_path, 'seek'):
+            image_path.seek(0)
+        return tiles
+    
+    @staticmethod
+    def _thumbnail(image_path, max_size):
+        """Legacy preparation: the decoded image, resized to reduce processing time"""
+        img = Image.open(image_path)
+        if max(img.size) > max_size:
+            img.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+        return img
+    
+    def estimated_request_tokens(self):
+        """Rough input+output token cost of one analysis, for the TPM budget"""
+        # Prompt tokens (measured when known), 258 tokens per image, typical short answer
+        return self.prompt.estimated_tokens + 258 + 512
+    
+    def _analysis_fingerprint(self):
+        return self.analysis_fingerprint(
+            self.model_name, self.prompt.fingerprint, self._preprocessing_fingerprint(), self.backend.name,
+            self.backend.output_format
+        )
+    
+    def _lookup(self, filepath, use_cache, digest):
+        """Return (digest, cache key, cached result)
+
+        The key is None when neither the cache nor single-flight coalescing
+        needs it. In NEAR_DUPLICATE_MODE=reuse a miss is answered with the
+        result of a near-identical earlier image when there is one.
+        """
+        cache = get_result_cache()
+        if cache is None and get_single_flight() is None:
+            return digest, None, None
+        
+        if digest is None:
+            with timed('analyze.hash'):
+                digest = hash_file(filepath)
+        cache_key = make_cache_key(digest, self._analysis_fingerprint())
+        if not use_cache or cache is None:
+            return digest, cache_key, None
+        
+        with timed('analyze.cache_lookup'):
+            content = cache.get(cache_key)
+        count('image_analyzer_cache_lookups_total', result='miss' if content is None else 'hit')
+        if content is not None:
+            return digest, cache_key, self._result(content, True)
+        
+        if current_app.config['NEAR_DUPLICATE_MODE'] == 'reuse':
+            match = self.find_near_duplicate(filepath, digest)
+            if match is not None:
+                count('image_analyzer_cache_lookups_total', result='near_duplicate')
+                return digest, cache_key, self._result(
+                    match['content'], True, near_duplicate={'distance': match['distance']}
+                )
+        return digest, cache_key, None
+    
+    def _store(self, filepath, digest, cache_key, content):
+        """Cache a fresh result and index the image so near duplicates can find it"""
+        cache = get_result_cache()
+        if cache is None:
+            return
+        cache.set(cache_key, content)
+        if get_perceptual_index() is not None:
+            self._perceptual_hash(filepath, digest)
+    
+    def find_near_duplicate(self, filepath, digest):
+        """The closest earlier image within NEAR_DUPLICATE_THRESHOLD that has a cached result
+
+        Returns {'distance': bits, 'content': result} or None. The image is
+        hashed and added to the index on the way if it was not already.
+        """
+        index = get_perceptual_index()
+        cache = get_result_cache()
+        if index is None or cache is None:
+            return None
+        
+        phash = self._perceptual_hash(filepath, digest)
+        if phash is None:
+            return None
+        
+        analysis = self._analysis_fingerprint()
+        with timed('analyze.near_duplicate_lookup'):
+            for distance, other in index.nearest(phash, exclude=digest):
+                content = cache.get(make_cache_key(other, analysis))
+                if content is not None:
+                    return {'distance': distance, 'content': content}
+        return None
+    
+    @staticmethod
+    def _perceptual_hash(filepath, digest):
+        """The image's perceptual hash from the index, computing and storing it if new"""
+        index = get_perceptual_index()
+        phash = index.get(digest)
+        if phash is not None:
+            return phash
+        
+        try:
+            with timed('analyze.phash'):
+                if hasattr(filepath, 'seek'):
+                    filepath.seek(0)
+                phash = run_blocking(dhash, filepath)
+        except Exception as e:
+            print(f"Could not compute perceptual hash: {e}")
+            return None
+        finally:
+            if hasattr(filepath, 'seek'):
+                filepath.seek(0)
+        index.add(digest, phash)
+        return phash
+    
+    @staticmethod
+    def _join_flight(cache_key):
+        """Lead the analysis for cache_key, or wait for an identical one already running
+
+        Returns a Flight; a follower's flight carries the leader's answer.
+        """
+        flights = get_single_flight()
+        if flights is None or cache_key is None:
+            return Flight.solo()
+        started = time.perf_counter()
+        flight = flights.join(cache_key)
+        if not flight.leader:
+            record_stage('analyze.coalesced_wait', time.perf_counter() - started)
+        return flight
+    
+    def _answer(self, filepath, digest, cache_key, content, served):
+        """The outcome of a fresh analysis: its text and the key/model routes that produced it
+
+        The answer is cached unless a fallback model gave it, since the cache
+        key names the primary model.
+        """
+        if all(route.tier == 0 for route in served):
+            self._store(filepath, digest, cache_key, content)
+        return {'content': content, 'served_by': [route.served_by for route in dict.fromkeys(served)]}
+    
+    def analyze_file(self, filepath, use_cache=True, progress=None, digest=None, lane='interactive', client=None):
+        """Main method to analyze image file
+
+        filepath may also be a binary file object (e.g. an in-memory upload);
+        pass its SHA-256 as digest when already known to skip re-hashing.
+        With use_cache=False the cached result is ignored but still refreshed.
+        progress, if given, is called with each stage name as the analysis advances.
+        Concurrent analyses of the same image share one model call (single-flight),
+        unless use_cache is False: a bypass always makes its own call.
+        Fresh results carry served_by, the API key (by pool position) and model used.
+        The model call waits for a slot in the admission lane ('interactive' or
+        'batch') on behalf of client, and raises AdmissionRejected if it would wait too long.
+        """
+        digest, cache_key, cached = self._lookup(filepath, use_cache, digest)
+        if cached is not None:
+            return cached
+        
+        with self._join_flight(cache_key if use_cache else None) as flight:
+            if flight.leader:
+                if hasattr(filepath, 'seek'):
+                    filepath.seek(0)
+                served = []
+                with admission_slot(lane, client):
+                    content = self.analyze_image(filepath, progress=progress, served=served)
+                flight.value = self._answer(filepath, digest, cache_key, content, served)
+        
+        answer = flight.value
+        if not flight.leader:
+            return self._result(answer['content'], False, served_by=answer['served_by'], coalesced=True)
+        return self._result(answer['content'], False, served_by=answer['served_by'])
+    
+    def analyze_file_stream(self, filepath, use_cache=True, digest=None, lane='interactive', client=None):
+        """Streaming analyze_file: yields {'type': 'delta', 'text'} events, then {'type': 'done', 'result'}
+
+        A cached answer, or one shared with an identical analysis already in
+        flight, arrives as a single delta. The complete answer is cached once
+        the model has finished.
+        """
+        digest, cache_key, cached = self._lookup(filepath, use_cache, digest)
+        if cached is not None:
+            yield {'type': 'delta', 'text': cached['content']}
+            yield {'type': 'done', 'result': cached}
+            return
+        
+        with self._join_flight(cache_key if use_cache else None) as flight:
+            if flight.leader:
+                if hasattr(filepath, 'seek'):
+                    filepath.seek(0)
+                pieces, served = [], []
+                with admission_slot(lane, client):
+                    for text in self.analyze_image_stream(filepath, served=served):
+                        pieces.append(text)
+                        yield {'type': 'delta', 'text': text}
+                # A structured answer arrives as one piece; keep it whole so its fields come along
+                content = pieces[0] if len(pieces) == 1 else ''.join(pieces)
+                flight.value = self._answer(filepath, digest, cache_key, content, served)
+        
+        answer = flight.value
+        if not flight.leader:
+            yield {'type': 'delta', 'text': answer['content']}
+            yield {'type': 'done', 'result': self._result(
+                answer['content'], False, served_by=answer['served_by'], coalesced=True
+            )}
+            return
+        yield {'type': 'done', 'result': self._result(answer['content'], False, served_by=answer['served_by'])}
+
+
+def classify_error(error):
+    """Map an analysis exception to a user-facing message and HTTP status code"""
+    if isinstance(error, AdmissionRejected):
+        return str(error), error.status_code
+    if isinstance(error, TimeoutError):
+        return 'Analysis timed out. Please try again with a smaller or clearer image.', 504
+    
+    error_msg = str(error)
+    if 'quota' in error_msg.lower() or '429' in error_msg:
+        return 'API quota exceeded. Please try again later.', 429
+    elif 'timeout' in error_msg.lower() or 'deadline' in error_msg.lower():
+        return 'Analysis timed out. Please try again.', 504
+    else:
+        return f'Analysis failed: {error_msg}', 500
+
+
+class GeminiServiceRegistry:
+    """Per-worker registry owning one configured GeminiService per key/model/prompt/backend/config
+
+    Services are built lazily and shared by every request thread in the worker,
+    so the SDK client (and its connection) is reused between analyses. When
+    env_file changes on disk (checked at most every check_interval seconds),
+    its Gemini settings are loaded into the app config on the next lookup.
+    """
+    
+    # Settings a changed env file can swap without a restart
+    RELOADABLE = ('GEMINI_API_KEY', 'GEMINI_MODEL', 'PROMPT_VARIANT')
+    RELOADABLE_LISTS = ('GEMINI_API_KEYS', 'GEMINI_FALLBACK_MODELS')
+    
+    def __init__(self, env_file=None, check_interval=0):
+        self._services = {}
+        self._lock = threading.Lock()
+        self._configured_key = None
+        self._pid = os.getpid()
+        self._env_file = env_file
+        self._check_interval = check_interval
+        self._env_mtime = self._read_mtime()
+        self._next_check = 0.0
+    
+    def get(self, api_key, model_name, prompt=None, backend=None):
+        """Return the shared service for this API key, model, prompt and backend, creating it once"""
+        prompt = prompt or get_active_prompt()
+        config = current_app.config
+        backend = backend or config['MODEL_BACKEND']
+        key = (api_key, model_name, prompt.fingerprint, backend, _GENERATION_CONFIG_FINGERPRINT,
+               tuple(config['GEMINI_API_KEYS']), tuple(config['GEMINI_FALLBACK_MODELS']))
+        service = self._services.get(key)
+        if service is not None and self._pid == os.getpid():
+            return service
+        
+        with self._lock:
+            # Connections opened before a fork must not be shared with the parent
+            if self._pid != os.getpid():
+                self._reset()
+            
+            service = self._services.get(key)
+            if service is None:
+                # genai.configure swaps a process-wide client, so a new key retires the old services
+                if api_key != self._configured_key:
+                    self._services.clear()
+                service = GeminiService(api_key=api_key, model_name=model_name, prompt=prompt, backend=backend)
+                self._configured_key = api_key
+                self._services[key] = service
+        return service
+    
+    def _read_mtime(self):
+        try:
+            return os.stat(self._env_file).st_mtime_ns
+        except (OSError, TypeError):
+            return None
+    
+    def check_env_file(self, app):
+        """Reload if the env file changed since it was last read; returns True when it did"""
+        if not self._env_file or not self._check_interval:
+            return False
+        now = time.monotonic()
+        if now < self._next_check:
+            return False
+        self._next_check = now + self._check_interval
+        mtime = self._read_mtime()
+        if mtime == self._env_mtime:
+            return False
+        self._env_mtime = mtime
+        self.reload(app)
+        return True
+    
+    def reload(self, app):
+        """Load the Gemini settings from the env file, then register rate limiters and drop services in one step
+
+        Requests already holding a service finish with it; the next lookup
+        builds one for the new settings, whose key/model routes already have
+        their limiters.
+        """
+        values = dotenv_values(self._env_file) if self._env_file and os.path.exists(self._env_file) else {}
+        with self._lock:
+            for name in self.RELOADABLE_LISTS:
+                if name in values:
+                    app.config[name] = [item.strip() for item in (values[name] or '').split(',') if item.strip()]
+            for name in self.RELOADABLE:
+                if values.get(name):
+                    app.config[name] = values[name]
+            register_rate_limiters(app)
+            self._reset()
+        count('image_analyzer_config_reloads_total')
+        print(f"Reloaded Gemini settings from {self._env_file}")
+    
+    def _reset(self):
+        self._services.clear()
+        self._configured_key = None
+        self._pid = os.getpid()
+    
+    def __len__(self):
+        return len(self._services)
+
+
+def init_gemini_services(app):
+    """Attach an empty service registry to the app, watching ENV_FILE for Gemini settings"""
+    app.extensions['gemini_services'] = GeminiServiceRegistry(
+        env_file=app.config['ENV_FILE'],
+        check_interval=app.config['CONFIG_RELOAD_INTERVAL'],
+    )
+
+
+def warm_gemini_service(app):
+    """Build the process's shared GeminiService, SDK clients included, ahead of its first request"""
+    with app.app_context():
+        get_gemini_service()
+
+
+def get_gemini_service():
+    """Return the shared GeminiService for the current app config
+
+    The lookup key follows the live config, so changing GEMINI_API_KEY,
+    GEMINI_MODEL or PROMPT_VARIANT on the app, or in ENV_FILE, hot-swaps the
+    client on the next request.
+    """
+    registry = current_app.extensions.get('gemini_services')
+    if registry is None:
+        registry = current_app.extensions.setdefault('gemini_services', GeminiServiceRegistry())
+    registry.check_env_file(current_app._get_current_object())
+    return registry.get(current_app.config['GEMINI_API_KEY'], current_app.config['GEMINI_MODEL'])
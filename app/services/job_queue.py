@@ -0,0 +1,300 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from app.utils.sqlite import SQLiteConnections
+
+# Job lifecycle, in order; "failed" or "cancelled" can replace any later stage
+JOB_STAGES = ('queued', 'uploading', 'model-running', 'done')
+TERMINAL_STATUSES = ('done', 'failed', 'cancelled')
+_TERMINAL_PLACEHOLDERS = ', '.join('?' * len(TERMINAL_STATUSES))
+
+
+class JobStore:
+    """SQLite-backed job table visible to every gunicorn worker on the host
+
+    Besides queued jobs it keeps the results of analyses answered in the
+    request itself, so export sees every finished analysis. A speculative job
+    is left out of export until a request claims it.
+    """
+
+    def __init__(self, path):
+        self._connections = SQLiteConnections(path)
+        with self._connections.get() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                ' id TEXT PRIMARY KEY,'
+                ' filename TEXT NOT NULL,'
+                ' status TEXT NOT NULL,'
+                ' result TEXT,'
+                ' error TEXT,'
+                ' error_status INTEGER,'
+                ' created_at REAL NOT NULL,'
+                ' updated_at REAL NOT NULL,'
+                ' speculative INTEGER NOT NULL DEFAULT 0)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS jobs_updated ON jobs (updated_at)')
+        # Tables created before the speculative column; another worker may add it first
+        columns = {row[1] for row in self._connections.get().execute('PRAGMA table_info(jobs)')}
+        if 'speculative' not in columns:
+            try:
+                with self._connections.get() as conn:
+                    conn.execute('ALTER TABLE jobs ADD COLUMN speculative INTEGER NOT NULL DEFAULT 0')
+            except sqlite3.OperationalError as e:
+                if 'duplicate column' not in str(e):
+                    raise
+
+    def create(self, filename, speculative=False):
+        """Insert a queued job and return its ID"""
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._connections.get() as conn:
+            conn.execute(
+                'INSERT INTO jobs (id, filename, status, created_at, updated_at, speculative) VALUES (?, ?, ?, ?, ?, ?)',
+                (job_id, filename, 'queued', now, now, int(speculative))
+            )
+        return job_id
+
+    def record(self, filename, result):
+        """Insert the result of an analysis that ran outside the queue as a done job; returns its ID"""
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._connections.get() as conn:
+            conn.execute(
+                'INSERT INTO jobs (id, filename, status, result, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)',
+                (job_id, filename, 'done', json.dumps(result), now, now)
+            )
+        return job_id
+
+    def claim(self, job_id):
+        """Mark a speculative job as asked for, so it is exported like any other"""
+        with self._connections.get() as conn:
+            conn.execute('UPDATE jobs SET speculative = 0 WHERE id = ?', (job_id,))
+
+    def update(self, job_id, status, result=None, error=None, error_status=None):
+        """Move a job to status; a done, failed or cancelled job keeps its status"""
+        with self._connections.get() as conn:
+            conn.execute(
+                'UPDATE jobs SET status = ?, result = ?, error = ?, error_status = ?, updated_at = ?'
+                f' WHERE id = ? AND status NOT IN ({_TERMINAL_PLACEHOLDERS})',
+                (status, json.dumps(result) if result is not None else None, error, error_status, time.time(), job_id,
+                 *TERMINAL_STATUSES)
+            )
+
+    def touch(self, job_ids):
+        """Refresh updated_at of the unfinished jobs among job_ids, so they are not taken for stale"""
+        job_ids = list(job_ids)
+        now = time.time()
+        with self._connections.get() as conn:
+            for start in range(0, len(job_ids), 500):
+                chunk = job_ids[start:start + 500]
+                conn.execute(
+                    f"UPDATE jobs SET updated_at = ? WHERE id IN ({', '.join('?' * len(chunk))})"
+                    f' AND status NOT IN ({_TERMINAL_PLACEHOLDERS})',
+                    (now, *chunk, *TERMINAL_STATUSES)
+                )
+
+    def cancel(self, job_id):
+        """Cancel a job, dropping its result if it has one; returns the status it had, or None"""
+        with self._connections.get() as conn:
+            row = conn.execute('SELECT status FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            if row is None or row[0] == 'cancelled':
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = 'cancelled', result = NULL, updated_at = ? WHERE id = ?",
+                (time.time(), job_id)
+            )
+        return row[0]
+
+    def get(self, job_id):
+        """Return the job as a dict, or None if it does not exist"""
+        row = self._connections.get().execute(
+            'SELECT id, filename, status, result, error, error_status, created_at, updated_at FROM jobs WHERE id = ?',
+            (job_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return {
+            'job_id': row[0],
+            'filename': row[1],
+            'status': row[2],
+            'result': json.loads(row[3]) if row[3] else None,
+            'error': row[4],
+            'error_status': row[5],
+            'created_at': row[6],
+            'updated_at': row[7],
+        }
+
+    def finished(self, since=0, limit=1000):
+        """Yield done jobs finished after since, oldest first, as {job_id, filename, finished_at, result}
+
+        Speculative jobs nobody claimed are skipped.
+        """
+        rows = self._connections.get().execute(
+            "SELECT id, filename, updated_at, result FROM jobs WHERE status = 'done' AND speculative = 0"
+            " AND updated_at > ? ORDER BY updated_at LIMIT ?",
+            (since, limit)
+        )
+        for job_id, filename, updated_at, result in rows:
+            yield {'job_id': job_id, 'filename': filename, 'finished_at': updated_at, 'result': json.loads(result)}
+
+    def purge(self, older_than):
+        """Delete finished jobs last updated before the given timestamp"""
+        with self._connections.get() as conn:
+            conn.execute(
+                "DELETE FROM jobs WHERE status IN ('done', 'failed', 'cancelled') AND updated_at < ?",
+                (older_than,)
+            )
+
+
+class JobQueue:
+    """Runs analyses on a bounded thread pool and records progress in a JobStore
+
+    Each worker touches the jobs it holds (queued or running) every third of
+    stale_after, so only a job whose worker stopped, not one waiting its turn
+    behind the pool or an admission slot, is failed as stale.
+    """
+
+    def __init__(self, app, store, max_workers=4, stale_after=300, retention=86400):
+        self.app = app
+        self.store = store
+        self.max_workers = max_workers
+        self.stale_after = stale_after
+        self.retention = retention
+        self._executor = None
+        self._pid = None
+        self._futures = {}  # job ID -> future, for jobs this worker has not finished
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        """Create the pool lazily so each forked worker gets its own threads"""
+        if self._executor is None or self._pid != os.getpid():
+            with self._lock:
+                if self._executor is None or self._pid != os.getpid():
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.max_workers,
+                        thread_name_prefix='analysis'
+                    )
+                    self._futures = {}
+                    self._pid = os.getpid()
+                    threading.Thread(target=self._heartbeat_loop, name='job-heartbeat', daemon=True).start()
+        return self._executor
+
+    def _heartbeat_loop(self):
+        pid = os.getpid()
+        while self._pid == pid:
+            time.sleep(self.stale_after / 3)
+            with self._lock:
+                job_ids = list(self._futures)
+            if not job_ids:
+                continue
+            try:
+                self.store.touch(job_ids)
+            except Exception as e:
+                print(f"Job heartbeat failed: {e}")
+
+    def submit(self, filepath, filename, use_cache=True, lane='interactive', client=None, speculative=False):
+        """Queue an analysis in an admission lane and return the new job ID"""
+        job_id = self.store.create(filename, speculative=speculative)
+        future = self._get_executor().submit(self._run, job_id, filepath, use_cache, lane, client)
+        with self._lock:
+            self._futures[job_id] = future
+        future.add_done_callback(lambda _: self._forget(job_id))
+        self.store.purge(time.time() - self.retention)
+        return job_id
+
+    def record(self, filename, result):
+        """Keep the result of an analysis answered in its request, for export; returns its job ID"""
+        job_id = self.store.record(filename, result)
+        self.store.purge(time.time() - self.retention)
+        return job_id
+
+    def _forget(self, job_id):
+        with self._lock:
+            self._futures.pop(job_id, None)
+
+    def cancel(self, job_id):
+        """Cancel a job from any worker; returns the status it had, or None
+
+        A job still queued in this worker never starts; one queued in another
+        worker is skipped when it comes up. A model call already running is
+        not interrupted, but its result is dropped, as is a finished job's.
+        """
+        with self._lock:
+            future = self._futures.get(job_id)
+        if future is not None:
+            future.cancel()
+        return self.store.cancel(job_id)
+
+    def wait(self, job_id, poll_interval=0.5):
+        """Block until a job is done, failed or cancelled and return it (None if it does not exist)
+
+        A job of this worker is awaited on its future; another worker's is
+        polled in the store, where a job whose worker stopped goes stale.
+        """
+        with self._lock:
+            future = self._futures.get(job_id)
+        if future is not None:
+            try:
+                future.result()
+            except Exception:
+                pass  # _run reports failures through the store; a cancelled future is cancelled there too
+        while True:
+            job = self.get(job_id)
+            if job is None or job['status'] in TERMINAL_STATUSES:
+                return job
+            time.sleep(poll_interval)
+
+    def get(self, job_id):
+        """Return job status, failing jobs whose worker stopped reporting"""
+        job = self.store.get(job_id)
+        if job and job['status'] not in TERMINAL_STATUSES and time.time() - job['updated_at'] > self.stale_after:
+            self.store.update(job_id, 'failed', error='Analysis worker stopped responding. Please try again.', error_status=504)
+            job = self.store.get(job_id)
+        return job
+
+    def _run(self, job_id, filepath, use_cache, lane, client):
+        from app.services.gemini_service import get_gemini_service, classify_error
+
+        with self.app.app_context():
+            job = self.store.get(job_id)
+            # Cancelled, or already failed as stale: a result now would contradict what clients were told
+            if job is None or job['status'] in TERMINAL_STATUSES:
+                return
+            try:
+                result = get_gemini_service().analyze_file(
+                    filepath,
+                    use_cache=use_cache,
+                    progress=lambda stage: self.store.update(job_id, stage),
+                    lane=lane,
+                    client=client
+                )
+                if not result or 'content' not in result:
+                    self.store.update(job_id, 'failed', error='No content extracted from image', error_status=500)
+                    return
+                self.store.update(job_id, 'done', result=result)
+            except Exception as e:
+                traceback.print_exc()
+                message, status_code = classify_error(e)
+                self.store.update(job_id, 'failed', error=message, error_status=status_code)
+
+
+def init_job_queue(app):
+    """Attach the analysis job queue to the app"""
+    store = JobStore(app.config['JOB_STORE_PATH'])
+    app.extensions['job_queue'] = JobQueue(
+        app,
+        store,
+        max_workers=app.config['ANALYSIS_WORKERS'],
+        stale_after=app.config['JOB_STALE_AFTER'],
+        retention=app.config['JOB_RETENTION'],
+    )
+
+
+def get_job_queue():
+    return current_app.extensions['job_queue']
@@ -0,0 +1,275 @@
+import atexit
+import os
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from flask import current_app, g, has_app_context, has_request_context, request
+from app.utils.sqlite import SQLiteConnections
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# Metric families: name -> (type, help, label names)
+METRICS = {
+    'image_analyzer_request_seconds': (
+        'histogram', 'HTTP request handling time (to the first byte for streamed responses)',
+        ('endpoint', 'method', 'status')),
+    'image_analyzer_stage_seconds': (
+        'histogram', 'Time spent in each stage of uploading and analyzing an image', ('stage',)),
+    'image_analyzer_model_calls_total': (
+        'counter', 'Model calls by outcome', ('outcome',)),
+    'image_analyzer_model_retries_total': (
+        'counter', 'Model calls retried after an error, by reason', ('reason',)),
+    'image_analyzer_quota_errors_total': (
+        'counter', 'Quota (429) errors returned by the model', ()),
+    'image_analyzer_cache_lookups_total': (
+        'counter', 'Result cache lookups by result (hit, miss, or near_duplicate for a miss answered from a re-scan)',
+        ('result',)),
+    'image_analyzer_route_calls_total': (
+        'counter', 'Model calls by API key (pool position), model and outcome', ('key', 'model', 'outcome')),
+    'image_analyzer_circuit_opens_total': (
+        'counter', 'Times a key/model was set aside by the router, by reason (quota or slow)',
+        ('key', 'model', 'reason')),
+    'image_analyzer_coalesced_calls_total': (
+        'counter', 'Analyses answered by an identical one already in flight (model calls saved), by scope',
+        ('scope',)),
+    'image_analyzer_admissions_total': (
+        'counter', 'Analyses admitted to or rejected from a model slot, by lane and outcome',
+        ('lane', 'outcome')),
+    'image_analyzer_speculations_total': (
+        'counter', 'Analyses started at upload time, by outcome (started, skipped, hit, joined, failed, '
+        'cancelled, discarded or expired)', ('outcome',)),
+    'image_analyzer_config_reloads_total': (
+        'counter', 'Gemini settings reloaded from a changed ENV_FILE', ()),
+}
+
+_LE = re.compile(r'le="([^"]+)"')
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, labels):
+    return ','.join(f'{name}="{_escape(labels.get(name, ""))}"' for name in names)
+
+
+def _sample_order(sample):
+    """Sort by label set, then histogram buckets by numeric bound"""
+    le = _LE.search(sample[0])
+    return (_LE.sub('', sample[0]), float(le.group(1)) if le else 0.0)
+
+
+def _format_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(value)
+
+
+class Metrics:
+    """Counters and histograms shared by all gunicorn workers via SQLite
+
+    Each worker keeps cumulative totals in memory and flushes the ones that
+    changed every flush_interval seconds, as rows owned by that process.
+    /metrics sums the rows of every process, so the exposition covers the
+    whole server. Rows of workers that have exited are folded into one
+    "retired" row set, so counters never go backwards.
+    """
+
+    def __init__(self, path, flush_interval=5.0):
+        self.flush_interval = flush_interval
+        self._connections = SQLiteConnections(path)
+        self._lock = threading.Lock()
+        self._values = {}
+        self._dirty = set()
+        self._pid = None
+        self._process = None
+        with self._connections.get() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS samples ('
+                ' process TEXT NOT NULL,'
+                ' name TEXT NOT NULL,'
+                ' labels TEXT NOT NULL,'
+                ' value REAL NOT NULL,'
+                ' PRIMARY KEY (process, name, labels))'
+            )
+
+    def _ensure_process(self):
+        """Start fresh totals and a flusher in each forked worker"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._process = f'{self._pid}-{uuid.uuid4().hex[:8]}'
+            self._values = {}
+            self._dirty = set()
+        self._fold_dead_processes()
+        threading.Thread(target=self._flush_loop, name='metrics-flush', daemon=True).start()
+        atexit.register(self.flush)
+
+    def _add(self, name, labels, amount):
+        key = (name, labels)
+        self._values[key] = self._values.get(key, 0) + amount
+        self._dirty.add(key)
+
+    def inc(self, name, amount=1, **labels):
+        """Increment a counter"""
+        self._ensure_process()
+        label_str = _format_labels(METRICS[name][2], labels)
+        with self._lock:
+            self._add(name, label_str, amount)
+
+    def observe(self, name, value, **labels):
+        """Record one observation in a histogram"""
+        self._ensure_process()
+        label_str = _format_labels(METRICS[name][2], labels)
+        prefix = f'{label_str},' if label_str else ''
+        with self._lock:
+            for bound in LATENCY_BUCKETS:
+                if value <= bound:
+                    self._add(f'{name}_bucket', f'{prefix}le="{bound}"', 1)
+            self._add(f'{name}_bucket', f'{prefix}le="+Inf"', 1)
+            self._add(f'{name}_sum', label_str, value)
+            self._add(f'{name}_count', label_str, 1)
+
+    def flush(self):
+        """Write this worker's changed totals to the shared database"""
+        with self._lock:
+            if not self._dirty:
+                return
+            rows = [(self._process, name, labels, self._values[(name, labels)]) for name, labels in self._dirty]
+            self._dirty = set()
+        with self._connections.get() as conn:
+            conn.executemany(
+                'INSERT INTO samples (process, name, labels, value) VALUES (?, ?, ?, ?)'
+                ' ON CONFLICT (process, name, labels) DO UPDATE SET value = excluded.value',
+                rows
+            )
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Metrics flush failed: {e}")
+
+    def _fold_dead_processes(self):
+        """Merge the rows of exited workers into the "retired" process"""
+        conn = self._connections.get()
+        dead = []
+        for (process,) in conn.execute("SELECT DISTINCT process FROM samples WHERE process != 'retired'"):
+            try:
+                os.kill(int(process.split('-')[0]), 0)
+            except ProcessLookupError:
+                dead.append(process)
+            except (OSError, ValueError):
+                continue
+        if not dead:
+            return
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for process in dead:
+                conn.execute(
+                    "INSERT INTO samples (process, name, labels, value)"
+                    " SELECT 'retired', name, labels, value FROM samples WHERE process = ? AND true"
+                    " ON CONFLICT (process, name, labels) DO UPDATE SET value = value + excluded.value",
+                    (process,)
+                )
+                conn.execute('DELETE FROM samples WHERE process = ?', (process,))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        self._ensure_process()
+        self.flush()
+        rows = self._connections.get().execute(
+            'SELECT name, labels, SUM(value) FROM samples GROUP BY name, labels'
+        ).fetchall()
+
+        samples = {}
+        for name, labels, value in rows:
+            samples.setdefault(name, []).append((labels, value))
+
+        lines = []
+        for family, (kind, help_text, _) in METRICS.items():
+            lines.append(f'# HELP {family} {help_text}')
+            lines.append(f'# TYPE {family} {kind}')
+            suffixes = ('_bucket', '_sum', '_count') if kind == 'histogram' else ('',)
+            for suffix in suffixes:
+                for labels, value in sorted(samples.get(family + suffix, ()), key=_sample_order):
+                    label_part = '{' + labels + '}' if labels else ''
+                    lines.append(f'{family}{suffix}{label_part} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+def get_metrics():
+    """The app's Metrics, or None when disabled or outside an app context"""
+    if not has_app_context():
+        return None
+    return current_app.extensions.get('metrics')
+
+
+def count(name, amount=1, **labels):
+    """Increment a counter if metrics are enabled"""
+    metrics = get_metrics()
+    if metrics is not None:
+        metrics.inc(name, amount, **labels)
+
+
+def record_stage(stage, seconds):
+    """Record a stage duration in the histogram and the request's Server-Timing"""
+    metrics = get_metrics()
+    if metrics is not None:
+        metrics.observe('image_analyzer_stage_seconds', seconds, stage=stage)
+    if has_request_context():
+        timings = g.setdefault('server_timing', {})
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def timed(stage):
+    """Time the enclosed block as one stage (exceptions still record the time spent)"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - started)
+
+
+def _start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+def _finish_request_timer(response):
+    started = g.pop('request_started', None)
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+
+    metrics = get_metrics()
+    if metrics is not None and request.endpoint != 'main.metrics':
+        metrics.observe('image_analyzer_request_seconds', elapsed,
+                        endpoint=request.endpoint or 'unmatched', method=request.method,
+                        status=response.status_code)
+
+    if current_app.config['SERVER_TIMING']:
+        entries = [f'{stage};dur={seconds * 1000:.1f}' for stage, seconds in g.get('server_timing', {}).items()]
+        entries.append(f'total;dur={elapsed * 1000:.1f}')
+        response.headers['Server-Timing'] = ', '.join(entries)
+    return response
+
+
+def init_metrics(app):
+    """Attach the shared metrics store and time every request"""
+    if not app.config['METRICS_ENABLED']:
+        app.extensions['metrics'] = None
+    else:
+        app.extensions['metrics'] = Metrics(app.config['METRICS_PATH'], app.config['METRICS_FLUSH_INTERVAL'])
+    app.before_request(_start_request_timer)
+    app.after_request(_finish_request_timer)
@@ -0,0 +1,327 @@
+import hashlib
+import inspect
+import json
+import math
+import random
+import threading
+import time
+from datetime import timedelta
+from app.services.prompt_service import supports_context_cache, supports_system_instruction
+from app.utils.result_parser import RESPONSE_SCHEMA, parse_fields
+
+# Answers the fake backend picks from when no FAKE_MODEL_OUTPUTS file is given
+DEFAULT_FAKE_OUTPUTS = (
+    "- **Name:** K. Ramesh\n- **Date of Birth:** 14/08/1987\n- **Mobile:** 9876543210\n- **PIN Code:** 400001",
+    "- **Account Holder:** Smt. Lakshmi Devi\n- **Account No.:** 30012345678\n- **IFSC:** SBIN0001234\n"
+    "- **Amount:** ₹1,25,000 (Rupees One Lakh Twenty Five Thousand Only)",
+    "- **Invoice No.:** INV-2024-0173\n- **Date:** 05/01/2024\n- **Total:** ~~4,500~~ corrected to 4,850",
+)
+
+
+class ModelBackend:
+    """What GeminiService needs from a model: one image in, the answer text out"""
+
+    name = None
+    # How the prompt reaches the model: inline, system-instruction or context-cache
+    prompt_mode = 'inline'
+    # What the answer text is: markdown bullets, or json (a list of fields, see RESPONSE_SCHEMA)
+    output_format = 'markdown'
+
+    def generate(self, image_part):
+        """Return the response text for one prepared image (empty if the model said nothing)"""
+        raise NotImplementedError
+
+    def generate_stream(self, image_part):
+        """Yield the response text in pieces as the model produces them"""
+        text = self.generate(image_part)
+        if text:
+            yield text
+
+    def count_tokens(self, content):
+        """Number of input tokens content would cost"""
+        raise NotImplementedError
+
+
+def supports_response_schema():
+    """True when the installed SDK can ask the model for JSON matching a schema"""
+    import google.generativeai as genai
+    
+    try:
+        return 'response_schema' in inspect.signature(genai.types.GenerationConfig).parameters
+    except (TypeError, ValueError):
+        return False
+
+
+class GeminiBackend(ModelBackend):
+    """The Gemini API through google-generativeai
+
+    The analysis prompt is compiled into the model once: as a system
+    instruction where the SDK supports it (optionally backed by a context
+    cache, so the prefix is not re-billed per call), otherwise as a fixed
+    first content part. With structured_output the model answers in JSON
+    following RESPONSE_SCHEMA, where the SDK supports it.
+
+    The SDK's process-wide client belongs to the primary API key; a backend
+    for another key of the pool (primary=False) gets a client of its own and
+    does not use context caching, which needs the process-wide client.
+    """
+
+    name = 'gemini'
+
+    def __init__(self, api_key, model_name, prompt, generation_config, context_cache_ttl=0,
+                 structured_output=False, primary=True):
+        self.api_key = api_key
+        self.primary = primary
+        self.model_name = model_name
+        self.prompt = prompt
+        self.generation_config = generation_config
+        if structured_output:
+            if supports_response_schema():
+                self.generation_config = {
+                    **generation_config,
+                    'response_mime_type': 'application/json',
+                    'response_schema': RESPONSE_SCHEMA,
+                }
+                self.output_format = 'json'
+            else:
+                print("Structured output needs a newer google-generativeai; parsing markdown answers instead")
+        self.model = None
+        self._context_cache_ttl = context_cache_ttl
+        self._context_cache_expires = 0
+        self._lock = threading.Lock()
+        self._configure()
+
+    def _configure(self):
+        """Configure Gemini API"""
+        import google.generativeai as genai
+        
+        if self.primary:
+            genai.configure(api_key=self.api_key)
+
+        if self.primary and self._context_cache_ttl and supports_context_cache():
+            try:
+                self._create_context_cache()
+                return
+            except Exception as e:
+                # Models and prompts below the caching minimum are refused; fall back
+                print(f"Context cache unavailable, sending prompt as system instruction: {e}")
+
+        if supports_system_instruction():
+            self.model = genai.GenerativeModel(
+                self.model_name,
+                generation_config=self.generation_config,
+                system_instruction=self.prompt.text
+            )
+            self.prompt_mode = 'system-instruction'
+        else:
+            self.model = genai.GenerativeModel(
+                self.model_name,
+                generation_config=self.generation_config
+            )
+            self.prompt_mode = 'inline'
+        self._bind_client()
+
+    def _bind_client(self):
+        """Create the SDK client now rather than on first use
+
+        The SDK binds a model to the process-wide default client lazily and
+        without a lock; doing it here, while the registry lock is held, stops
+        concurrent first requests from each opening a channel.
+        """
+        from google.generativeai import client as genai_client
+        
+        if getattr(self.model, '_client', False) is None:
+            if self.primary:
+                self.model._client = genai_client.get_default_generative_client()
+            else:
+                manager = genai_client._ClientManager()
+                manager.configure(api_key=self.api_key)
+                self.model._client = manager.get_default_client('generative')
+
+    def _create_context_cache(self):
+        """Upload the prompt as cached content and bind a model to it"""
+        import google.generativeai as genai
+        
+        cached = genai.caching.CachedContent.create(
+            model=self.model_name,
+            display_name=f'prompt-{self.prompt.id}-{self.prompt.fingerprint}',
+            system_instruction=self.prompt.text,
+            ttl=timedelta(seconds=self._context_cache_ttl)
+        )
+        self.model = genai.GenerativeModel.from_cached_content(
+            cached,
+            generation_config=self.generation_config
+        )
+        # Renew a minute early so no request races the expiry
+        self._context_cache_expires = time.time() + self._context_cache_ttl - 60
+        self.prompt_mode = 'context-cache'
+        self._bind_client()
+
+    def _current_model(self):
+        """The model to call, renewing an expired context cache first"""
+        if self.prompt_mode == 'context-cache' and time.time() >= self._context_cache_expires:
+            with self._lock:
+                if time.time() >= self._context_cache_expires:
+                    self._create_context_cache()
+        return self.model
+
+    def _contents(self, image_part):
+        """Request contents: the image, preceded by the prompt unless it is compiled in"""
+        if self.prompt_mode == 'inline':
+            return [self.prompt.text, image_part]
+        return [image_part]
+
+    def generate(self, image_part):
+        # Generate content (timeout handled by server/gunicorn)
+        response = self._current_model().generate_content(self._contents(image_part))
+        return response.text if response else ''
+
+    def generate_stream(self, image_part):
+        response = self._current_model().generate_content(self._contents(image_part), stream=True)
+        for chunk in response:
+            try:
+                text = chunk.text
+            except ValueError:
+                continue  # a chunk without text, e.g. only safety ratings
+            if text:
+                yield text
+
+    def count_tokens(self, content):
+        return self._current_model().count_tokens(content).total_tokens
+
+
+class FakeBackend(ModelBackend):
+    """Deterministic local stand-in for Gemini, for benchmarks and offline runs
+
+    Latency is drawn from a lognormal distribution around latency_median
+    (sigma 0 makes it fixed). Each call fails with a 429, a deadline error or
+    an empty answer at the given rates, and otherwise returns one of the
+    canned outputs (as JSON with structured_output). Every draw is seeded by
+    the image content and how many times that image has been sent, so a run
+    replays identically and a retried image can succeed on a later attempt.
+    """
+
+    name = 'fake'
+
+    def __init__(self, model_name='fake', latency_median=1.0, latency_sigma=0.0,
+                 rate_limit_rate=0.0, deadline_rate=0.0, empty_rate=0.0, outputs=None, seed=0,
+                 structured_output=False):
+        self.model_name = model_name
+        self.latency_median = latency_median
+        self.latency_sigma = latency_sigma
+        self.rate_limit_rate = rate_limit_rate
+        self.deadline_rate = deadline_rate
+        self.empty_rate = empty_rate
+        self.outputs = tuple(outputs or DEFAULT_FAKE_OUTPUTS)
+        self.seed = seed
+        if structured_output:
+            self.output_format = 'json'
+        self.calls = 0
+        self._attempts = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _image_digest(image_part):
+        if isinstance(image_part, dict):
+            data = image_part['data']
+        else:
+            data = image_part.tobytes()  # legacy path hands over a PIL image
+        return hashlib.sha256(data).hexdigest()
+
+    def _draw(self, image_part):
+        """Decide one call: raises the injected errors, else returns (latency, text)"""
+        digest = self._image_digest(image_part)
+        with self._lock:
+            attempt = self._attempts.get(digest, 0)
+            self._attempts[digest] = attempt + 1
+            self.calls += 1
+        rng = random.Random(f'{self.seed}:{digest}:{attempt}')
+
+        latency = self.latency_median
+        if self.latency_sigma:
+            latency *= math.exp(rng.gauss(0, self.latency_sigma))
+        roll = rng.random()
+
+        if roll < self.rate_limit_rate:
+            from google.api_core import exceptions as google_exceptions
+            time.sleep(latency * 0.1)  # quota errors come back quickly
+            raise google_exceptions.ResourceExhausted('Resource has been exhausted (e.g. check quota). Please retry in 1s.')
+        roll -= self.rate_limit_rate
+        if roll < self.deadline_rate:
+            from google.api_core import exceptions as google_exceptions
+            time.sleep(latency)
+            raise google_exceptions.DeadlineExceeded('Deadline Exceeded')
+        roll -= self.deadline_rate
+
+        if roll < self.empty_rate:
+            return latency, ''
+        text = self.outputs[int(digest, 16) % len(self.outputs)]
+        if self.output_format == 'json':
+            text = json.dumps([field.as_dict() for field in parse_fields(text)], ensure_ascii=False)
+        return latency, text
+
+    def generate(self, image_part):
+        latency, text = self._draw(image_part)
+        time.sleep(latency)
+        return text
+
+    def generate_stream(self, image_part):
+        latency, text = self._draw(image_part)
+        lines = text.splitlines(keepends=True)
+        if not lines:
+            time.sleep(latency)
+            return
+        # First token after 40% of the latency, then one line at a time
+        time.sleep(latency * 0.4)
+        step = latency * 0.6 / len(lines)
+        for line in lines:
+            time.sleep(step)
+            yield line
+
+    def count_tokens(self, content):
+        if isinstance(content, str):
+            return len(content) // 4
+        return sum(self.count_tokens(part) if isinstance(part, str) else 258 for part in content)
+
+
+def load_sdk(name):
+    """Import the SDK the named backend calls, ahead of its first use
+
+    Backends import their SDK lazily, so a process that never calls the
+    model does not pay for it; a preloading Gunicorn master calls this so
+    every forked worker shares the imported modules.
+    """
+    if name == 'gemini':
+        import google.generativeai  # noqa: F401
+
+
+def create_backend(config, api_key, model_name, prompt, generation_config, name=None, primary=True):
+    """Build the backend named by MODEL_BACKEND (or name) from the app config
+
+    primary is False for API keys of the pool other than GEMINI_API_KEY.
+    """
+    name = name or config['MODEL_BACKEND']
+    if name == 'gemini':
+        return GeminiBackend(
+            api_key, model_name, prompt, generation_config,
+            context_cache_ttl=config['PROMPT_CONTEXT_CACHE_TTL'],
+            structured_output=config['STRUCTURED_OUTPUT'],
+            primary=primary
+        )
+    if name == 'fake':
+        outputs = None
+        if config['FAKE_MODEL_OUTPUTS']:
+            with open(config['FAKE_MODEL_OUTPUTS'], encoding='utf-8') as f:
+                outputs = json.load(f)
+        return FakeBackend(
+            model_name=model_name,
+            latency_median=config['FAKE_MODEL_LATENCY'],
+            latency_sigma=config['FAKE_MODEL_LATENCY_SIGMA'],
+            rate_limit_rate=config['FAKE_MODEL_429_RATE'],
+            deadline_rate=config['FAKE_MODEL_DEADLINE_RATE'],
+            empty_rate=config['FAKE_MODEL_EMPTY_RATE'],
+            outputs=outputs,
+            seed=config['FAKE_MODEL_SEED'],
+            structured_output=config['STRUCTURED_OUTPUT'],
+        )
+    raise ValueError(f"Unknown model backend: {name}")
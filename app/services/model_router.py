@@ -0,0 +1,176 @@
+import math
+import threading
+import time
+from collections import deque
+from app.services.metrics import count
+
+# Weight of the newest call in a route's latency average
+LATENCY_ALPHA = 0.3
+# Calls timed before a route may be judged slow
+MIN_LATENCY_SAMPLES = 3
+# Seconds a reading of the shared rate-limit budgets is reused for
+BUDGET_TTL = 0.1
+
+
+class Route:
+    """One API key and model the router can send calls to, with its recent health"""
+
+    def __init__(self, label, api_key, model_name, backend, tier, window=20):
+        self.label = label
+        self.api_key = api_key
+        self.model_name = model_name
+        self.backend = backend
+        self.tier = tier  # position of the model in the fallback order, 0 = primary
+        self.outcomes = deque(maxlen=window)  # True per success, False per failure
+        self.latency = None  # moving average, seconds
+        self.latency_samples = 0
+        self.in_flight = 0
+        self.calls = 0
+        self.throttled = 0  # consecutive 429s
+        self.open_until = 0.0
+        self.open_reason = None
+
+    @property
+    def served_by(self):
+        return {'key': self.label, 'model': self.model_name}
+
+    def error_rate(self):
+        if not self.outcomes:
+            return 0.0
+        return 1 - sum(self.outcomes) / len(self.outcomes)
+
+    def is_open(self, now):
+        return self.open_until > now
+
+    def __repr__(self):
+        return f'Route({self.label!r}, {self.model_name!r})'
+
+
+class ModelRouter:
+    """Spreads model calls over a pool of API keys and an ordered list of models
+
+    Calls go to the first model that has a key able to take them, and to
+    the key with the most remaining rate-limit budget there, discounted by
+    its recent error rate (ties go to the least busy key). A key that keeps
+    returning 429s has its circuit opened for breaker_cooldown seconds, or
+    the server's retry hint if longer. A key/model whose average latency
+    exceeds slow_after is set aside the same way. After the cooldown the
+    route takes calls again, and a single further 429 reopens its circuit.
+    When no key of a model can take a call, the next model is used. Health is
+    tracked per worker; budget() reads the rate limiters that all workers share,
+    at most every BUDGET_TTL seconds and never while holding the router's lock.
+    """
+
+    def __init__(self, routes, budget=None, breaker_threshold=3, breaker_cooldown=60, slow_after=0):
+        self.routes = list(routes)
+        self.primary = self.routes[0]
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.slow_after = slow_after
+        self._budget = budget or (lambda route: math.inf)
+        self._budgets = (0.0, {})  # (read until, route -> budget)
+        self._lock = threading.Lock()
+
+    def _read_budgets(self, now):
+        """Every route's remaining budget, re-read from the limiters once the last reading is BUDGET_TTL old"""
+        read_until, budgets = self._budgets
+        if now < read_until:
+            return budgets
+        budgets = {route: self._budget(route) for route in self.routes}
+        self._budgets = (now + BUDGET_TTL, budgets)
+        return budgets
+
+    def _best(self, now, budgets):
+        """The route the next call should use"""
+        closed = [route for route in self.routes if not route.is_open(now)]
+        if not closed:
+            # Every circuit is open: use the one that reopens first
+            return min(self.routes, key=lambda route: route.open_until)
+
+        for tier in sorted({route.tier for route in closed}):
+            ready = [route for route in closed if route.tier == tier and budgets[route] >= 1]
+            if ready:
+                return max(ready, key=lambda route: (
+                    min(budgets[route], 1e9) * (1 - route.error_rate()), -route.in_flight, -route.calls
+                ))
+        # No budget anywhere: queue on the least loaded route of the best model
+        top = min(route.tier for route in closed)
+        return min((route for route in closed if route.tier == top), key=lambda route: route.in_flight)
+
+    def choose(self):
+        """Pick a route for a call and mark it busy; release() it when the call ends"""
+        now = time.monotonic()
+        budgets = self._read_budgets(now)
+        with self._lock:
+            route = self._best(now, budgets)
+            route.in_flight += 1
+            route.calls += 1
+        return route
+
+    def has_alternative(self, route):
+        """True when a retry would now go to a different route"""
+        now = time.monotonic()
+        budgets = self._read_budgets(now)
+        with self._lock:
+            return self._best(now, budgets) is not route
+
+    def release(self, route, outcome=None, seconds=None, retry_after=None):
+        """Record how a call on route ended
+
+        outcome is success, quota_error, transient_error, empty or error;
+        None (a call that never reached the model) only frees the route.
+        """
+        now = time.monotonic()
+        opened = None
+        with self._lock:
+            route.in_flight -= 1
+            if outcome is None:
+                return
+            route.outcomes.append(outcome == 'success')
+            if seconds is not None and outcome in ('success', 'transient_error'):
+                route.latency = seconds if route.latency is None else (
+                    LATENCY_ALPHA * seconds + (1 - LATENCY_ALPHA) * route.latency)
+                route.latency_samples += 1
+
+            if outcome == 'quota_error':
+                route.throttled += 1
+                if route.throttled >= self.breaker_threshold:
+                    opened = 'quota'
+                    route.open_until = now + max(self.breaker_cooldown, retry_after or 0)
+            elif outcome == 'success':
+                route.throttled = 0
+            if (opened is None and self.slow_after and route.latency_samples >= MIN_LATENCY_SAMPLES
+                    and route.latency > self.slow_after):
+                opened = 'slow'
+                route.open_until = now + self.breaker_cooldown
+                # Judge the route afresh once it takes calls again
+                route.latency, route.latency_samples = None, 0
+            if opened:
+                route.open_reason = opened
+
+        count('image_analyzer_route_calls_total', key=route.label, model=route.model_name, outcome=outcome)
+        if opened:
+            count('image_analyzer_circuit_opens_total', key=route.label, model=route.model_name, reason=opened)
+
+    def stats(self):
+        """Health of every route, as this worker sees it"""
+        now = time.monotonic()
+        budgets = {route: self._budget_or_none(route) for route in self.routes}
+        with self._lock:
+            return [{
+                'key': route.label,
+                'model': route.model_name,
+                'tier': route.tier,
+                'circuit': 'open' if route.is_open(now) else 'closed',
+                'open_for': round(max(0.0, route.open_until - now), 2),
+                'open_reason': route.open_reason if route.is_open(now) else None,
+                'in_flight': route.in_flight,
+                'calls': route.calls,
+                'error_rate': round(route.error_rate(), 4),
+                'latency': round(route.latency, 3) if route.latency is not None else None,
+                'budget': budgets[route],
+            } for route in self.routes]
+
+    def _budget_or_none(self, route):
+        budget = self._budget(route)
+        return None if math.isinf(budget) else round(budget, 2)
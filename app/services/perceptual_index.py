@@ -0,0 +1,125 @@
+import itertools
+import time
+from flask import current_app
+from app.utils.sqlite import SQLiteConnections
+
+HASH_BITS = 64
+# The hash is indexed as one column per chunk: wide enough that a probe at a
+# million entries matches a row or so, few enough that probes stay cheap
+CHUNK_WIDTHS = (22, 21, 21)
+CHUNKS = len(CHUNK_WIDTHS)
+_CHUNK_OFFSETS = tuple(sum(CHUNK_WIDTHS[:i]) for i in range(CHUNKS))
+_HASH_MASK = (1 << HASH_BITS) - 1
+
+
+def _to_signed(value):
+    """SQLite integers are signed 64-bit"""
+    return value - (1 << HASH_BITS) if value >= 1 << (HASH_BITS - 1) else value
+
+
+def _chunks(value):
+    return [(value >> offset) & ((1 << width) - 1) for offset, width in zip(_CHUNK_OFFSETS, CHUNK_WIDTHS)]
+
+
+def _neighbours(chunk, width, radius):
+    """Every chunk value within radius flipped bits of chunk"""
+    values = [chunk]
+    for flips in range(1, radius + 1):
+        for bits in itertools.combinations(range(width), flips):
+            flipped = chunk
+            for bit in bits:
+                flipped ^= 1 << bit
+            values.append(flipped)
+    return values
+
+
+class PerceptualIndex:
+    """Perceptual hashes of seen images, searchable by Hamming distance
+
+    Uses multi-index hashing: the 64-bit hash is stored as three indexed
+    chunks. Two hashes at most d bits apart agree to within d // 3 bits on
+    at least one chunk, so a lookup probes each chunk index with the values
+    that close and checks the full distance of those candidates only.
+    The database is shared by every worker on the host.
+    """
+
+    def __init__(self, path, threshold=8, max_entries=1_000_000):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._connections = SQLiteConnections(path)
+        with self._connections.get() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS hashes ('
+                ' digest TEXT PRIMARY KEY,'
+                ' phash INTEGER NOT NULL,'
+                ' c0 INTEGER NOT NULL, c1 INTEGER NOT NULL, c2 INTEGER NOT NULL,'
+                ' created_at REAL NOT NULL)'
+            )
+            for i in range(CHUNKS):
+                # Covering indexes: probes read the hash without touching the table
+                conn.execute(f'CREATE INDEX IF NOT EXISTS hashes_c{i} ON hashes (c{i}, phash)')
+            conn.execute('CREATE INDEX IF NOT EXISTS hashes_created ON hashes (created_at)')
+
+    def get(self, digest):
+        """The stored hash of the image with this SHA-256, or None"""
+        row = self._connections.get().execute('SELECT phash FROM hashes WHERE digest = ?', (digest,)).fetchone()
+        return row[0] & _HASH_MASK if row else None
+
+    def add(self, digest, phash):
+        """Remember an image's hash, dropping the oldest entries beyond max_entries"""
+        with self._connections.get() as conn:
+            cursor = conn.execute(
+                'INSERT OR IGNORE INTO hashes (digest, phash, c0, c1, c2, created_at) VALUES (?, ?, ?, ?, ?, ?)',
+                (digest, _to_signed(phash), *_chunks(phash), time.time())
+            )
+            if cursor.rowcount and cursor.lastrowid % 1000 == 0:
+                conn.execute(
+                    'DELETE FROM hashes WHERE digest IN ('
+                    ' SELECT digest FROM hashes ORDER BY created_at DESC LIMIT -1 OFFSET ?)',
+                    (self.max_entries,)
+                )
+
+    def nearest(self, phash, threshold=None, exclude=None):
+        """[(distance, digest), ...] of stored images within threshold bits, closest first"""
+        threshold = self.threshold if threshold is None else threshold
+        radius = threshold // CHUNKS
+        conn = self._connections.get()
+        close = []
+        for i, (chunk, width) in enumerate(zip(_chunks(phash), CHUNK_WIDTHS)):
+            values = _neighbours(chunk, width, radius)
+            rows = conn.execute(
+                f'SELECT rowid, phash FROM hashes WHERE c{i} IN ({",".join("?" * len(values))})', values
+            )
+            close.extend((rowid, distance) for rowid, stored in rows
+                         if (distance := ((stored & _HASH_MASK) ^ phash).bit_count()) <= threshold)
+        if not close:
+            return []
+
+        distances = dict(close)
+        rows = conn.execute(
+            f'SELECT rowid, digest FROM hashes WHERE rowid IN ({",".join("?" * len(distances))})', list(distances)
+        )
+        return sorted((distances[rowid], digest) for rowid, digest in rows if digest != exclude)
+
+    def __len__(self):
+        return self._connections.get().execute('SELECT COUNT(*) FROM hashes').fetchone()[0]
+
+
+def init_perceptual_index(app):
+    """Attach the near-duplicate index, or None when NEAR_DUPLICATE_MODE is off"""
+    mode = app.config['NEAR_DUPLICATE_MODE']
+    if mode not in ('off', 'flag', 'reuse'):
+        raise ValueError(f"Unknown NEAR_DUPLICATE_MODE: {mode}")
+    if mode == 'off':
+        app.extensions['perceptual_index'] = None
+        return
+    app.extensions['perceptual_index'] = PerceptualIndex(
+        app.config['NEAR_DUPLICATE_PATH'],
+        threshold=app.config['NEAR_DUPLICATE_THRESHOLD'],
+        max_entries=app.config['NEAR_DUPLICATE_MAX_ENTRIES']
+    )
+
+
+def get_perceptual_index():
+    """Return the app's perceptual index (None when near-duplicate detection is off)"""
+    return current_app.extensions.get('perceptual_index')
@@ -0,0 +1,128 @@
+import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app, url_for
+from app.services.metrics import timed
+from app.services.result_cache import fingerprint
+from app.utils.image_processing import render_previews
+
+# Seconds a request waits for a preview still being rendered
+RENDER_WAIT = 30
+
+
+def is_digest(value):
+    return len(value) == 64 and all(c in '0123456789abcdef' for c in value)
+
+
+class PreviewRenderer:
+    """Display-size WebP previews and tiny placeholders of uploads, rendered once per stored image
+
+    Renditions are stored next to the upload's blob and named by its content
+    hash, so identical uploads share them and they are deleted with the blob.
+    schedule() renders them on a background thread right after the upload is
+    stored; a request that arrives first waits for that render (or starts it).
+    A rendition's ETag is the image's hash plus the render settings, and its
+    URL carries the settings version, so browsers may cache it forever.
+    """
+
+    def __init__(self, app, storage, sizes, quality=75, max_workers=2):
+        self.app = app
+        self.storage = storage
+        self.sizes = sizes  # kind -> longest side in pixels
+        self.quality = quality
+        self.max_workers = max_workers
+        self.version = fingerprint(sorted(sizes.items()), quality)[:8]
+        self._pending = {}
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        """Create the pool lazily so each forked worker gets its own threads"""
+        if self._executor is None or self._pid != os.getpid():
+            with self._lock:
+                if self._executor is None or self._pid != os.getpid():
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.max_workers,
+                        thread_name_prefix='preview'
+                    )
+                    self._pending = {}
+                    self._pid = os.getpid()
+        return self._executor
+
+    def schedule(self, digest):
+        """Render the image's previews in the background unless they exist or are underway; returns a future or None"""
+        if all(os.path.exists(self.storage.derivative_path(digest, kind)) for kind in self.sizes):
+            return None
+        executor = self._get_executor()
+        with self._lock:
+            future = self._pending.get(digest)
+            if future is None:
+                future = self._pending[digest] = executor.submit(self._render, digest)
+                future.add_done_callback(lambda _: self._forget(digest, future))
+        return future
+
+    def _forget(self, digest, future):
+        with self._lock:
+            if self._pending.get(digest) is future:
+                del self._pending[digest]
+
+    def _render(self, digest):
+        blob_path = self.storage.blob_path(digest)
+        with self.app.app_context():
+            try:
+                with timed('preview.render'):
+                    renditions = render_previews(blob_path, self.sizes, self.quality)
+            except FileNotFoundError:
+                return  # deleted before its preview was rendered
+            except Exception as e:
+                print(f"Preview rendering failed for {digest[:12]}: {e}")
+                return
+        for kind, data in renditions.items():
+            path = self.storage.derivative_path(digest, kind)
+            tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+
+    def path(self, digest, kind):
+        """Path of a rendition, rendering it first if needed; None when the image is gone or unreadable"""
+        path = self.storage.derivative_path(digest, kind)
+        if os.path.exists(path):
+            return path
+        if not os.path.exists(self.storage.blob_path(digest)):
+            return None
+        future = self.schedule(digest)
+        if future is not None:
+            future.result(timeout=RENDER_WAIT)
+        return path if os.path.exists(path) else None
+
+    def etag(self, digest, kind):
+        return f'{digest[:32]}-{kind}-{self.version}'
+
+    def urls(self, digest):
+        """URLs of an image's renditions, e.g. {'preview_url': ..., 'placeholder_url': ...}"""
+        return {
+            f'{kind}_url': url_for('api.upload_preview', digest=digest, kind=kind, v=self.version, _external=True)
+            for kind in self.sizes
+        }
+
+
+def init_previews(app):
+    """Attach the preview renderer (None when PREVIEW_MAX_SIDE is 0)"""
+    if not app.config['PREVIEW_MAX_SIDE']:
+        app.extensions['previews'] = None
+        return
+    app.extensions['previews'] = PreviewRenderer(
+        app,
+        app.extensions['upload_storage'],
+        sizes={'preview': app.config['PREVIEW_MAX_SIDE'], 'placeholder': app.config['PREVIEW_PLACEHOLDER_SIDE']},
+        quality=app.config['PREVIEW_QUALITY'],
+        max_workers=app.config['PREVIEW_WORKERS'],
+    )
+
+
+def get_previews():
+    """Return the app's preview renderer (None when previews are off)"""
+    return current_app.extensions.get('previews')
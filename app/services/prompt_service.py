@@ -0,0 +1,124 @@
+import inspect
+import os
+import re
+import threading
+from flask import current_app
+from app.services.result_cache import fingerprint
+
+# Templates are named <variant>.v<version>.txt, e.g. analysis.v1.txt
+_TEMPLATE_NAME = re.compile(r'^(?P<name>[a-z0-9_-]+)\.v(?P<version>\d+)\.txt$')
+
+
+class PromptTemplate:
+    """One immutable prompt version, with its fingerprint and token count"""
+
+    __slots__ = ('name', 'version', 'text', 'fingerprint', 'token_count')
+
+    def __init__(self, name, version, text):
+        self.name = name
+        self.version = version
+        self.text = text
+        self.fingerprint = fingerprint(name, version, text)
+        self.token_count = None  # measured with the model's tokenizer, see measure()
+
+    @property
+    def id(self):
+        return f'{self.name}.v{self.version}'
+
+    @property
+    def estimated_tokens(self):
+        """Token count if measured, else the usual ~4 characters per token"""
+        return self.token_count or len(self.text) // 4
+
+    def measure(self, backend):
+        """Count tokens with the model backend's tokenizer once; returns None if that fails"""
+        if self.token_count is None:
+            try:
+                self.token_count = backend.count_tokens(self.text)
+            except Exception as e:
+                print(f"Could not count tokens for prompt {self.id}: {e}")
+        return self.token_count
+
+    def describe(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'version': self.version,
+            'fingerprint': self.fingerprint,
+            'characters': len(self.text),
+            'tokens': self.token_count,
+            'estimated_tokens': self.estimated_tokens,
+        }
+
+
+class PromptLibrary:
+    """All prompt templates in a folder, read once at startup
+
+    A variant is requested by name ("analysis", resolving to its newest
+    version) or pinned to an exact version ("analysis.v1").
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self._templates = {}
+        self._latest = {}
+        self._measure_lock = threading.Lock()
+
+        for entry in sorted(os.listdir(folder)):
+            match = _TEMPLATE_NAME.match(entry)
+            if not match:
+                continue
+            with open(os.path.join(folder, entry), encoding='utf-8') as f:
+                template = PromptTemplate(match['name'], int(match['version']), f.read().strip())
+            self._templates[template.id] = template
+            latest = self._latest.get(template.name)
+            if latest is None or template.version > latest.version:
+                self._latest[template.name] = template
+
+    def get(self, variant):
+        template = self._templates.get(variant) or self._latest.get(variant)
+        if template is None:
+            raise ValueError(f"Unknown prompt variant: {variant}")
+        return template
+
+    def templates(self):
+        return list(self._templates.values())
+
+    def measure(self, backend):
+        """Count tokens for every template that has not been measured yet"""
+        with self._measure_lock:
+            for template in self._templates.values():
+                template.measure(backend)
+
+
+def supports_system_instruction():
+    """True when the installed SDK can send the prompt as a system instruction"""
+    import google.generativeai as genai
+    
+    try:
+        return 'system_instruction' in inspect.signature(genai.GenerativeModel).parameters
+    except (TypeError, ValueError):
+        return False
+
+
+def supports_context_cache():
+    """True when the installed SDK offers explicit context caching"""
+    import google.generativeai as genai
+    
+    return hasattr(genai, 'caching') and hasattr(genai.GenerativeModel, 'from_cached_content')
+
+
+def init_prompt_library(app):
+    """Load the prompt templates and check the configured variant exists"""
+    library = PromptLibrary(app.config['PROMPT_FOLDER'])
+    library.get(app.config['PROMPT_VARIANT'])
+    app.extensions['prompt_library'] = library
+
+
+def get_prompt_library():
+    return current_app.extensions['prompt_library']
+
+
+def get_active_prompt():
+    """The template selected by PROMPT_VARIANT"""
+    return get_prompt_library().get(current_app.config['PROMPT_VARIANT'])
@@ -0,0 +1,265 @@
+import hashlib
+import os
+import random
+import re
+import time
+from flask import current_app
+from app.utils.sqlite import SQLiteConnections
+
+# Patterns for the retry hints Gemini/Google API errors carry in their message
+_RETRY_AFTER_PATTERNS = (
+    re.compile(r'retry in ([\d.]+)\s*s', re.IGNORECASE),
+    re.compile(r'retry[_ -]after[:= ]+([\d.]+)', re.IGNORECASE),
+    re.compile(r'retry_delay\s*\{\s*seconds:\s*(\d+)', re.IGNORECASE),
+)
+
+
+class RateLimitTimeout(Exception):
+    """Raised when no request slot frees up within the allowed wait"""
+
+
+def is_quota_error(error):
+    error_msg = str(error).lower()
+    return '429' in error_msg or 'quota' in error_msg or 'resource exhausted' in error_msg
+
+
+def is_transient_error(error):
+    error_msg = str(error).lower()
+    return any(marker in error_msg for marker in ('deadline', 'timeout', 'timed out', '503', 'unavailable'))
+
+
+def parse_retry_after(error):
+    """Return the server's suggested retry delay in seconds, if the error carries one"""
+    retry_delay = getattr(error, 'retry_after', None)
+    if retry_delay:
+        return float(retry_delay)
+    error_msg = str(error)
+    for pattern in _RETRY_AFTER_PATTERNS:
+        match = pattern.search(error_msg)
+        if match:
+            return float(match.group(1))
+    return None
+
+
+def backoff_delay(attempt, base=2.0, cap=60.0, retry_after=None):
+    """Full-jitter exponential backoff, never shorter than the server's hint"""
+    delay = random.uniform(0, min(cap, base * (2 ** attempt)))
+    if retry_after:
+        delay = max(delay, min(retry_after, cap) + random.uniform(0, 1))
+    return delay
+
+
+class RateLimiter:
+    """Token-bucket limiter with AIMD rate control, shared by all workers via SQLite
+
+    Requests draw from a requests-per-minute bucket and (optionally) a
+    tokens-per-minute bucket. The effective RPM starts at the configured budget,
+    halves on every 429 and creeps back up by one per success. A 429 with a
+    retry hint pauses every worker until the hint expires.
+    """
+
+    def __init__(self, path, rpm, tpm=0, min_rpm=1, max_wait=60):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.min_rpm = min(min_rpm, rpm)
+        self.max_wait = max_wait
+        self._connections = SQLiteConnections(path)
+        conn = self._connections.get()
+        with conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS limiter ('
+                ' id INTEGER PRIMARY KEY CHECK (id = 1),'
+                ' rate REAL NOT NULL,'
+                ' tokens REAL NOT NULL,'
+                ' model_tokens REAL NOT NULL,'
+                ' updated_at REAL NOT NULL,'
+                ' blocked_until REAL NOT NULL DEFAULT 0,'
+                ' waiting INTEGER NOT NULL DEFAULT 0,'
+                ' throttle_events INTEGER NOT NULL DEFAULT 0,'
+                ' granted INTEGER NOT NULL DEFAULT 0)'
+            )
+            conn.execute(
+                'INSERT OR IGNORE INTO limiter (id, rate, tokens, model_tokens, updated_at) VALUES (1, ?, ?, ?, ?)',
+                (rpm, rpm, tpm, time.time())
+            )
+
+    def _locked(self):
+        """Open a write transaction; BEGIN IMMEDIATE serialises workers on the file lock"""
+        conn = self._connections.get()
+        conn.execute('BEGIN IMMEDIATE')
+        return conn
+
+    def _refill(self, conn, now):
+        rate, tokens, model_tokens, updated_at = conn.execute(
+            'SELECT rate, tokens, model_tokens, updated_at FROM limiter WHERE id = 1'
+        ).fetchone()
+        rate = min(rate, self.rpm)
+        elapsed = max(0.0, now - updated_at)
+        tokens = min(rate, tokens + elapsed * rate / 60.0)
+        if self.tpm:
+            model_tokens = min(self.tpm, model_tokens + elapsed * self.tpm / 60.0)
+        return rate, tokens, model_tokens
+
+    def acquire(self, cost=0):
+        """Block until a request (and `cost` model tokens) may be sent"""
+        deadline = time.monotonic() + self.max_wait
+        queued = False
+        cost = min(cost, self.tpm) if self.tpm else 0
+
+        try:
+            while True:
+                now = time.time()
+                conn = self._locked()
+                try:
+                    rate, tokens, model_tokens = self._refill(conn, now)
+                    blocked_until = conn.execute('SELECT blocked_until FROM limiter WHERE id = 1').fetchone()[0]
+
+                    if now >= blocked_until and tokens >= 1 and model_tokens >= cost:
+                        conn.execute(
+                            'UPDATE limiter SET tokens = ?, model_tokens = ?, updated_at = ?,'
+                            ' granted = granted + 1, waiting = waiting - ? WHERE id = 1',
+                            (tokens - 1, model_tokens - cost, now, 1 if queued else 0)
+                        )
+                        conn.commit()
+                        queued = False
+                        return
+
+                    # Time until both buckets (and any 429 pause) allow this request
+                    wait = max(0.0, blocked_until - now)
+                    if tokens < 1:
+                        wait = max(wait, (1 - tokens) * 60.0 / rate)
+                    if model_tokens < cost:
+                        wait = max(wait, (cost - model_tokens) * 60.0 / self.tpm)
+
+                    conn.execute(
+                        'UPDATE limiter SET tokens = ?, model_tokens = ?, updated_at = ?, waiting = waiting + ? WHERE id = 1',
+                        (tokens, model_tokens, now, 0 if queued else 1)
+                    )
+                    conn.commit()
+                    queued = True
+                except Exception:
+                    conn.rollback()
+                    raise
+
+                if time.monotonic() + wait > deadline:
+                    raise RateLimitTimeout('API quota exceeded. Please try again later.')
+                # Small jitter keeps waiting workers from stampeding the lock together
+                time.sleep(min(wait, 5.0) + random.uniform(0, 0.05))
+        finally:
+            if queued:
+                with self._connections.get() as conn:
+                    conn.execute('UPDATE limiter SET waiting = MAX(waiting - 1, 0) WHERE id = 1')
+
+    def record_success(self):
+        """Additive increase back towards the configured budget"""
+        conn = self._locked()
+        try:
+            conn.execute('UPDATE limiter SET rate = MIN(?, rate + 1) WHERE id = 1', (self.rpm,))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    def record_throttle(self, retry_after=None):
+        """Multiplicative decrease, and pause everyone for the server's retry hint"""
+        now = time.time()
+        conn = self._locked()
+        try:
+            rate, tokens, model_tokens = self._refill(conn, now)
+            new_rate = max(self.min_rpm, rate / 2)
+            conn.execute(
+                'UPDATE limiter SET rate = ?, tokens = ?, model_tokens = ?, updated_at = ?,'
+                ' blocked_until = MAX(blocked_until, ?), throttle_events = throttle_events + 1 WHERE id = 1',
+                (new_rate, min(tokens, new_rate), model_tokens, now, now + (retry_after or 0))
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    def available(self):
+        """Requests that could be sent right now (0 during a 429 pause)"""
+        now = time.time()
+        rate, tokens, updated_at, blocked_until = self._connections.get().execute(
+            'SELECT rate, tokens, updated_at, blocked_until FROM limiter WHERE id = 1'
+        ).fetchone()
+        if now < blocked_until:
+            return 0.0
+        return min(rate, tokens + max(0.0, now - updated_at) * rate / 60.0)
+
+    def stats(self):
+        """Current limiter state for monitoring"""
+        now = time.time()
+        row = self._connections.get().execute(
+            'SELECT rate, tokens, model_tokens, updated_at, blocked_until, waiting, throttle_events, granted'
+            ' FROM limiter WHERE id = 1'
+        ).fetchone()
+        rate, tokens, model_tokens, updated_at, blocked_until, waiting, throttle_events, granted = row
+        elapsed = max(0.0, now - updated_at)
+        return {
+            'configured_rpm': self.rpm,
+            'configured_tpm': self.tpm,
+            'current_rpm': round(rate, 2),
+            'tokens': round(min(rate, tokens + elapsed * rate / 60.0), 2),
+            'model_tokens': round(min(self.tpm, model_tokens + elapsed * self.tpm / 60.0), 0) if self.tpm else None,
+            'blocked_for': round(max(0.0, blocked_until - now), 2),
+            'queue_depth': waiting,
+            'throttle_events': throttle_events,
+            'granted': granted,
+        }
+
+
+def init_rate_limiter(app):
+    """Attach the shared Gemini rate limiters to the app (disabled when GEMINI_RPM is 0)
+
+    Gemini quotas are per key and model, so every API key of the pool gets a
+    GEMINI_RPM/GEMINI_TPM budget for each model it may call. Each route's
+    bucket lives in a file named after the route, so every worker shares it.
+    """
+    rpm = app.config['GEMINI_RPM']
+    app.extensions['rate_limiters'] = {}
+    if not rpm:
+        app.extensions['rate_limiter'] = None
+        return
+
+    primary = (app.config['GEMINI_API_KEY'], app.config['GEMINI_MODEL'])
+    root, ext = os.path.splitext(app.config['RATE_LIMITER_PATH'])
+
+    def limiter(route):
+        path = app.config['RATE_LIMITER_PATH'] if route == primary else \
+            f'{root}.{hashlib.sha256(repr(route).encode()).hexdigest()[:12]}{ext}'
+        return RateLimiter(path, rpm=rpm, tpm=app.config['GEMINI_TPM'], max_wait=app.config['RATE_LIMIT_MAX_WAIT'])
+
+    app.extensions['rate_limiter_factory'] = limiter
+    register_rate_limiters(app)
+    app.extensions['rate_limiter'] = app.extensions['rate_limiters'][primary]
+
+
+def register_rate_limiters(app):
+    """Add a limiter for every key/model route the current config can call that has none yet"""
+    limiters = app.extensions.get('rate_limiters')
+    if not app.config['GEMINI_RPM'] or limiters is None:
+        return
+    config = app.config
+    for key in [config['GEMINI_API_KEY'], *config['GEMINI_API_KEYS']]:
+        for model in [config['GEMINI_MODEL'], *config['GEMINI_FALLBACK_MODELS']]:
+            if (key, model) not in limiters:
+                limiters[(key, model)] = app.extensions['rate_limiter_factory']((key, model))
+
+
+def get_rate_limiter(api_key=None, model_name=None):
+    """The limiter for an API key and model (default GEMINI_API_KEY, GEMINI_MODEL), or None when off
+
+    A route that was not configured at startup (a key or model changed on
+    app.config since) gets its own limiter on first use rather than going
+    unlimited.
+    """
+    config = current_app.config
+    route = (api_key or config['GEMINI_API_KEY'], model_name or config['GEMINI_MODEL'])
+    limiters = current_app.extensions.get('rate_limiters')
+    if not limiters:
+        return None
+    limiter = limiters.get(route)
+    if limiter is None:
+        limiter = limiters.setdefault(route, current_app.extensions['rate_limiter_factory'](route))
+    return limiter
@@ -0,0 +1,220 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app
+from app.utils.sqlite import SQLiteConnections
+
+
+def hash_file(filepath, chunk_size=1024 * 1024):
+    """Return the SHA-256 hex digest of a file's contents (path or binary file object)"""
+    digest = hashlib.sha256()
+    if hasattr(filepath, 'read'):
+        filepath.seek(0)
+        for chunk in iter(lambda: filepath.read(chunk_size), b''):
+            digest.update(chunk)
+        filepath.seek(0)
+        return digest.hexdigest()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def make_cache_key(image_digest, analysis_fingerprint):
+    """Combine the image hash with the model/config/prompt fingerprint"""
+    return f"{analysis_fingerprint}:{image_digest}"
+
+
+class MemoryCacheBackend:
+    """In-process LRU cache backend (one copy per gunicorn worker)"""
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at and expires_at < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        expires_at = time.time() + ttl if ttl else None
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+class SQLiteCacheBackend:
+    """On-disk cache backend shared by every worker on the host"""
+
+    def __init__(self, path, max_entries=1000):
+        self.path = path
+        self.max_entries = max_entries
+        self._connections = SQLiteConnections(path)
+        with self._connect() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS results ('
+                ' key TEXT PRIMARY KEY,'
+                ' value TEXT NOT NULL,'
+                ' expires_at REAL,'
+                ' accessed_at REAL NOT NULL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed_at)')
+
+    def _connect(self):
+        return self._connections.get()
+
+    def get(self, key):
+        now = time.time()
+        conn = self._connect()
+        row = conn.execute(
+            'SELECT value, expires_at FROM results WHERE key = ?', (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        value, expires_at = row
+        with conn:
+            if expires_at and expires_at < now:
+                conn.execute('DELETE FROM results WHERE key = ?', (key,))
+                return None
+            conn.execute('UPDATE results SET accessed_at = ? WHERE key = ?', (now, key))
+        return json.loads(value)
+
+    def set(self, key, value, ttl):
+        now = time.time()
+        expires_at = now + ttl if ttl else None
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO results (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)',
+                (key, json.dumps(value), expires_at, now)
+            )
+            conn.execute('DELETE FROM results WHERE expires_at IS NOT NULL AND expires_at < ?', (now,))
+            conn.execute(
+                'DELETE FROM results WHERE key IN ('
+                ' SELECT key FROM results ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)',
+                (self.max_entries,)
+            )
+
+    def delete(self, key):
+        with self._connect() as conn:
+            conn.execute('DELETE FROM results WHERE key = ?', (key,))
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute('DELETE FROM results')
+
+    def __len__(self):
+        return self._connect().execute('SELECT COUNT(*) FROM results').fetchone()[0]
+
+
+class ResultCache:
+    """Analysis result cache with TTL, size-bounded eviction and hit/miss counters"""
+
+    def __init__(self, backend, ttl=None):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached result for key, or None on a miss"""
+        try:
+            value = self.backend.get(key)
+        except Exception as e:
+            print(f"Result cache read failed: {e}")
+            value = None
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, value):
+        """Store a result; cache failures never break the analysis itself"""
+        try:
+            self.backend.set(key, value, self.ttl)
+        except Exception as e:
+            print(f"Result cache write failed: {e}")
+            return
+        with self._lock:
+            self.stores += 1
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        """Return counters for this worker plus the backend's current size"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            stats = {
+                'backend': type(self.backend).__name__,
+                'hits': self.hits,
+                'misses': self.misses,
+                'stores': self.stores,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+        try:
+            stats['entries'] = len(self.backend)
+        except Exception:
+            stats['entries'] = None
+        return stats
+
+
+def create_result_cache(config):
+    """Build the result cache described by the app config, or None if disabled"""
+    backend_name = (config.get('RESULT_CACHE_BACKEND') or 'none').lower()
+    max_entries = config.get('RESULT_CACHE_MAX_ENTRIES', 1000)
+
+    if backend_name == 'memory':
+        backend = MemoryCacheBackend(max_entries=max_entries)
+    elif backend_name == 'sqlite':
+        backend = SQLiteCacheBackend(config['RESULT_CACHE_PATH'], max_entries=max_entries)
+    elif backend_name == 'none':
+        return None
+    else:
+        raise ValueError(f"Unknown RESULT_CACHE_BACKEND: {backend_name}")
+
+    return ResultCache(backend, ttl=config.get('RESULT_CACHE_TTL'))
+
+
+def init_result_cache(app):
+    """Attach the configured result cache to the app"""
+    app.extensions['result_cache'] = create_result_cache(app.config)
+
+
+def get_result_cache():
+    """Return the current app's result cache (None when caching is disabled)"""
+    return current_app.extensions.get('result_cache')
+
+
+def fingerprint(*parts):
+    """Stable short hash of JSON-serialisable parts"""
+    payload = json.dumps(parts, sort_keys=True, default=str).encode('utf-8')
+    return hashlib.sha256(payload).hexdigest()[:16]
@@ -0,0 +1,250 @@
+import json
+import os
+import threading
+import time
+from flask import current_app
+from app.services.metrics import count
+from app.utils.sqlite import SQLiteConnections
+
+RUNNING, DONE, FAILED, ABANDONED = 'running', 'done', 'failed', 'abandoned'
+
+
+class _Call:
+    """A call in flight in this worker, and its outcome once settled"""
+
+    __slots__ = ('event', 'state', 'value', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.state = RUNNING
+        self.value = None
+        self.error = None
+
+
+class Flight:
+    """One caller's share of a coalesced call
+
+    The leader runs the call inside `with flight:` and sets flight.value;
+    leaving the block publishes the value, or the exception raised inside it,
+    to everyone waiting. A leader that leaves without a value (e.g. a client
+    disconnecting from a stream), or with an error marked shared = False
+    (one about the caller rather than the call), hands the call to one of
+    the waiters. Followers get a flight whose value is already set.
+    """
+
+    def __init__(self, group, key, call=None, value=None):
+        self._group = group
+        self._key = key
+        self._call = call
+        self.leader = call is not None
+        self.value = value
+
+    @classmethod
+    def solo(cls):
+        """A leader's flight for a call that is not coalesced with anything"""
+        return cls(None, None, _Call())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if not self.leader or self._group is None:
+            return False
+        if isinstance(exc, Exception) and getattr(exc, 'shared', True):
+            self._group._settle(self._key, self._call, FAILED, error=exc)
+        elif exc is None and self.value is not None:
+            self._group._settle(self._key, self._call, DONE, value=self.value)
+        else:
+            self._group._settle(self._key, self._call, ABANDONED)
+        return False
+
+
+class SingleFlight:
+    """Coalesces concurrent identical calls: one caller runs it, the others wait for its outcome
+
+    Within a worker, followers wait on an event set by the leading thread.
+    Across the workers on a host, the leading thread of each worker claims a
+    lease row in SQLite; the worker that gets it runs the call and leaves the
+    outcome in the row for `linger` seconds, so workers already polling for it
+    can read it. Only a running call is joined: a settled row is replaced by
+    the next caller's new call. A lease older than lease_ttl (a worker that
+    died mid-call) can be taken over.
+    """
+
+    def __init__(self, path=None, lease_ttl=300, linger=5, poll_interval=0.2):
+        self.lease_ttl = lease_ttl
+        self.linger = linger
+        self.poll_interval = poll_interval
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._connections = SQLiteConnections(path) if path else None
+        self.leaders = 0
+        self.saved_worker = 0
+        self.saved_host = 0
+        if self._connections is not None:
+            with self._connections.get() as conn:
+                conn.execute(
+                    'CREATE TABLE IF NOT EXISTS flights ('
+                    ' key TEXT PRIMARY KEY,'
+                    ' state TEXT NOT NULL,'
+                    ' value TEXT,'
+                    ' error TEXT,'
+                    ' owner INTEGER NOT NULL,'
+                    ' expires_at REAL NOT NULL)'
+                )
+
+    def join(self, key):
+        """Return a Flight for key: the leader's, or a follower's carrying the leader's value
+
+        Followers block until the call settles, and re-raise the leader's error.
+        """
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                local_leader = call is None
+                if local_leader:
+                    call = self._calls[key] = _Call()
+
+            if not local_leader:
+                call.event.wait()
+                if call.state == DONE:
+                    self._saved('worker')
+                    return Flight(self, key, value=call.value)
+                if call.state == FAILED:
+                    self._saved('worker')
+                    raise call.error
+                continue
+
+            if self._connections is None or self._claim(key):
+                with self._lock:
+                    self.leaders += 1
+                return Flight(self, key, call)
+
+            # Another worker is running the call: wait for it on behalf of this worker
+            try:
+                state, value, error, owner = self._wait_for_host(key)
+            except BaseException:
+                self._settle_local(key, call, ABANDONED)
+                raise
+            if state == ABANDONED:
+                self._settle_local(key, call, ABANDONED)
+                continue
+            self._saved('host' if owner != os.getpid() else 'worker')
+            if state == DONE:
+                self._settle_local(key, call, DONE, value=value)
+                return Flight(self, key, value=value)
+            error = Exception(error)
+            self._settle_local(key, call, FAILED, error=error)
+            raise error
+
+    def run(self, key, fn):
+        """Return fn(), or the result of an identical call already in flight"""
+        with self.join(key) as flight:
+            if flight.leader:
+                flight.value = fn()
+        return flight.value
+
+    def _saved(self, scope):
+        with self._lock:
+            if scope == 'worker':
+                self.saved_worker += 1
+            else:
+                self.saved_host += 1
+        count('image_analyzer_coalesced_calls_total', scope=scope)
+
+    def _claim(self, key):
+        """Take the host-wide lease for key unless another worker's call is still running"""
+        now = time.time()
+        conn = self._connections.get()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT state, expires_at FROM flights WHERE key = ?', (key,)).fetchone()
+            if row is not None and row[0] == RUNNING and row[1] > now:
+                conn.rollback()
+                return False
+            conn.execute('DELETE FROM flights WHERE expires_at < ?', (now,))
+            conn.execute(
+                'INSERT OR REPLACE INTO flights (key, state, value, error, owner, expires_at)'
+                ' VALUES (?, ?, NULL, NULL, ?, ?)',
+                (key, RUNNING, os.getpid(), now + self.lease_ttl)
+            )
+            conn.commit()
+            return True
+        except Exception:
+            conn.rollback()
+            raise
+
+    def _wait_for_host(self, key):
+        """Poll another worker's lease until it settles; returns (state, value, error, owner pid)"""
+        conn = self._connections.get()
+        while True:
+            row = conn.execute(
+                'SELECT state, value, error, owner, expires_at FROM flights WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None or row[4] < time.time():
+                return ABANDONED, None, None, None
+            state, value, error, owner, _ = row
+            if state == DONE:
+                return DONE, json.loads(value), None, owner
+            if state == FAILED:
+                return FAILED, None, error, owner
+            time.sleep(self.poll_interval)
+
+    def _settle(self, key, call, state, value=None, error=None):
+        """Publish the leader's outcome to other workers, then to this worker's followers"""
+        if self._connections is not None:
+            try:
+                with self._connections.get() as conn:
+                    if state == ABANDONED:
+                        conn.execute('DELETE FROM flights WHERE key = ? AND owner = ?', (key, os.getpid()))
+                    else:
+                        conn.execute(
+                            'UPDATE flights SET state = ?, value = ?, error = ?, expires_at = ?'
+                            ' WHERE key = ? AND owner = ?',
+                            (state, json.dumps(value) if state == DONE else None,
+                             str(error) if error is not None else None,
+                             time.time() + self.linger, key, os.getpid())
+                        )
+            except Exception as e:
+                # Other workers fall back to taking over the lease once it expires
+                print(f"Single-flight lease update failed: {e}")
+        self._settle_local(key, call, state, value, error)
+
+    def _settle_local(self, key, call, state, value=None, error=None):
+        call.state, call.value, call.error = state, value, error
+        with self._lock:
+            if self._calls.get(key) is call:
+                del self._calls[key]
+        call.event.set()
+
+    def stats(self):
+        """Counters for this worker"""
+        with self._lock:
+            return {
+                'host_wide': self._connections is not None,
+                'in_flight': len(self._calls),
+                'leaders': self.leaders,
+                'calls_saved': self.saved_worker + self.saved_host,
+                'saved_in_worker': self.saved_worker,
+                'saved_across_workers': self.saved_host,
+            }
+
+
+def init_single_flight(app):
+    """Attach request coalescing to the app (None when SINGLE_FLIGHT is off)"""
+    mode = app.config['SINGLE_FLIGHT']
+    if mode not in ('off', 'worker', 'host'):
+        raise ValueError(f"Unknown SINGLE_FLIGHT mode: {mode}")
+    if mode == 'off':
+        app.extensions['single_flight'] = None
+        return
+    app.extensions['single_flight'] = SingleFlight(
+        app.config['SINGLE_FLIGHT_PATH'] if mode == 'host' else None,
+        lease_ttl=app.config['SINGLE_FLIGHT_LEASE_TTL'],
+        poll_interval=app.config['SINGLE_FLIGHT_POLL_INTERVAL'],
+    )
+
+
+def get_single_flight():
+    """Return the app's single-flight group (None when coalescing is off)"""
+    return current_app.extensions.get('single_flight')
@@ -0,0 +1,114 @@
+import time
+from flask import current_app
+from app.services.admission import get_admission_controller
+from app.services.metrics import count, record_stage
+from app.utils.sqlite import SQLiteConnections
+
+
+class Speculator:
+    """Starts analyzing each upload before /api/analyze asks for it
+
+    An upload is queued as an ordinary analysis job right away, and its
+    filename is recorded against the job in a table every worker can read.
+    The first analyze request for that filename claims the job: a finished
+    job answers it at once, and one still queued or running is attached to
+    (an async request gets its job ID; a blocking or streamed one waits for
+    the job's result). Deleting the upload cancels the job, or drops its
+    result. Speculation is skipped while this worker has no free model slot,
+    so it never queues ahead of analyses someone asked for.
+    """
+
+    def __init__(self, path, job_queue, ttl=600):
+        self.job_queue = job_queue
+        self.ttl = ttl
+        self._connections = SQLiteConnections(path)
+        with self._connections.get() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS speculations ('
+                ' filename TEXT PRIMARY KEY,'
+                ' job_id TEXT NOT NULL,'
+                ' created_at REAL NOT NULL)'
+            )
+
+    def start(self, filepath, filename, client=None):
+        """Queue a speculative analysis of an upload; returns the job ID, or None if skipped"""
+        admission = get_admission_controller()
+        if admission is not None and not admission.has_free_slot():
+            count('image_analyzer_speculations_total', outcome='skipped')
+            return None
+        self._expire()
+        job_id = self.job_queue.submit(filepath, filename, client=client, speculative=True)
+        with self._connections.get() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO speculations (filename, job_id, created_at) VALUES (?, ?, ?)',
+                (filename, job_id, time.time())
+            )
+        count('image_analyzer_speculations_total', outcome='started')
+        return job_id
+
+    def _pop(self, filename):
+        with self._connections.get() as conn:
+            return conn.execute(
+                'DELETE FROM speculations WHERE filename = ? RETURNING job_id, created_at', (filename,)
+            ).fetchone()
+
+    def claim(self, filename):
+        """The speculative job for an upload, for the analyze request that wants it, or None
+
+        Only the first request for the upload gets the job. A failed job is
+        not returned, so the request analyzes the image itself.
+        """
+        row = self._pop(filename)
+        if row is None:
+            return None
+        job_id, created_at = row
+        self.job_queue.store.claim(job_id)
+        job = self.job_queue.get(job_id)
+        if job is None or job['status'] in ('failed', 'cancelled'):
+            count('image_analyzer_speculations_total', outcome='failed')
+            return None
+        if job['status'] == 'done':
+            # The whole analysis ran before it was asked for
+            count('image_analyzer_speculations_total', outcome='hit')
+            record_stage('analyze.speculation_lead', job['updated_at'] - created_at)
+        else:
+            count('image_analyzer_speculations_total', outcome='joined')
+            record_stage('analyze.speculation_lead', time.time() - created_at)
+        return job
+
+    def cancel(self, filename):
+        """Cancel the unclaimed speculative analysis of a deleted upload"""
+        row = self._pop(filename)
+        if row is None:
+            return
+        status = self.job_queue.cancel(row[0])
+        if status == 'done':
+            count('image_analyzer_speculations_total', outcome='discarded')
+        elif status is not None and status != 'failed':
+            count('image_analyzer_speculations_total', outcome='cancelled')
+
+    def _expire(self):
+        """Forget speculations nobody claimed within ttl seconds"""
+        with self._connections.get() as conn:
+            expired = conn.execute(
+                'DELETE FROM speculations WHERE created_at < ?', (time.time() - self.ttl,)
+            ).rowcount
+        if expired > 0:
+            count('image_analyzer_speculations_total', expired, outcome='expired')
+
+
+def init_speculation(app):
+    """Attach the speculator (None unless SPECULATIVE_ANALYSIS is on)"""
+    if not app.config['SPECULATIVE_ANALYSIS']:
+        app.extensions['speculator'] = None
+        return
+    app.extensions['speculator'] = Speculator(
+        app.config['JOB_STORE_PATH'],
+        app.extensions['job_queue'],
+        ttl=app.config['SPECULATION_TTL'],
+    )
+
+
+def get_speculator():
+    """Return the app's speculator (None when speculative analysis is off)"""
+    return current_app.extensions.get('speculator')
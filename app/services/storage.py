@@ -0,0 +1,358 @@
+import fcntl
+import glob
+import json
+import os
+import random
+import shutil
+import threading
+import time
+import uuid
+from datetime import datetime
+from flask import current_app
+from werkzeug.utils import secure_filename
+
+BLOB_DIR = '.blobs'
+# Renditions of a blob (e.g. its preview) are stored next to it as <sha256>.<kind>.webp
+DERIVATIVE_EXT = '.webp'
+INCOMING_PREFIX = '.incoming-'
+# Partial uploads and temp files older than this were abandoned by a crashed request
+INCOMING_MAX_AGE = 3600
+TMP_SUFFIX = '.tmp'
+# Orphaned blobs younger than this may be about to get their first link; the sweeper leaves them
+ORPHAN_GRACE = 600
+
+
+def _digest_prefix(filename):
+    """The 12-character content hash suffix of an upload filename, if it has one"""
+    stem = os.path.splitext(filename)[0]
+    prefix = stem.rsplit('_', 1)[-1]
+    if len(prefix) == 12 and all(c in '0123456789abcdef' for c in prefix):
+        return prefix
+    return None
+
+
+class UploadStorage:
+    """Lifecycle manager for the upload folder
+
+    Layout: every distinct upload is stored once as .blobs/<ab>/<sha256>, and
+    each upload filename is a hard link to it under a shard directory named by
+    the same two-hex-digit hash prefix (<ab>/<name>_<time>_<hash12>.<ext>), so
+    no directory grows without bound. A sweeper removes uploads older than
+    max_age, orphaned blobs and abandoned partial uploads, then evicts the
+    least recently used blobs until the folder is under quota_bytes.
+    Derivatives (previews) live beside their blob and are removed with it.
+    """
+
+    def __init__(self, root, state_folder, max_age=0, quota_bytes=0, sweep_interval=0):
+        self.root = root
+        self.max_age = max_age
+        self.quota_bytes = quota_bytes
+        self.sweep_interval = sweep_interval
+        self.lock_path = os.path.join(state_folder, 'upload_sweep.lock')
+        self.report_path = os.path.join(state_folder, 'upload_sweep.json')
+        self._sweeper_pid = None
+        self._sweeper_lock = threading.Lock()
+        os.makedirs(state_folder, exist_ok=True)
+
+    # Paths
+
+    def relative_path(self, filename):
+        """Path of an upload below the upload folder (legacy names stay flat)"""
+        prefix = _digest_prefix(filename)
+        return f'{prefix[:2]}/{filename}' if prefix else filename
+
+    def path_for(self, filename):
+        """Absolute path of an upload, or None for names that could escape the folder"""
+        if not filename or filename != secure_filename(filename):
+            return None
+        return os.path.join(self.root, self.relative_path(filename))
+
+    def blob_path(self, digest):
+        return os.path.join(self.root, BLOB_DIR, digest[:2], digest)
+
+    def derivative_path(self, digest, kind):
+        """Where a rendition of the blob with this digest is stored"""
+        return f'{self.blob_path(digest)}.{kind}{DERIVATIVE_EXT}'
+
+    @staticmethod
+    def _remove_derivatives(blob_path):
+        """Delete a blob's renditions; returns the bytes freed"""
+        freed = 0
+        for path in glob.glob(f'{glob.escape(blob_path)}.*{DERIVATIVE_EXT}'):
+            try:
+                freed += os.stat(path).st_size
+                os.remove(path)
+            except OSError:
+                pass
+        return freed
+
+    def touch(self, filepath):
+        """Mark an upload as recently used (shared by every link to the blob)"""
+        try:
+            os.utime(filepath)
+        except OSError:
+            pass
+
+    # Storing and deleting
+
+    def store(self, stream, name, ext):
+        """Move a finished HashingFileStream into place; returns (filepath, filename)"""
+        digest = stream.digest
+        blob_path = self.blob_path(digest)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+
+        stream.finalized = True
+        if stream.path is not None:
+            stream.close()
+
+        # Add timestamp to avoid conflicts, and a hash prefix to find the blob again
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        unique_filename = f"{name}_{timestamp}_{digest[:12]}{ext}"
+
+        filepath = os.path.join(self.root, self.relative_path(unique_filename))
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        try:
+            for _ in range(3):
+                self._place_blob(stream, blob_path)
+                try:
+                    os.link(blob_path, filepath)
+                except FileExistsError:
+                    pass  # same name, second and content - already the file we want
+                except FileNotFoundError:
+                    continue  # the sweeper reaped an orphaned blob just now: put it back
+                except OSError:
+                    shutil.copyfile(blob_path, filepath)  # filesystem without hard links
+                break
+        finally:
+            # The upload's own copy is kept until it is linked, so a reaped blob can be restored
+            if stream.path is not None and os.path.exists(stream.path):
+                os.remove(stream.path)
+        self.touch(filepath)
+        return filepath, unique_filename
+
+    @staticmethod
+    def _place_blob(stream, blob_path):
+        """Make sure the blob exists, from the upload on disk or in memory (atomically, in case of a twin)"""
+        if os.path.exists(blob_path):
+            return
+        if stream.path is not None:
+            try:
+                os.link(stream.path, blob_path)
+                return
+            except FileExistsError:
+                return
+            except OSError:
+                pass  # filesystem without hard links: copy it instead
+        tmp_path = f"{blob_path}.{uuid.uuid4().hex}{TMP_SUFFIX}"
+        if stream.path is not None:
+            shutil.copyfile(stream.path, tmp_path)
+        else:
+            stream.seek(0)
+            with open(tmp_path, 'wb') as f:
+                shutil.copyfileobj(stream, f)
+            stream.seek(0)
+        os.replace(tmp_path, blob_path)
+
+    def _find_blob(self, filepath):
+        """Return the blob hard-linked to an upload, if it has one"""
+        prefix = _digest_prefix(os.path.basename(filepath))
+        if prefix is None:
+            return None
+        for candidate in glob.glob(os.path.join(self.root, BLOB_DIR, prefix[:2], prefix + '*')):
+            if os.path.samefile(candidate, filepath):
+                return candidate
+        return None
+
+    def delete(self, filepath):
+        """Remove an upload; returns the bytes freed (the blob goes with its last link)"""
+        blob_path = self._find_blob(filepath)
+        size = os.stat(filepath).st_size
+        os.remove(filepath)
+        if blob_path is None:
+            return size
+        if os.stat(blob_path).st_nlink <= 1:
+            os.remove(blob_path)
+            return size + self._remove_derivatives(blob_path)
+        return 0
+
+    # Sweeping
+
+    def _iter_uploads(self):
+        """Yield (path, stat) for every upload link, flat or sharded"""
+        for entry in os.scandir(self.root):
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                for sub in os.scandir(entry.path):
+                    if sub.is_file(follow_symlinks=False) and not sub.name.startswith('.'):
+                        yield sub.path, sub.stat()
+            elif entry.is_file(follow_symlinks=False):
+                yield entry.path, entry.stat()
+
+    def _iter_blobs(self, derivatives=False):
+        """Yield (path, stat) for every blob, or with derivatives=True for every blob rendition"""
+        blob_root = os.path.join(self.root, BLOB_DIR)
+        if not os.path.isdir(blob_root):
+            return
+        for shard in os.scandir(blob_root):
+            if shard.is_dir(follow_symlinks=False):
+                for blob in os.scandir(shard.path):
+                    # Temp files are still being written; only the sweeper's age check touches them
+                    if not blob.name.endswith(TMP_SUFFIX) and blob.name.endswith(DERIVATIVE_EXT) == derivatives:
+                        yield blob.path, blob.stat()
+
+    def _iter_temp_files(self):
+        """Yield (path, stat) for every blob or rendition still being written"""
+        blob_root = os.path.join(self.root, BLOB_DIR)
+        if not os.path.isdir(blob_root):
+            return
+        for shard in os.scandir(blob_root):
+            if shard.is_dir(follow_symlinks=False):
+                for entry in os.scandir(shard.path):
+                    if entry.name.endswith(TMP_SUFFIX):
+                        yield entry.path, entry.stat()
+
+    def usage(self):
+        """Current number of uploads and blobs and the bytes they occupy on disk"""
+        uploads = sum(1 for _ in self._iter_uploads())
+        blobs = 0
+        blob_bytes = 0
+        for _, st in self._iter_blobs():
+            blobs += 1
+            blob_bytes += st.st_size
+        legacy_bytes = sum(st.st_size for _, st in self._iter_uploads() if st.st_nlink == 1)
+        derivative_bytes = sum(st.st_size for _, st in self._iter_blobs(derivatives=True))
+        return {'uploads': uploads, 'blobs': blobs, 'bytes': blob_bytes + legacy_bytes + derivative_bytes}
+
+    def sweep(self):
+        """Apply the age limit and quota once; returns what was reclaimed"""
+        started = time.time()
+        report = {'expired': 0, 'orphaned_blobs': 0, 'abandoned_partials': 0, 'evicted': 0, 'bytes_reclaimed': 0}
+
+        # Abandoned partial uploads
+        for entry in os.scandir(self.root):
+            if entry.name.startswith(INCOMING_PREFIX) and started - entry.stat().st_mtime > INCOMING_MAX_AGE:
+                report['bytes_reclaimed'] += entry.stat().st_size
+                os.remove(entry.path)
+                report['abandoned_partials'] += 1
+        for path, st in list(self._iter_temp_files()):
+            if started - st.st_mtime > INCOMING_MAX_AGE:
+                report['bytes_reclaimed'] += st.st_size
+                os.remove(path)
+                report['abandoned_partials'] += 1
+
+        # Uploads past their maximum age
+        if self.max_age:
+            for path, st in list(self._iter_uploads()):
+                if started - st.st_mtime > self.max_age:
+                    report['bytes_reclaimed'] += self.delete(path)
+                    report['expired'] += 1
+
+        # Blobs no upload links to any more (new ones may be linked any moment)
+        blobs = []
+        for path, st in list(self._iter_blobs()):
+            if st.st_nlink <= 1 and started - st.st_mtime > ORPHAN_GRACE:
+                report['bytes_reclaimed'] += st.st_size + self._remove_derivatives(path)
+                os.remove(path)
+                report['orphaned_blobs'] += 1
+            else:
+                blobs.append((st.st_mtime, st.st_size, path))
+
+        # Renditions whose blob is gone (e.g. rendered while it was being deleted)
+        for path, st in list(self._iter_blobs(derivatives=True)):
+            blob_path = os.path.join(os.path.dirname(path), os.path.basename(path).split('.', 1)[0])
+            if not os.path.exists(blob_path):
+                report['bytes_reclaimed'] += st.st_size
+                os.remove(path)
+
+        # Quota: evict least recently used blobs, with all their links, down to 90%
+        if self.quota_bytes:
+            # The same total as usage(): blobs, unshared legacy uploads and renditions
+            total = sum(size for _, size, _ in blobs)
+            total += sum(st.st_size for _, st in self._iter_uploads() if st.st_nlink == 1)
+            total += sum(st.st_size for _, st in self._iter_blobs(derivatives=True))
+            if total > self.quota_bytes:
+                target = self.quota_bytes * 0.9
+                for _, size, path in sorted(blobs):
+                    if total <= target:
+                        break
+                    digest = os.path.basename(path)
+                    shard_dir = os.path.join(self.root, digest[:2])
+                    for link in glob.glob(os.path.join(shard_dir, f'*_{digest[:12]}.*')):
+                        os.remove(link)
+                        report['evicted'] += 1
+                    os.remove(path)
+                    freed = size + self._remove_derivatives(path)
+                    total -= freed
+                    report['bytes_reclaimed'] += freed
+
+        report['finished_at'] = time.time()
+        report['duration'] = round(report['finished_at'] - started, 3)
+        return report
+
+    def maybe_sweep(self):
+        """Sweep if no other worker is sweeping and none swept within the interval"""
+        with open(self.lock_path, 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+            try:
+                last = self.last_report()
+                if last and time.time() - last.get('finished_at', 0) < self.sweep_interval:
+                    return None
+                report = self.sweep()
+                tmp_path = f'{self.report_path}.{os.getpid()}.tmp'
+                with open(tmp_path, 'w') as f:
+                    json.dump(report, f)
+                os.replace(tmp_path, self.report_path)
+                return report
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def last_report(self):
+        try:
+            with open(self.report_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def start_sweeper(self):
+        """Start this process's background sweeper thread (once per worker)"""
+        if not self.sweep_interval or self._sweeper_pid == os.getpid():
+            return
+        with self._sweeper_lock:
+            if self._sweeper_pid == os.getpid():
+                return
+            self._sweeper_pid = os.getpid()
+            threading.Thread(target=self._sweep_loop, name='upload-sweeper', daemon=True).start()
+
+    def _sweep_loop(self):
+        while True:
+            # Jitter spreads workers out so they rarely contend for the lock
+            time.sleep(self.sweep_interval * random.uniform(0.5, 1.0))
+            try:
+                report = self.maybe_sweep()
+                if report and report['bytes_reclaimed']:
+                    print(f"Upload sweep reclaimed {report['bytes_reclaimed']} bytes: {report}")
+            except Exception as e:
+                print(f"Upload sweep failed: {e}")
+
+
+def init_upload_storage(app):
+    """Attach the upload storage manager and start its sweeper with each worker"""
+    storage = UploadStorage(
+        app.config['UPLOAD_FOLDER'],
+        app.config['DATA_FOLDER'],
+        max_age=app.config['UPLOAD_MAX_AGE'],
+        quota_bytes=app.config['UPLOAD_QUOTA_BYTES'],
+        sweep_interval=app.config['UPLOAD_SWEEP_INTERVAL'],
+    )
+    app.extensions['upload_storage'] = storage
+
+    # Started on the first request so each forked worker gets its own thread
+    app.before_request(storage.start_sweeper)
+
+
+def get_upload_storage():
+    return current_app.extensions['upload_storage']
@@ -1,8 +1,12 @@
 // Global state
 let currentFile = null;
 let currentFilename = null;
+let currentPreview = null;
 let extractedData = null;
 let isEditing = false;
+let uploadConfig = null;
+let resizeWorker = null;
+let resizeRequests = 0;
 
 // DOM Elements
 const uploadSection = document.getElementById("uploadSection");
@@ -29,8 +33,21 @@ const toastMessage = document.getElementById("toastMessage");
 // Initialize
 document.addEventListener("DOMContentLoaded", () => {
   setupEventListeners();
+  loadUploadConfig();
 });
 
+async function loadUploadConfig() {
+  // Upload limits and the size the server scales images to
+  try {
+    const response = await fetch("/api/config");
+    if (response.ok) {
+      uploadConfig = await response.json();
+    }
+  } catch (err) {
+    console.error("Error loading upload config:", err);
+  }
+}
+
 function setupEventListeners() {
   // Drag and drop
   dropZone.addEventListener("dragover", handleDragOver);
@@ -78,10 +95,10 @@ function handleFileSelect(e) {
 }
 
 function handleFile(file) {
-  // Validate file size
-  const maxSize = 16 * 1024 * 1024; // 16MB
-  if (file.size > maxSize) {
-    showToast("File too large. Maximum size is 16MB.", "error");
+  // Validate file size (larger files are fine when the browser will shrink them first)
+  const maxSize = uploadConfig ? uploadConfig.max_upload_bytes : 16 * 1024 * 1024;
+  if (file.size > maxSize && !canResizeInBrowser()) {
+    showToast(`File too large. Maximum size is ${formatFileSize(maxSize)}.`, "error");
     return;
   }
 
@@ -120,6 +137,53 @@ function displayFilePreview(file) {
   filePreview.classList.remove("hidden");
 }
 
+function canResizeInBrowser() {
+  return Boolean(
+    uploadConfig && window.Worker && window.OffscreenCanvas && window.createImageBitmap
+  );
+}
+
+function prepareUpload(file) {
+  // Decode, orient, downscale and re-encode the image in a Web Worker to what
+  // the server would scale it to anyway. Resolves to the file to upload: the
+  // original when the browser lacks the APIs, shrinking fails or doesn't help.
+  if (!canResizeInBrowser() || file.type === "image/gif") {
+    return Promise.resolve(file);
+  }
+  try {
+    resizeWorker = resizeWorker || new Worker("/static/js/resize-worker.js");
+  } catch (err) {
+    console.error("Error starting resize worker:", err);
+    return Promise.resolve(file);
+  }
+
+  const { max_side: maxSide, format, quality } = uploadConfig.client_resize;
+  const id = ++resizeRequests;
+  return new Promise((resolve) => {
+    const finish = (result) => {
+      clearTimeout(timer);
+      resizeWorker.removeEventListener("message", onMessage);
+      resolve(result);
+    };
+    const onMessage = (e) => {
+      if (e.data.id !== id) return;
+      if (e.data.error) {
+        console.error("Error resizing image:", e.data.error);
+        finish(file);
+      } else if (e.data.blob.size >= file.size) {
+        finish(file);
+      } else {
+        const extension = e.data.blob.type === "image/webp" ? "webp" : "jpg";
+        const name = `${file.name.replace(/\.[^.]*$/, "")}.${extension}`;
+        finish(new File([e.data.blob], name, { type: e.data.blob.type }));
+      }
+    };
+    const timer = setTimeout(() => finish(file), 15000);
+    resizeWorker.addEventListener("message", onMessage);
+    resizeWorker.postMessage({ id, file, maxSide, type: format, quality });
+  });
+}
+
 function resetUpload() {
   currentFile = null;
   fileInput.value = "";
@@ -136,12 +200,22 @@ async function analyzeFile() {
 
   analyzeBtn.disabled = true;
   analyzeBtn.innerHTML =
-    '<i class="fas fa-spinner fa-spin mr-2"></i>Uploading...';
+    '<i class="fas fa-spinner fa-spin mr-2"></i>Preparing...';
 
   try {
+    // Shrink the image before it goes over the network
+    const uploadFile = await prepareUpload(currentFile);
+    if (uploadConfig && uploadFile.size > uploadConfig.max_upload_bytes) {
+      throw new Error(
+        `File too large. Maximum size is ${formatFileSize(uploadConfig.max_upload_bytes)}.`
+      );
+    }
+    analyzeBtn.innerHTML =
+      '<i class="fas fa-spinner fa-spin mr-2"></i>Uploading...';
+
     // Upload file
     const formData = new FormData();
-    formData.append("file", currentFile);
+    formData.append("file", uploadFile);
 
     const uploadResponse = await fetch("/api/upload", {
       method: "POST",
@@ -161,6 +235,12 @@ async function analyzeFile() {
 
     const uploadData = await uploadResponse.json();
     currentFilename = uploadData.filename;
+    currentPreview = uploadData.preview_url
+      ? { url: uploadData.preview_url, placeholder: uploadData.placeholder_url }
+      : null;
+    if (uploadData.near_duplicate) {
+      showToast("This looks like a re-scan of an image analyzed before.", "info");
+    }
 
     // Show loading section
     uploadSection.classList.add("hidden");
@@ -169,6 +249,13 @@ async function analyzeFile() {
     // Animate progress bar
     animateProgress();
 
+    // Stream the analysis, showing each field as soon as it is complete
+    const streamed = await streamAnalysis(currentFilename);
+    if (streamed) {
+      extractedData = streamed;
+      return;
+    }
+
     // Analyze file
     const analyzeResponse = await fetch("/api/analyze", {
       method: "POST",
@@ -190,7 +277,9 @@ async function analyzeFile() {
     }
 
     const analyzeData = await analyzeResponse.json();
-    extractedData = analyzeData.result;
+    extractedData = analyzeData.job_id
+      ? await waitForJob(analyzeData.status_url)
+      : analyzeData.result;
 
     // Show results
     setTimeout(() => {
@@ -203,6 +292,109 @@ async function analyzeFile() {
   }
 }
 
+async function streamAnalysis(filename) {
+  // Server-sent events from /api/analyze/stream; returns null to fall back to a job
+  const response = await fetch("/api/analyze/stream", {
+    method: "POST",
+    headers: {
+      "Content-Type": "application/json",
+    },
+    body: JSON.stringify({ filename }),
+  });
+
+  if (response.status === 404 || response.status === 405 || !response.body) {
+    return null;
+  }
+  if (!response.ok) {
+    let errorMessage = "Analysis failed";
+    try {
+      const data = await response.json();
+      errorMessage = data.error || errorMessage;
+    } catch (e) {
+      errorMessage = `Server error (${response.status})`;
+    }
+    throw new Error(errorMessage);
+  }
+
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = "";
+  let fieldsShown = false;
+
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) {
+      throw new Error("The analysis stream ended unexpectedly");
+    }
+    buffer += decoder.decode(value, { stream: true });
+
+    let boundary;
+    while ((boundary = buffer.indexOf("\n\n")) !== -1) {
+      const message = buffer.slice(0, boundary);
+      buffer = buffer.slice(boundary + 2);
+
+      let event = "message";
+      let data = "";
+      for (const line of message.split("\n")) {
+        if (line.startsWith("event: ")) event = line.slice(7);
+        else if (line.startsWith("data: ")) data += line.slice(6);
+      }
+      if (!data) continue; // keep-alive comment
+
+      const payload = JSON.parse(data);
+      if (event === "field") {
+        displayField(payload, !fieldsShown);
+        fieldsShown = true;
+      } else if (event === "done") {
+        reader.cancel();
+        if (fieldsShown) {
+          finishStreamedResults(payload.result);
+        } else {
+          displayResults(payload.result);
+        }
+        return payload.result;
+      } else if (event === "error") {
+        reader.cancel();
+        throw new Error(payload.error || "Analysis failed");
+      }
+    }
+  }
+}
+
+const jobStageText = {
+  queued: "Waiting for an analysis slot...",
+  uploading: "Sending image to AI model...",
+  "model-running": "Analyzing content...",
+};
+
+async function waitForJob(statusUrl) {
+  // Poll the job until it finishes; polling works with any worker class
+  while (true) {
+    await new Promise((resolve) => setTimeout(resolve, 1000));
+
+    const jobResponse = await fetch(statusUrl);
+    let job;
+    try {
+      job = await jobResponse.json();
+    } catch (e) {
+      throw new Error(`Server error (${jobResponse.status})`);
+    }
+
+    if (!jobResponse.ok) {
+      throw new Error(job.error || "Could not check analysis status");
+    }
+    if (job.status === "done") {
+      return job.result;
+    }
+    if (job.status === "failed") {
+      throw new Error(job.error || "Analysis failed");
+    }
+    if (jobStageText[job.status]) {
+      loadingText.textContent = jobStageText[job.status];
+    }
+  }
+}
+
 function animateProgress() {
   let progress = 0;
   const texts = [
@@ -229,11 +421,18 @@ function animateProgress() {
   }, 100);
 }
 
-function displayResults(data) {
+function showResultsSection() {
   loadingSection.classList.add("hidden");
   resultsSection.classList.remove("hidden");
 
-  // Display the uploaded image
+  // Display the uploaded image: the server's cached preview, shown over its
+  // tiny placeholder until it loads, or the local file if there is none
+  if (currentPreview) {
+    resultImagePreview.innerHTML = `
+      <img src="${currentPreview.url}" alt="Uploaded Image" decoding="async" class="max-w-full h-auto rounded-lg shadow-md mx-auto" style="max-height: 500px; background: url('${currentPreview.placeholder}') center / cover no-repeat;">
+    `;
+    return;
+  }
   const reader = new FileReader();
   reader.onload = (e) => {
     resultImagePreview.innerHTML = `
@@ -241,6 +440,10 @@ function displayResults(data) {
     `;
   };
   reader.readAsDataURL(currentFile);
+}
+
+function displayResults(data) {
+  showResultsSection();
 
   extractedContent.innerHTML = "";
 
@@ -255,15 +458,45 @@ function displayResults(data) {
   showToast("Analysis completed successfully!", "success");
 }
 
-function createContentBlock(title, content, id) {
+function displayField(field, first) {
+  // Append one streamed field, opening the results on the first one
+  if (first) {
+    showResultsSection();
+    extractedContent.innerHTML = "";
+    extractedContent.appendChild(
+      createContentBlock("Extracted Content", "", "single")
+    );
+  }
+  const block = document.getElementById("content-single");
+  const corrected = field.corrections
+    .map((c) => c.struck)
+    .join(", ");
+  block.textContent +=
+    cleanContent(`${field.name}: ${field.value}`) +
+    (corrected ? ` (corrected from ${corrected})` : "") +
+    "\n";
+}
+
+function finishStreamedResults(data) {
+  // Replace the streamed fields with the full answer, including any non-field lines
+  document.getElementById("content-single").textContent = cleanContent(
+    data.content
+  );
+  progressBar.style.width = "100%";
+  showToast("Analysis completed successfully!", "success");
+}
+
+function cleanContent(content) {
   // Clean up content - remove markdown formatting
-  let cleanContent = content
+  return content
     .replace(/\*\*/g, "") // Remove bold markers
     .replace(/\*/g, "") // Remove asterisks
     .replace(/#{1,6}\s/g, "") // Remove markdown headers
     .replace(/`{1,3}/g, "") // Remove code markers
     .trim();
+}
 
+function createContentBlock(title, content, id) {
   const div = document.createElement("div");
   div.className = "bg-gray-50 rounded-lg p-6";
   div.innerHTML = `
@@ -272,7 +505,7 @@ function createContentBlock(title, content, id) {
         </h3>
         <div class="content-editable bg-white rounded-lg p-4 border border-gray-200 min-h-[200px] whitespace-pre-wrap font-mono text-sm" 
              id="content-${id}" 
-             contenteditable="false">${escapeHtml(cleanContent)}</div>
+             contenteditable="false">${escapeHtml(cleanContent(content))}</div>
     `;
   return div;
 }
@@ -353,6 +586,7 @@ function resetAll() {
   // Reset state
   currentFile = null;
   currentFilename = null;
+  currentPreview = null;
   extractedData = null;
   isEditing = false;
 
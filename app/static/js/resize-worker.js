@@ -0,0 +1,30 @@
+// Shrinks an image off the main thread before upload.
+// Receives { id, file, maxSide, type, quality }; replies { id, blob, width, height } or { id, error }.
+self.addEventListener("message", async (e) => {
+  const { id, file, maxSide, type, quality } = e.data;
+  try {
+    // Decodes and applies the EXIF orientation, so the pixels arrive upright
+    const bitmap = await createImageBitmap(file, { imageOrientation: "from-image" });
+    const scale = maxSide ? Math.min(1, maxSide / Math.max(bitmap.width, bitmap.height)) : 1;
+    const width = Math.max(1, Math.round(bitmap.width * scale));
+    const height = Math.max(1, Math.round(bitmap.height * scale));
+
+    const canvas = new OffscreenCanvas(width, height);
+    const context = canvas.getContext("2d");
+    // Flatten transparent areas onto white, as the server does
+    context.fillStyle = "#fff";
+    context.fillRect(0, 0, width, height);
+    context.imageSmoothingQuality = "high";
+    context.drawImage(bitmap, 0, 0, width, height);
+    bitmap.close();
+
+    let blob = await canvas.convertToBlob({ type, quality });
+    if (blob.type !== type) {
+      // Browsers without a WebP encoder hand back PNG; JPEG is always available
+      blob = await canvas.convertToBlob({ type: "image/jpeg", quality });
+    }
+    self.postMessage({ id, blob, width, height });
+  } catch (error) {
+    self.postMessage({ id, error: String(error) });
+  }
+});
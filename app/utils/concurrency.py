@@ -0,0 +1,19 @@
+import sys
+
+
+def gevent_patched():
+    """True when running under a gevent worker that has monkey-patched threading"""
+    monkey = sys.modules.get('gevent.monkey')
+    return monkey is not None and monkey.is_module_patched('threading')
+
+
+def run_blocking(func, *args, **kwargs):
+    """Run CPU-bound work (image decoding, encoding) without stalling other requests
+
+    Under gevent every request shares one OS thread, so the work goes to the
+    hub's native thread pool; with sync or gthread workers it runs inline.
+    """
+    if gevent_patched():
+        import gevent
+        return gevent.get_hub().threadpool.apply(func, args, kwargs)
+    return func(*args, **kwargs)
@@ -1,35 +1,250 @@
+import hashlib
+import io
 import os
+import shutil
+import uuid
+from flask import Request, current_app
+from PIL import ImageFile
 from werkzeug.utils import secure_filename
-from flask import current_app
+from app.services.metrics import timed
+from app.services.storage import get_upload_storage
+
+# Magic-byte signatures of the image types we accept, mapped to their extensions
+IMAGE_SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', {'png'}),
+    (b'\xff\xd8\xff', {'jpg', 'jpeg'}),
+    (b'GIF87a', {'gif'}),
+    (b'GIF89a', {'gif'}),
+    (b'BM', {'bmp'}),
+)
+SNIFF_BYTES = 16
+# Headers of every supported format fit well inside this; stop parsing after it
+HEADER_PARSE_LIMIT = 256 * 1024
+
+
+class UploadRejected(Exception):
+    """Raised while an upload is still streaming in, to stop reading it early"""
+
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def sniff_image_type(header):
+    """Return the set of extensions matching the file's magic bytes, or None"""
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return {'webp'}
+    for signature, extensions in IMAGE_SIGNATURES:
+        if header.startswith(signature):
+            return extensions
+    return None
+
+
+class HashingFileStream:
+    """Upload sink that writes straight into the upload folder
+
+    Werkzeug's multipart parser writes each chunk here as it arrives, so the
+    content hash, size and type sniff are computed in the same pass and a
+    bad upload is rejected before the rest of the body is read. The sniffed
+    type must match the filename's extension, and the header must parse to
+    image dimensions.
+    """
+
+    def __init__(self, directory, max_size=None, max_pixels=None, strict=True, filename=None):
+        # Without a directory the upload is kept in memory (analyze-without-saving mode)
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self.path = os.path.join(directory, f'.incoming-{uuid.uuid4().hex}')
+        else:
+            self.path = None
+        self.max_size = max_size
+        self.max_pixels = max_pixels
+        self.size = 0
+        self.image_type = None
+        self.image_size = None
+        self.finalized = False
+        self.strict = strict
+        self.extension = filename.rsplit('.', 1)[1].lower() if filename and '.' in filename else None
+        self.rejection = None
+        self._hash = hashlib.sha256()
+        self._header = b''
+        self._parser = ImageFile.Parser()
+        self._file = open(self.path, 'w+b') if self.path else io.BytesIO()
+
+    @property
+    def digest(self):
+        return self._hash.hexdigest()
+
+    def write(self, data):
+        if self.rejection:
+            return len(data)  # lenient mode: drain the part without storing it
+        self.size += len(data)
+        if self.max_size and self.size > self.max_size:
+            self._reject(f'File too large. Maximum size is {self.max_size // (1024 * 1024)}MB.', 413)
+
+        self._inspect(data)
+        if self.rejection:
+            return len(data)
+        self._hash.update(data)
+        return self._file.write(data)
+
+    def _inspect(self, data):
+        """Sniff the type from the first bytes and the dimensions from the header"""
+        if self.image_type is None:
+            self._header += data[:SNIFF_BYTES]
+            if len(self._header) < SNIFF_BYTES:
+                return
+            self._check_type()
+
+        if self.rejection:
+            return
+        if self._parser is not None and self.size - len(data) < HEADER_PARSE_LIMIT:
+            try:
+                self._parser.feed(data)
+            except Exception:
+                self._reject('File is not a valid image.')
+            if self._parser.image is not None:
+                self.image_size = self._parser.image.size
+                self._parser = None
+                width, height = self.image_size
+                if self.max_pixels and width * height > self.max_pixels:
+                    self._reject(f'Image dimensions too large ({width}x{height}).', 413)
+
+    def _check_type(self):
+        self.image_type = sniff_image_type(self._header)
+        if self.image_type is None:
+            self._reject('File is not a supported image.')
+        elif self.extension and self.extension not in self.image_type:
+            self._reject(f'File content does not match its .{self.extension} extension.')
+
+    def _reject(self, message, status_code=400):
+        """Stop storing this upload; strict streams also abort the request body"""
+        self.discard()
+        self.rejection = UploadRejected(message, status_code)
+        if self.strict:
+            raise self.rejection
+
+    def check_complete(self):
+        """Validate anything that could not be decided while streaming"""
+        if self.rejection:
+            raise self.rejection
+        if self.image_type is None:
+            self._check_type()
+        if self.image_size is None and not self.rejection:
+            # The header never yielded dimensions: truncated, or not really an image
+            self._reject('File is not a valid image.')
+        if self.rejection:
+            raise self.rejection
+
+    def read(self, *args):
+        return self._file.read(*args)
+
+    def readline(self, *args):
+        return self._file.readline(*args)
+
+    def seek(self, *args):
+        return self._file.seek(*args)
+
+    def tell(self):
+        return self._file.tell()
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        """Close the handle; an upload that was never saved is deleted"""
+        if not self._file.closed:
+            self._file.close()
+        if not self.finalized:
+            self.discard()
+
+    def discard(self):
+        """Delete the partial file; later reads see an empty stream"""
+        if not self._file.closed:
+            self._file.close()
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+        self._file = io.BytesIO()
+
+
+class UploadRequest(Request):
+    """Request class that streams uploaded files through HashingFileStream"""
+
+    # Endpoints taking several files report bad ones per file instead of failing the request
+    lenient_endpoints = {'api.analyze_batch'}
+    # Endpoints that decode uploads from memory and only write them to disk on request
+    in_memory_endpoints = {'api.analyze_file', 'api.analyze_stream'}
+
+    def _load_form_data(self):
+        # Form parsing is where the body is received, hashed and checked
+        with timed('upload.receive'):
+            super()._load_form_data()
+    
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        config = current_app.config
+        in_memory = self.endpoint in self.in_memory_endpoints
+        return HashingFileStream(
+            None if in_memory else config['UPLOAD_FOLDER'],
+            max_size=config['MAX_CONTENT_LENGTH'],
+            max_pixels=config['UPLOAD_MAX_PIXELS'],
+            strict=self.endpoint not in self.lenient_endpoints,
+            filename=filename
+        )
+
 
 def allowed_file(filename):
     """Check if file extension is allowed"""
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in current_app.config['ALLOWED_EXTENSIONS']
 
+def ingest_upload(file):
+    """Return a finished HashingFileStream for any uploaded file object"""
+    if isinstance(file.stream, HashingFileStream):
+        stream = file.stream
+    else:
+        # Not parsed by UploadRequest (e.g. constructed in code): hash while copying
+        config = current_app.config
+        stream = HashingFileStream(
+            config['UPLOAD_FOLDER'],
+            max_size=config['MAX_CONTENT_LENGTH'],
+            max_pixels=config['UPLOAD_MAX_PIXELS'],
+            filename=file.filename
+        )
+        with timed('upload.receive'):
+            shutil.copyfileobj(file.stream, stream)
+    stream.flush()
+    stream.check_complete()
+    return stream
+
+def upload_path(filename):
+    """Absolute path of an upload by filename, or None if the name is invalid"""
+    return get_upload_storage().path_for(filename)
+
+def upload_url_path(filename):
+    """Path of an upload below /static, for url_for"""
+    return f"uploads/{get_upload_storage().relative_path(filename)}"
+
 def save_file(file):
-    """Save uploaded file and return the filepath"""
+    """Save uploaded file and return the filepath
+
+    Identical uploads share one stored blob: each upload gets its own
+    filename, hard-linked to the blob named by the content hash.
+    """
     if file and allowed_file(file.filename):
         filename = secure_filename(file.filename)
-        # Add timestamp to avoid conflicts
-        from datetime import datetime
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
         name, ext = os.path.splitext(filename)
-        unique_filename = f"{name}_{timestamp}{ext}"
         
-        filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], unique_filename)
-        file.save(filepath)
-        return filepath, unique_filename
+        stream = ingest_upload(file)
+        with timed('upload.store'):
+            return get_upload_storage().store(stream, name, ext)
     return None, None
 
 def cleanup_file(filepath):
-    """Delete file from filesystem"""
+    """Delete file from filesystem, and its blob once no upload refers to it"""
     try:
         if filepath and os.path.exists(filepath):
-            os.remove(filepath)
+            get_upload_storage().delete(filepath)
             return True
     except Exception as e:
         print(f"Error deleting file: {e}")
     return False
-
-
@@ -0,0 +1,240 @@
+import io
+import math
+from PIL import Image, ImageChops, ImageOps
+
+# Output formats the model accepts, with their MIME types
+OUTPUT_FORMATS = {
+    'JPEG': 'image/jpeg',
+    'WEBP': 'image/webp',
+}
+
+
+class PreparedImage:
+    """Encoded image ready to send to the model"""
+
+    __slots__ = ('data', 'mime_type', 'size', 'original_size', 'quality', 'grayscale')
+
+    def __init__(self, data, mime_type, size, original_size, quality, grayscale):
+        self.data = data
+        self.mime_type = mime_type
+        self.size = size
+        self.original_size = original_size
+        self.quality = quality
+        self.grayscale = grayscale
+
+    def as_part(self):
+        """Inline blob in the shape generate_content expects"""
+        return {'mime_type': self.mime_type, 'data': self.data}
+
+
+def is_effectively_grayscale(img, tolerance=12):
+    """True when no pixel's colour channels differ by more than tolerance
+
+    Checked on a small copy so coloured ink (corrections, stamps) keeps the
+    image in colour while plain scans drop two thirds of their pixel data.
+    """
+    if img.mode in ('1', 'L', 'LA', 'I', 'F'):
+        return True
+    sample = img.convert('RGB')
+    sample.thumbnail((256, 256))
+    r, g, b = sample.split()
+    return max(
+        ImageChops.difference(r, g).getextrema()[1],
+        ImageChops.difference(g, b).getextrema()[1],
+    ) <= tolerance
+
+
+def load_image(source, max_size):
+    """Decode an image at reduced scale where the codec allows it, upright and bounded"""
+    img = Image.open(source)
+    original_size = img.size
+
+    # JPEG can decode directly at 1/2, 1/4 or 1/8 scale - far cheaper than a full decode.
+    # draft() never goes below the requested size, so ask for the final thumbnail size.
+    if img.format == 'JPEG' and max(original_size) > max_size:
+        ratio = max_size / max(original_size)
+        img.draft(None, (int(original_size[0] * ratio), int(original_size[1] * ratio)))
+
+    img = ImageOps.exif_transpose(img)
+
+    if max(img.size) > max_size:
+        img.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+
+    return img, original_size
+
+
+def _flatten(img):
+    """Drop alpha/palette so the image can be saved as JPEG/WebP"""
+    if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+        img = img.convert('RGBA')
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel('A'))
+        return background
+    if img.mode not in ('RGB', 'L'):
+        return img.convert('RGB')
+    return img
+
+
+def _encode(img, fmt, quality):
+    buffer = io.BytesIO()
+    img.save(buffer, format=fmt, quality=quality)
+    return buffer.getvalue()
+
+
+def encode_to_budget(img, fmt='JPEG', byte_budget=300 * 1024, min_quality=50, max_quality=85):
+    """Binary-search the highest quality whose encoding fits byte_budget
+
+    Returns (data, quality). If even min_quality is over budget, that
+    encoding is returned anyway - the budget is a target, not a hard cap.
+    """
+    data = _encode(img, fmt, max_quality)
+    if len(data) <= byte_budget:
+        return data, max_quality
+
+    best = None
+    low, high = min_quality, max_quality - 1
+    while low <= high:
+        quality = (low + high) // 2
+        candidate = _encode(img, fmt, quality)
+        if len(candidate) <= byte_budget:
+            best = (candidate, quality)
+            low = quality + 1
+        else:
+            high = quality - 1
+
+    if best is None:
+        return _encode(img, fmt, min_quality), min_quality
+    return best
+
+
+def preprocess_image(source, max_size=1536, fmt='JPEG', byte_budget=300 * 1024,
+                     min_quality=50, max_quality=85, grayscale=True):
+    """Decode, orient, downscale and re-encode an image for upload to the model"""
+    fmt = fmt.upper()
+    if fmt not in OUTPUT_FORMATS:
+        raise ValueError(f"Unsupported preprocessing format: {fmt}")
+
+    img, original_size = load_image(source, max_size)
+    img = _flatten(img)
+
+    is_gray = grayscale and is_effectively_grayscale(img)
+    if is_gray and img.mode != 'L':
+        img = img.convert('L')
+
+    data, quality = encode_to_budget(img, fmt, byte_budget, min_quality, max_quality)
+    return PreparedImage(data, OUTPUT_FORMATS[fmt], img.size, original_size, quality, is_gray)
+
+
+def render_previews(source, sizes, quality=75):
+    """WebP renditions of an image for display, from one reduced-scale decode
+
+    sizes maps each rendition's name to its longest side in pixels; returns
+    a dict of the same names to encoded bytes.
+    """
+    img, _ = load_image(source, max(sizes.values()))
+    img = _flatten(img)
+
+    renditions = {}
+    for name, side in sizes.items():
+        rendition = img
+        if max(img.size) > side:
+            rendition = img.copy()
+            rendition.thumbnail((side, side), Image.Resampling.LANCZOS)
+        renditions[name] = _encode(rendition, 'WEBP', quality)
+    return renditions
+
+
+def tile_boxes(width, height, tile_size, overlap):
+    """Crop boxes covering the image in reading order, overlapping neighbours by overlap pixels"""
+    def spans(length):
+        if length <= tile_size:
+            return [(0, length)]
+        count = math.ceil((length - overlap) / (tile_size - overlap))
+        step = (length - tile_size) / (count - 1)
+        return [(round(i * step), round(i * step) + tile_size) for i in range(count)]
+
+    return [(left, top, right, bottom) for top, bottom in spans(height) for left, right in spans(width)]
+
+
+def preprocess_tiles(source, min_side=3072, overlap=0.1, max_tiles=6, max_size=1536, fmt='JPEG',
+                     byte_budget=300 * 1024, min_quality=50, max_quality=85, grayscale=True):
+    """Cut a large image into overlapping tiles, each prepared like preprocess_image
+
+    Tiles are max_size pixels square at full resolution, so small handwriting
+    survives that a single downscaled image would lose. When more than
+    max_tiles would be needed the tiles grow (and are downscaled to max_size).
+    Returns None for images whose longest side is under min_side.
+    """
+    fmt = fmt.upper()
+    if fmt not in OUTPUT_FORMATS:
+        raise ValueError(f"Unsupported preprocessing format: {fmt}")
+
+    img = Image.open(source)
+    original_size = img.size
+    if max(original_size) < min_side:
+        return None
+    img = _flatten(ImageOps.exif_transpose(img))
+
+    crop_size = max_size
+    while True:
+        boxes = tile_boxes(img.width, img.height, crop_size, int(crop_size * overlap))
+        if len(boxes) <= max_tiles:
+            break
+        crop_size = int(crop_size * 1.1)
+
+    tiles = []
+    for box in boxes:
+        tile = img.crop(box)
+        if max(tile.size) > max_size:
+            tile.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+        is_gray = grayscale and is_effectively_grayscale(tile)
+        if is_gray and tile.mode != 'L':
+            tile = tile.convert('L')
+        data, quality = encode_to_budget(tile, fmt, byte_budget, min_quality, max_quality)
+        tiles.append(PreparedImage(data, OUTPUT_FORMATS[fmt], tile.size, original_size, quality, is_gray))
+    return tiles
+
+
+def tiling_settings(config):
+    """Tiling keyword arguments from the app config, or None when tiling is off"""
+    if not config['TILING_ENABLED'] or not config['PREPROCESS_ENABLED']:
+        return None
+    return {
+        'min_side': config['TILING_MIN_SIDE'],
+        'overlap': config['TILING_OVERLAP'],
+        'max_tiles': config['TILING_MAX_TILES'],
+        **preprocess_settings(config),
+    }
+
+
+def dhash(source, hash_size=8):
+    """Difference hash: one bit per pair of neighbouring pixels on a tiny grayscale copy
+
+    The bits record which of the two is brighter, so the hash survives
+    rescaling, recompression and moderate lighting or crop changes. Returns
+    a hash_size * hash_size bit integer.
+    """
+    img = Image.open(source)
+    img.draft('L', ((hash_size + 1) * 8, hash_size * 8))  # JPEG: decode at up to 1/8 scale
+    img = ImageOps.exif_transpose(img).convert('L')
+    img = img.resize((hash_size + 1, hash_size), Image.Resampling.LANCZOS)
+
+    pixels = img.tobytes()
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] < pixels[offset + col + 1])
+    return value
+
+
+def preprocess_settings(config):
+    """Preprocessing keyword arguments from the app config"""
+    return {
+        'max_size': config['PREPROCESS_MAX_SIZE'],
+        'fmt': config['PREPROCESS_FORMAT'],
+        'byte_budget': config['PREPROCESS_BYTE_BUDGET'],
+        'min_quality': config['PREPROCESS_MIN_QUALITY'],
+        'max_quality': config['PREPROCESS_MAX_QUALITY'],
+        'grayscale': config['PREPROCESS_GRAYSCALE'],
+    }
@@ -0,0 +1,244 @@
+import csv
+import io
+import json
+import re
+from functools import lru_cache
+
+# "- **Label:** value" bullets, the output format the analysis prompts ask for
+FIELD_LINE = re.compile(r'^\s*[-*•]\s*\*\*(?P<label>[^*]+?):?\*\*:?\s*(?P<value>.*?)\s*$')
+# "~~crossed out~~ corrected to X", or a bare "~~crossed out~~"
+CORRECTION = re.compile(
+    r'~~(?P<struck>.+?)~~(?:\s*(?:corrected to|changed to|->|→)\s*(?P<corrected>.+?)(?=\s*[,;]?\s*~~|$))?'
+)
+UNCERTAIN_MARKER = '[?]'
+
+# JSON schema for models that can answer in structured output (STRUCTURED_OUTPUT=true)
+RESPONSE_SCHEMA = {
+    'type': 'array',
+    'items': {
+        'type': 'object',
+        'properties': {
+            'name': {'type': 'string'},
+            'value': {'type': 'string'},
+            'uncertain': {'type': 'boolean'},
+            'corrections': {
+                'type': 'array',
+                'items': {
+                    'type': 'object',
+                    'properties': {'struck': {'type': 'string'}, 'corrected': {'type': 'string'}},
+                    'required': ['struck'],
+                },
+            },
+        },
+        'required': ['name', 'value'],
+    },
+}
+
+# Columns of the CSV export after the per-record key columns: one row per field
+CSV_FIELD_COLUMNS = ('field', 'value', 'uncertain', 'corrections')
+
+
+class Field:
+    """One extracted field
+
+    value is the reading after any corrections. corrections holds
+    (struck, corrected) pairs, with corrected None when the model only noted
+    a strikethrough. uncertain is set when the model marked part of the value
+    [?]; the marker stays in value, where it shows which part was unreadable
+    (a structured answer that only sets the flag gets it appended).
+    """
+
+    __slots__ = ('name', 'value', 'uncertain', 'corrections')
+
+    def __init__(self, name, value, uncertain=False, corrections=()):
+        self.name = name
+        self.value = value
+        self.uncertain = uncertain
+        self.corrections = tuple(corrections)
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'value': self.value,
+            'uncertain': self.uncertain,
+            'corrections': [{'struck': struck, 'corrected': corrected} for struck, corrected in self.corrections],
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        value = str(data.get('value', '')).strip()
+        uncertain = bool(data.get('uncertain')) or UNCERTAIN_MARKER in value
+        if uncertain and UNCERTAIN_MARKER not in value:
+            value = f'{value} {UNCERTAIN_MARKER}'.strip()
+        return cls(
+            str(data['name']).strip(),
+            value,
+            uncertain,
+            ((c['struck'], c.get('corrected') or None) for c in data.get('corrections') or ())
+        )
+
+    def as_markdown(self):
+        """The field as the bullet the prompts ask for, corrections and the [?] marker included"""
+        value = self.value
+        if self.uncertain and UNCERTAIN_MARKER not in value:
+            value = f'{value} {UNCERTAIN_MARKER}'.strip()
+        if not self.corrections:
+            return f'- **{self.name}:** {value}'
+        text = ', '.join(f'~~{struck}~~ corrected to {corrected}' if corrected else f'~~{struck}~~'
+                         for struck, corrected in self.corrections)
+        if not any(corrected and corrected in value for _, corrected in self.corrections):
+            text = f'{text} {value}'
+        return f'- **{self.name}:** {text}'
+
+    def __repr__(self):
+        return f'Field({self.name!r}, {self.value!r})'
+
+
+class FieldText(str):
+    """Answer text rendered from structured fields, carrying the fields so they are not parsed back"""
+
+    @classmethod
+    def render(cls, fields):
+        text = cls('\n'.join(field.as_markdown() for field in fields))
+        text.fields = tuple(fields)
+        return text
+
+
+def parse_field_line(line):
+    """Return (label, value) for a field bullet, or None for any other line"""
+    match = FIELD_LINE.match(line)
+    if not match:
+        return None
+    return match['label'].strip(), match['value']
+
+
+def parse_field(label, raw_value):
+    """Build a Field from a bullet's label and raw value text"""
+    corrections = [(m['struck'].strip(), m['corrected'].strip() if m['corrected'] else None)
+                   for m in CORRECTION.finditer(raw_value)]
+    value = raw_value
+    if corrections:
+        value = CORRECTION.sub(lambda m: m['corrected'] or '', raw_value)
+        value = ' '.join(value.split()).strip(' ,;')
+    return Field(label, value, UNCERTAIN_MARKER in raw_value, corrections)
+
+
+@lru_cache(maxsize=1024)
+def parse_fields(text):
+    """All fields in a model answer, in order (cached: answers are re-read on every cache hit)"""
+    fields = []
+    for line in text.splitlines():
+        field = parse_field_line(line)
+        if field:
+            fields.append(parse_field(*field))
+    return tuple(fields)
+
+
+def fields_from_json(text):
+    """Fields from a structured-output answer: a list of fields, or {"fields": [...]}"""
+    data = json.loads(text)
+    if isinstance(data, dict):
+        data = data.get('fields', [])
+    return tuple(Field.from_dict(item) for item in data if isinstance(item, dict) and item.get('name'))
+
+
+def result_fields(result):
+    """The field dicts of an analysis result, parsing results stored before fields were added"""
+    if result.get('fields') is not None:
+        return result['fields']
+    return [field.as_dict() for field in parse_fields(result.get('content') or '')]
+
+
+class FieldStream:
+    """Turns text arriving in arbitrary pieces into fields, one per completed line"""
+
+    def __init__(self):
+        self._buffer = ''
+
+    def feed(self, text):
+        """Add a piece of text; returns the fields whose lines it completed"""
+        self._buffer += text
+        *lines, self._buffer = self._buffer.split('\n')
+        return [parse_field(*field) for field in map(parse_field_line, lines) if field]
+
+    def close(self):
+        """Fields on the last line, which has no trailing newline"""
+        line, self._buffer = self._buffer, ''
+        field = parse_field_line(line)
+        return [parse_field(*field)] if field else []
+
+
+def _normalise(text):
+    return ' '.join(text.lower().split())
+
+
+def merge_results(texts):
+    """Merge the answers for overlapping parts of one image into a single answer
+
+    Lines keep the order they first appear in. Repeated lines and fields are
+    dropped; when a label's value extends an earlier one (text cut off at a
+    tile edge) the longer line replaces the shorter in place.
+    """
+    lines = []
+    seen_lines = set()
+    fields = {}  # normalised label -> [[line index, normalised value], ...]
+
+    for text in texts:
+        for line in text.splitlines():
+            if not line.strip():
+                continue
+            field = parse_field_line(line)
+            if field is None:
+                key = _normalise(line)
+                if key not in seen_lines:
+                    seen_lines.add(key)
+                    lines.append(line)
+                continue
+
+            label, value = map(_normalise, field)
+            for entry in fields.setdefault(label, []):
+                if entry[1].startswith(value):
+                    break
+                if value.startswith(entry[1]):
+                    lines[entry[0]] = line
+                    entry[1] = value
+                    break
+            else:
+                fields[label].append([len(lines), value])
+                lines.append(line)
+
+    return '\n'.join(lines)
+
+
+def jsonl_lines(records):
+    """One JSON line per record; each record is a dict of key columns plus 'result'"""
+    for record in records:
+        result = record['result']
+        row = {key: value for key, value in record.items() if key != 'result'}
+        row['content'] = result.get('content')
+        row['fields'] = result_fields(result)
+        yield json.dumps(row, ensure_ascii=False) + '\n'
+
+
+def csv_lines(records, key_columns):
+    """CSV text, one row per field, each row starting with the record's key columns"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def flush():
+        text = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return text
+
+    writer.writerow(key_columns + CSV_FIELD_COLUMNS)
+    yield flush()
+    for record in records:
+        keys = [record.get(column) for column in key_columns]
+        for field in result_fields(record['result']):
+            corrections = '; '.join(
+                f"{c['struck']} -> {c['corrected']}" if c.get('corrected') else c['struck']
+                for c in field['corrections']
+            )
+            writer.writerow(keys + [field['name'], field['value'], field['uncertain'], corrections])
+        yield flush()
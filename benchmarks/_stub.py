@@ -0,0 +1,135 @@
+"""Shared helpers for benchmarks that must not call the real Gemini API"""
+import io
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+
+from PIL import Image
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def isolated_environment():
+    """Point the app at throwaway state and uploads, and disable shared caches, limits and coalescing"""
+    os.environ.setdefault('GEMINI_API_KEY', 'benchmark-key')
+    os.environ['DATA_FOLDER'] = tempfile.mkdtemp(prefix='bench-')
+    os.environ['UPLOAD_FOLDER'] = os.path.join(os.environ['DATA_FOLDER'], 'uploads')
+    os.environ['RESULT_CACHE_BACKEND'] = 'none'
+    os.environ['GEMINI_RPM'] = '0'
+    # Every request is meant to reach the model, not share an identical one's call
+    os.environ['SINGLE_FLIGHT'] = 'off'
+
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def serve_in_thread(app):
+    """Serve the app on a free local port; returns (base_url, server)"""
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=_QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_port}', server
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_gunicorn(profile='gthread', workers=1, log_level='warning', stderr=None, **env):
+    """Run the app under Gunicorn with gunicorn_config.py; returns (process, base_url)
+
+    Extra keyword arguments are passed as environment variables, e.g.
+    MODEL_BACKEND='fake' to serve every analysis from the local fake model.
+    Pass stderr=subprocess.PIPE to read Gunicorn's log.
+    """
+    port = free_port()
+    env = dict(os.environ,
+               GUNICORN_PROFILE=profile,
+               GUNICORN_WORKERS=str(workers),
+               GUNICORN_BIND=f'127.0.0.1:{port}',
+               **{key: str(value) for key, value in env.items()})
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn_config.py',
+         '--access-logfile', '/dev/null', '--log-level', log_level, 'run:app'],
+        cwd=ROOT, env=env, stderr=stderr
+    )
+    base = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f'gunicorn exited while starting the {profile} profile')
+        try:
+            urllib.request.urlopen(f'{base}/api/prompts', timeout=1).read()
+            return process, base
+        except (urllib.error.URLError, OSError):
+            time.sleep(0.2)
+    process.terminate()
+    raise SystemExit(f'gunicorn did not start for the {profile} profile')
+
+
+def worker_pids(master_pid):
+    """PIDs of a Gunicorn master's worker processes (Linux /proc)"""
+    pids = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # The parent pid is the second field after the parenthesised command name
+                if int(f.read().rsplit(')', 1)[1].split()[1]) == master_pid:
+                    pids.append(int(entry))
+        except (OSError, IndexError, ValueError):
+            continue
+    return pids
+
+
+def peak_rss_mb(pid):
+    """High-water resident memory of a process in MB, or None if unavailable"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def make_image(megapixels):
+    width = int((megapixels * 1e6 * 4 / 3) ** 0.5)
+    img = Image.effect_noise((width, width * 3 // 4), 40).convert('RGB')
+    buffer = io.BytesIO()
+    img.save(buffer, 'JPEG', quality=92)
+    return buffer.getvalue()
+
+
+def tagged_jpeg(data, tag):
+    """A copy of a JPEG with a comment segment holding tag, so each copy has its own content hash"""
+    comment = str(tag).encode()
+    return data[:2] + b'\xff\xfe' + (len(comment) + 2).to_bytes(2, 'big') + comment + data[2:]
+
+
+def multipart(fields, file_bytes, field='file'):
+    """Encode a form with one JPEG, or a list of JPEGs all sent as `field`"""
+    boundary = uuid.uuid4().hex
+    body = io.BytesIO()
+    for name, value in fields.items():
+        body.write(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for index, data in enumerate(file_bytes if isinstance(file_bytes, list) else [file_bytes]):
+        body.write(f'--{boundary}\r\nContent-Disposition: form-data; name="{field}"; filename="scan{index}.jpg"\r\n'
+                   'Content-Type: image/jpeg\r\n\r\n'.encode())
+        body.write(data)
+        body.write(b'\r\n')
+    body.write(f'--{boundary}--\r\n'.encode())
+    return body.getvalue(), f'multipart/form-data; boundary={boundary}'
@@ -0,0 +1,129 @@
+"""Concurrent analyses per worker under each Gunicorn serving profile
+
+Run from the project root:
+
+    python -m benchmarks.load_test [--profiles gthread sync] [--paths wait job]
+                                   [--concurrency 200] [--duration 10] [--model-latency 1.0]
+                                   [--workers 1] [--megapixels 0.3]
+
+Starts Gunicorn with gunicorn_config.py and the fake model backend (fixed
+latency) for each profile, then keeps --concurrency clients analyzing for
+--duration seconds along each path:
+
+- wait: one multipart POST /api/analyze, answered in the request
+- job:  POST /api/upload, POST /api/analyze (202 and a job ID), then polling
+        /api/jobs/<id> until it is done - the default path, run on the job pool
+
+Every request sends a distinct image (the same picture with its own JPEG
+comment), so none is answered by coalescing with another. "in flight" is the
+average number of model calls each worker had open at once (Little's law:
+req/s x model latency / workers), i.e. how many analyses one worker can wait on
+concurrently.
+Add `gevent` to --profiles when gevent is installed.
+"""
+import argparse
+import json
+import statistics
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks._stub import isolated_environment, make_image, multipart, start_gunicorn, tagged_jpeg
+
+POLL_INTERVAL = 0.1  # seconds between job status checks
+
+
+def post(url, body, content_type):
+    request = urllib.request.Request(url, data=body, headers={'Content-Type': content_type}, method='POST')
+    with urllib.request.urlopen(request, timeout=60) as response:
+        return json.loads(response.read())
+
+
+def analyze_wait(base, data):
+    post(f'{base}/api/analyze', *multipart({}, data))
+
+
+def analyze_job(base, data):
+    filename = post(f'{base}/api/upload', *multipart({}, data))['filename']
+    job = post(f'{base}/api/analyze', json.dumps({'filename': filename}).encode(), 'application/json')
+    while job['status'] not in ('done', 'failed', 'cancelled'):
+        time.sleep(POLL_INTERVAL)
+        with urllib.request.urlopen(f"{base}/api/jobs/{job['job_id']}", timeout=60) as response:
+            job = json.loads(response.read())
+    if job['status'] != 'done':
+        raise RuntimeError(job.get('error') or job['status'])
+
+
+PATHS = {'wait': analyze_wait, 'job': analyze_job}
+
+
+def client(base, analyze, image, stop_at, latencies, finished, errors, lock):
+    sent = 0
+    while time.monotonic() < stop_at:
+        data = tagged_jpeg(image, f'{threading.get_ident()}-{sent}')
+        sent += 1
+        started = time.perf_counter()
+        try:
+            analyze(base, data)
+            with lock:
+                latencies.append(time.perf_counter() - started)
+                finished.append(time.monotonic())
+        except Exception:
+            with lock:
+                errors.append(time.perf_counter() - started)
+
+
+def run_profile(profile, path, args, image):
+    process, base = start_gunicorn(profile, args.workers, MODEL_BACKEND='fake',
+                                   FAKE_MODEL_LATENCY=args.model_latency, FAKE_MODEL_LATENCY_SIGMA=0)
+    latencies, finished, errors, lock = [], [], [], threading.Lock()
+    started = time.monotonic()
+    stop_at = started + args.duration
+    try:
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            for _ in range(args.concurrency):
+                pool.submit(client, base, PATHS[path], image, stop_at, latencies, finished, errors, lock)
+            # Requests still queued long after the deadline are counted as unfinished
+            time.sleep(args.duration + args.model_latency * 2 + 2)
+            process.terminate()
+    finally:
+        process.terminate()
+        process.wait()
+
+    if not latencies:
+        print(f'{profile:<8} {path:<5} no requests completed ({len(errors)} failed)')
+        return
+    elapsed = max(finished) - started
+    ordered = sorted(latencies)
+    print(f'{profile:<8} {path:<5} {len(latencies):>6} {len(errors):>6} {len(latencies) / elapsed:>8.1f} '
+          f'{len(latencies) / elapsed * args.model_latency / args.workers:>10.1f} '
+          f'{statistics.median(ordered):>7.2f} {ordered[int(len(ordered) * 0.95) - 1]:>7.2f} '
+          f'{ordered[int(len(ordered) * 0.99) - 1]:>7.2f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--profiles', nargs='+', default=['gthread', 'sync'])
+    parser.add_argument('--paths', nargs='+', choices=sorted(PATHS), default=['wait', 'job'])
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--model-latency', type=float, default=1.0)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--megapixels', type=float, default=0.3)
+    args = parser.parse_args()
+
+    isolated_environment()
+    image = make_image(args.megapixels)
+
+    print(f'{args.workers} worker(s), {args.concurrency} clients for {args.duration:.0f}s, '
+          f'fake model latency {args.model_latency * 1000:.0f} ms')
+    print(f"{'profile':<8} {'path':<5} {'ok':>6} {'failed':>6} {'req/s':>8} {'in flight':>10} "
+          f"{'p50 s':>7} {'p95 s':>7} {'p99 s':>7}")
+    for profile in args.profiles:
+        for path in args.paths:
+            run_profile(profile, path, args, image)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""Lookup latency of the near-duplicate (perceptual hash) index at scale
+
+Run from the project root:
+
+    python -m benchmarks.near_duplicates [--entries 1000000] [--queries 1000] [--threshold 8]
+
+Fills a throwaway index with random 64-bit hashes, then times lookups for
+hashes a few bits away from stored ones (which must be found) and for
+unrelated random hashes. Filling a million entries takes a minute or so;
+the database is reused between runs of the same size.
+"""
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from app.services.perceptual_index import HASH_BITS, PerceptualIndex, _chunks, _to_signed
+
+
+def fill(index, entries, seed):
+    existing = len(index)
+    if existing >= entries:
+        return
+    rng = random.Random(seed)
+    for _ in range(existing):
+        rng.getrandbits(HASH_BITS)
+    conn = index._connections.get()
+    batch = []
+    with conn:
+        for i in range(existing, entries):
+            phash = rng.getrandbits(HASH_BITS)
+            batch.append((f'{i:064x}', _to_signed(phash), *_chunks(phash), float(i)))
+            if len(batch) == 50_000:
+                conn.executemany('INSERT INTO hashes VALUES (?, ?, ?, ?, ?, ?)', batch)
+                batch = []
+        conn.executemany('INSERT INTO hashes VALUES (?, ?, ?, ?, ?, ?)', batch)
+
+
+def flip(phash, bits, rng):
+    for bit in rng.sample(range(HASH_BITS), bits):
+        phash ^= 1 << bit
+    return phash
+
+
+def time_lookups(index, queries):
+    timings, found = [], 0
+    for query in queries:
+        started = time.perf_counter()
+        matches = index.nearest(query)
+        timings.append((time.perf_counter() - started) * 1000)
+        found += bool(matches)
+    timings.sort()
+    return timings, found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--entries', type=int, default=1_000_000)
+    parser.add_argument('--queries', type=int, default=1000)
+    parser.add_argument('--threshold', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.gettempdir(), f'near_duplicates_{args.entries}_{args.seed}.sqlite3')
+    index = PerceptualIndex(path, threshold=args.threshold, max_entries=args.entries)
+    started = time.perf_counter()
+    fill(index, args.entries, args.seed)
+    print(f'{len(index)} entries in {path} (filled in {time.perf_counter() - started:.1f}s)')
+
+    # Regenerate some stored hashes to derive near-duplicate queries from
+    rng = random.Random(args.seed)
+    stored = [rng.getrandbits(HASH_BITS) for _ in range(min(args.entries, args.queries * 10))]
+    query_rng = random.Random(args.seed + 1)
+    near = [flip(query_rng.choice(stored), query_rng.randint(0, args.threshold), query_rng)
+            for _ in range(args.queries)]
+    unrelated = [query_rng.getrandbits(HASH_BITS) for _ in range(args.queries)]
+
+    print(f"{'queries':<12} {'found':>7} {'mean ms':>8} {'p50 ms':>7} {'p99 ms':>7}")
+    for name, queries in (('near', near), ('unrelated', unrelated)):
+        timings, found = time_lookups(index, queries)
+        print(f"{name:<12} {found:>7} {statistics.mean(timings):>8.3f} "
+              f"{timings[len(timings) // 2]:>7.3f} {timings[int(len(timings) * 0.99)]:>7.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""Image preparation cost: legacy thumbnail path vs the preprocessing pipeline
+
+Run from the project root:
+
+    python -m benchmarks.preprocess [image ...] [--uplink-mbps 10]
+
+Without image arguments a synthetic 12 MP phone-style JPEG and a scanned-form
+PNG are generated. End-to-end latency is modelled as preparation time plus
+transfer of the encoded bytes over the given uplink (the model's own latency is
+the same for both paths and is left out).
+"""
+import argparse
+import io
+import random
+import time
+
+from google.generativeai.types import content_types
+from PIL import Image, ImageDraw
+
+from app.utils.image_processing import preprocess_image
+
+MAX_SIZE = 1536
+
+
+def synthetic_images():
+    """A noisy colour photo of a form and a clean grayscale scan"""
+    rng = random.Random(42)
+    photo = Image.new('RGB', (4032, 3024), (235, 230, 220))
+    draw = ImageDraw.Draw(photo)
+    for y in range(150, 2900, 90):
+        draw.line((200, y, 3800, y), fill=(120, 120, 140), width=3)
+        x = 220
+        while x < 3600:
+            w = rng.randint(20, 70)
+            draw.rectangle((x, y - 50, x + w, y - 10), fill=(20, 30, 90))
+            x += w + rng.randint(10, 40)
+    noise = Image.effect_noise(photo.size, 25).convert('RGB')
+    photo = Image.blend(photo, noise, 0.15)
+    photo_bytes = io.BytesIO()
+    photo.save(photo_bytes, 'JPEG', quality=95)
+
+    scan = Image.new('L', (2480, 3508), 255)
+    draw = ImageDraw.Draw(scan)
+    for y in range(200, 3300, 70):
+        draw.text((150, y), 'Name: ________  Date: ________  Amount: ________', fill=0)
+    scan_bytes = io.BytesIO()
+    scan.save(scan_bytes, 'PNG')
+
+    return [('photo-12mp.jpg', photo_bytes.getvalue()), ('scan-a4.png', scan_bytes.getvalue())]
+
+
+def legacy_prepare(data):
+    """What analyze_image did before: full decode, LANCZOS thumbnail, SDK re-encode"""
+    img = Image.open(io.BytesIO(data))
+    if max(img.size) > MAX_SIZE:
+        img.thumbnail((MAX_SIZE, MAX_SIZE), Image.Resampling.LANCZOS)
+    return len(content_types.pil_to_blob(img).data)
+
+
+def pipeline_prepare(data):
+    return len(preprocess_image(io.BytesIO(data), max_size=MAX_SIZE).data)
+
+
+def measure(fn, data, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        size = fn(data)
+        timings.append(time.perf_counter() - start)
+    return min(timings), size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('images', nargs='*')
+    parser.add_argument('--uplink-mbps', type=float, default=10.0)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    if args.images:
+        images = [(path, open(path, 'rb').read()) for path in args.images]
+    else:
+        images = synthetic_images()
+
+    bytes_per_second = args.uplink_mbps * 1e6 / 8
+    print(f"{'image':<20} {'path':<9} {'prep ms':>9} {'bytes sent':>12} {'e2e ms':>9}")
+    for name, data in images:
+        for label, fn in (('legacy', legacy_prepare), ('pipeline', pipeline_prepare)):
+            seconds, size = measure(fn, data, args.repeat)
+            e2e = seconds + size / bytes_per_second
+            print(f"{name:<20} {label:<9} {seconds * 1000:>9.1f} {size:>12,} {e2e * 1000:>9.1f}")
+
+
+if __name__ == '__main__':
+    main()
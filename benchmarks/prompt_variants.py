@@ -0,0 +1,172 @@
+"""Latency and token usage per prompt variant, against a recorded fixture set
+
+Run from the project root:
+
+    python -m benchmarks.prompt_variants record IMAGE_DIR [--variants analysis compact]
+    python -m benchmarks.prompt_variants report [--reference analysis]
+
+`record` calls the real Gemini API (GEMINI_API_KEY from .env) once per image and
+variant and appends one JSON line per call to the fixture file: latency, prompt,
+image and output token counts, and the response text. `report` reads the fixture
+file only, so variants can be compared repeatedly without spending quota. Field
+agreement is the share of the reference variant's extracted fields that another
+variant reproduced with the same value on the same image.
+
+The fixture file (benchmarks/fixtures/prompt_variants.jsonl) is meant to be
+committed once recorded. Without it, `report` (and the suite) says how to record
+it and exits successfully rather than failing.
+"""
+import argparse
+import hashlib
+import json
+import os
+import statistics
+import time
+
+from app.utils.result_parser import parse_field_line
+
+FIXTURE_PATH = os.path.join(os.path.dirname(__file__), 'fixtures', 'prompt_variants.jsonl')
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp')
+
+
+def parse_fields(text):
+    """{label: value} from '- **Label:** value' bullets, normalised for comparison"""
+    fields = {}
+    for field in map(parse_field_line, text.splitlines()):
+        if field:
+            label, value = field
+            fields[' '.join(label.lower().split())] = ' '.join(value.lower().split())
+    return fields
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def record(image_dir, variants, fixture_path):
+    from app import create_app
+    from app.services.gemini_service import GeminiService
+    from app.services.prompt_service import get_prompt_library
+    from app.utils.image_processing import preprocess_image, preprocess_settings
+
+    images = sorted(
+        os.path.join(image_dir, name) for name in os.listdir(image_dir)
+        if name.lower().endswith(IMAGE_EXTENSIONS)
+    )
+    if not images:
+        raise SystemExit(f'No images found in {image_dir}')
+
+    app = create_app()
+    os.makedirs(os.path.dirname(fixture_path), exist_ok=True)
+    with app.app_context(), open(fixture_path, 'a') as out:
+        library = get_prompt_library()
+        services = {variant: GeminiService(prompt=library.get(variant)) for variant in variants}
+
+        for path in images:
+            with open(path, 'rb') as f:
+                digest = hashlib.sha256(f.read()).hexdigest()
+            part = preprocess_image(path, **preprocess_settings(app.config)).as_part()
+
+            for variant, service in services.items():
+                prompt = service.prompt
+                started = time.perf_counter()
+                text = service.analyze_image(path)
+                latency = time.perf_counter() - started
+
+                row = {
+                    'image': os.path.basename(path),
+                    'digest': digest,
+                    'variant': variant,
+                    'prompt_id': prompt.id,
+                    'prompt_fingerprint': prompt.fingerprint,
+                    'prompt_mode': service.prompt_mode,
+                    'model': service.model_name,
+                    'prompt_tokens': prompt.measure(service.backend),
+                    'image_tokens': service.backend.count_tokens([part]),
+                    'output_tokens': service.backend.count_tokens(text),
+                    'latency': round(latency, 3),
+                    'text': text,
+                }
+                out.write(json.dumps(row) + '\n')
+                out.flush()
+                print(f"{row['image']:<32} {variant:<12} {latency:6.2f}s  "
+                      f"{row['prompt_tokens']} + {row['image_tokens']} in, {row['output_tokens']} out")
+
+
+def report(fixture_path, reference):
+    """Print the comparison table; returns False (after saying how to record) when there are no fixtures"""
+    if not os.path.exists(fixture_path):
+        print(f'No recorded fixtures at {fixture_path}; skipping the prompt variant comparison.\n'
+              f'Record them once against the real API (GEMINI_API_KEY) and commit the file:\n'
+              f'    python -m benchmarks.prompt_variants record path/to/sample/images/')
+        return False
+    with open(fixture_path) as f:
+        rows = [json.loads(line) for line in f if line.strip()]
+
+    # Only the newest recording of each (image, variant) counts
+    latest = {}
+    for row in rows:
+        latest[(row['digest'], row['variant'])] = row
+    by_variant = {}
+    for row in latest.values():
+        by_variant.setdefault(row['variant'], []).append(row)
+
+    reference_fields = {
+        digest: parse_fields(row['text'])
+        for (digest, variant), row in latest.items() if variant == reference
+    }
+
+    current = _current_fingerprints()
+    print(f"{'variant':<12} {'n':>3} {'prompt tok':>10} {'input tok':>10} {'output tok':>10} "
+          f"{'p50 s':>7} {'p95 s':>7} {'fields':>7} {'agree':>6}")
+    for variant, items in sorted(by_variant.items()):
+        latencies = [row['latency'] for row in items]
+        agreements = []
+        for row in items:
+            expected = reference_fields.get(row['digest'])
+            if expected:
+                got = parse_fields(row['text'])
+                agreements.append(sum(got.get(k) == v for k, v in expected.items()) / len(expected))
+        print(f"{variant:<12} {len(items):>3} "
+              f"{statistics.mean(row['prompt_tokens'] or 0 for row in items):>10.0f} "
+              f"{statistics.mean((row['prompt_tokens'] or 0) + row['image_tokens'] for row in items):>10.0f} "
+              f"{statistics.mean(row['output_tokens'] for row in items):>10.0f} "
+              f"{percentile(latencies, 50):>7.2f} {percentile(latencies, 95):>7.2f} "
+              f"{statistics.mean(len(parse_fields(row['text'])) for row in items):>7.1f} "
+              f"{(f'{statistics.mean(agreements):.0%}' if agreements else '-'):>6}")
+
+        stale = {row['prompt_id'] for row in items if current.get(row['prompt_id']) not in (None, row['prompt_fingerprint'])}
+        if stale:
+            print(f"  note: {', '.join(sorted(stale))} changed since it was recorded; re-record to compare")
+    return True
+
+
+def _current_fingerprints():
+    """Fingerprints of the templates on disk, to flag recordings of older prompt text"""
+    from config import Config
+    from app.services.prompt_service import PromptLibrary
+    return {template.id: template.fingerprint for template in PromptLibrary(Config.PROMPT_FOLDER).templates()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--fixtures', default=FIXTURE_PATH)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    record_parser = commands.add_parser('record', help='call the API and append to the fixture set')
+    record_parser.add_argument('image_dir')
+    record_parser.add_argument('--variants', nargs='+', default=['analysis', 'compact'])
+
+    report_parser = commands.add_parser('report', help='summarise the recorded fixture set')
+    report_parser.add_argument('--reference', default='analysis')
+
+    args = parser.parse_args()
+    if args.command == 'record':
+        record(args.image_dir, args.variants, args.fixtures)
+    else:
+        report(args.fixtures, args.reference)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""Throughput of key/model routing when keys run out of quota or the primary model slows down
+
+Run from the project root (no network access or API key needed):
+
+    python -m benchmarks.router_failover [--keys 3] [--exhausted 1] [--fallback-models lite]
+                                         [--slow-primary 0] [--slow-after 0] [--rpm 120]
+                                         [--images 200] [--concurrency 16] [--latency 0.2]
+
+Analyzes --images distinct images in-process with the fake model backend, once
+with GEMINI_API_KEY alone and once with a pool of --keys keys plus the fallback
+models. The first --exhausted keys answer every call to the primary model with
+a 429, and with --slow-primary the primary model takes that many seconds per
+call on every key. Reports throughput, latency, failures, which key/model
+served the analyses and how often circuits opened.
+"""
+import argparse
+import io
+import os
+import statistics
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks._stub import isolated_environment, make_image
+
+
+def run(args, keys, fallback_models, images):
+    from app import create_app
+    from app.services.gemini_service import get_gemini_service
+    from config import Config
+
+    # Config reads the environment once, at import; each run gets its own key pool
+    config = type('RouterBenchmarkConfig', (Config,), {
+        'GEMINI_API_KEY': keys[0],
+        'GEMINI_API_KEYS': keys,
+        'GEMINI_FALLBACK_MODELS': fallback_models,
+        'RATE_LIMITER_PATH': os.path.join(tempfile.mkdtemp(prefix='bench-'), 'rate_limiter.sqlite3'),
+    })
+    app = create_app(config)
+
+    with app.app_context():
+        service = get_gemini_service()
+        for route in service.router.routes:
+            if route.tier == 0:
+                if route.label in {f'key-{n}' for n in range(1, args.exhausted + 1)}:
+                    route.backend.rate_limit_rate = 1.0
+                if args.slow_primary:
+                    route.backend.latency_median = args.slow_primary
+
+    def analyze(data):
+        with app.app_context():
+            started = time.perf_counter()
+            try:
+                result = get_gemini_service().analyze_file(io.BytesIO(data), use_cache=False)
+            except Exception:
+                return None, time.perf_counter() - started
+            return result['served_by'], time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        outcomes = list(pool.map(analyze, images))
+    elapsed = time.perf_counter() - started
+
+    with app.app_context():
+        stats = get_gemini_service().router.stats()
+    return outcomes, elapsed, stats
+
+
+def report(name, outcomes, elapsed, stats):
+    latencies = sorted(seconds for served, seconds in outcomes if served is not None)
+    failures = sum(served is None for served, _ in outcomes)
+    served = Counter(f"{route['key']}/{route['model']}" for routes, _ in outcomes if routes for route in routes)
+    print(f'{name}: {len(latencies)} ok, {failures} failed, {len(latencies) / elapsed:.1f} analyses/s', end='')
+    if latencies:
+        print(f', p50 {statistics.median(latencies):.2f}s, p95 {latencies[int(len(latencies) * 0.95) - 1]:.2f}s')
+    else:
+        print()
+    for route in stats:
+        label = f"{route['key']}/{route['model']}"
+        print(f'    {label:<28} served {served[label]:>5}  calls {route["calls"]:>5}  '
+              f'errors {route["error_rate"]:>5.0%}  circuit {route["circuit"]}'
+              + (f' ({route["open_reason"]})' if route['open_reason'] else ''))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--keys', type=int, default=3)
+    parser.add_argument('--exhausted', type=int, default=1)
+    parser.add_argument('--fallback-models', nargs='*', default=['lite'])
+    parser.add_argument('--slow-primary', type=float, default=0)
+    parser.add_argument('--slow-after', type=float, default=0)
+    parser.add_argument('--rpm', type=int, default=120)
+    parser.add_argument('--images', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--latency', type=float, default=0.2)
+    args = parser.parse_args()
+
+    isolated_environment()
+    os.environ.update({
+        'MODEL_BACKEND': 'fake',
+        'FAKE_MODEL_LATENCY': str(args.latency),
+        'FAKE_MODEL_LATENCY_SIGMA': '0.3',
+        'GEMINI_RPM': str(args.rpm),
+        'GEMINI_RETRY_BASE_DELAY': '0.5',
+        'GEMINI_RETRY_MAX_DELAY': '5',
+        'RATE_LIMIT_MAX_WAIT': '30',
+        'SINGLE_FLIGHT': 'off',
+        'METRICS_ENABLED': 'false',
+        'ROUTER_SLOW_AFTER': str(args.slow_after),
+    })
+    # Distinct images, so the fake backend draws independently for each
+    base = make_image(0.1)
+    images = [base + i.to_bytes(4, 'big') for i in range(args.images)]
+
+    keys = [f'benchmark-key-{n}' for n in range(1, args.keys + 1)]
+    report('single key', *run(args, keys[:1], [], images))
+    report(f'{args.keys} keys + {len(args.fallback_models)} fallback models',
+           *run(args, keys, args.fallback_models, images))
+
+
+if __name__ == '__main__':
+    main()
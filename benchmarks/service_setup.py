@@ -0,0 +1,42 @@
+"""Per-request GeminiService setup cost: fresh construction vs the shared registry
+
+Run from the project root:
+
+    python -m benchmarks.service_setup [iterations]
+
+No network access is needed; each iteration builds the service and its SDK
+client (GeminiBackend binds the client when it is built).
+The numbers exclude the TCP/TLS handshake a fresh client pays on its first
+real request, so the saving in production is larger than reported here.
+"""
+import os
+import sys
+import time
+
+os.environ.setdefault('GEMINI_API_KEY', 'benchmark-key')
+
+from app import create_app
+from app.services.gemini_service import GeminiService, get_gemini_service
+
+
+def bench(label, make_service, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        make_service()
+    elapsed = time.perf_counter() - start
+    per_call_us = elapsed / iterations * 1e6
+    print(f"{label:<28} {iterations:>6} calls  {per_call_us:>10.1f} us/request")
+    return per_call_us
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    app = create_app()
+    with app.app_context():
+        fresh = bench('GeminiService() per request', GeminiService, iterations)
+        shared = bench('get_gemini_service()', get_gemini_service, iterations)
+    print(f"Setup overhead removed: {fresh - shared:.1f} us/request ({fresh / max(shared, 1e-9):.0f}x)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+"""Worker start-up cost: import time, and time until a (re)started Gunicorn worker is ready
+
+Run from the project root (no network access or API key needed):
+
+    python -m benchmarks.startup [--runs 5] [--workers 2] [--restarts 4]
+
+First times, in --runs fresh interpreters, importing the app and create_app(),
+importing the Gemini SDK (deferred until a backend needs it) and building the
+model client. Then serves the app with Gunicorn (gthread profile,
+MODEL_BACKEND=gemini with a dummy key) with and without preload_app, stops a
+worker --restarts times so the master replaces it as it does after
+max_requests, and reports each worker's time from fork to ready (logged by
+the post_worker_init hook) and its proportional set size, which counts pages
+shared with the master and other workers only in part.
+"""
+import argparse
+import json
+import os
+import re
+import signal
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+from benchmarks._stub import ROOT, isolated_environment, start_gunicorn, worker_pids
+
+# Runs in a fresh interpreter; prints the seconds each start-up step took as JSON
+IMPORT_PROBE = '''
+import json, sys, time
+started = time.perf_counter()
+from app import create_app
+imported = time.perf_counter()
+app = create_app()
+created = time.perf_counter()
+sdk_in_app = 'google.generativeai' in sys.modules
+from app.services.model_backends import load_sdk
+load_sdk('gemini')
+sdk = time.perf_counter()
+from app.services.gemini_service import warm_gemini_service
+warm_gemini_service(app)
+warmed = time.perf_counter()
+print(json.dumps({'import_app': imported - started, 'create_app': created - imported, 'sdk_in_app': sdk_in_app,
+                  'import_sdk': sdk - created, 'warm_client': warmed - sdk}))
+'''
+
+READY = re.compile(r'Worker (\d+) ready in ([\d.]+)s')
+
+
+def import_times(runs):
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', IMPORT_PROBE], cwd=ROOT, capture_output=True, text=True,
+                                check=True, env=dict(os.environ, MODEL_BACKEND='gemini')).stdout
+        samples.append(json.loads(output.splitlines()[-1]))
+    return samples
+
+
+def pss_mb(pid):
+    """Proportional set size of a process in MB, or None if unavailable"""
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as f:
+            for line in f:
+                if line.startswith('Pss:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def worker_boots(args, preload):
+    """Ready times of the first workers and of their replacements, and the workers' PSS"""
+    process, _ = start_gunicorn('gthread', args.workers, log_level='info', stderr=subprocess.PIPE,
+                                MODEL_BACKEND='gemini', GUNICORN_PRELOAD=str(preload).lower())
+    ready = []
+    condition = threading.Condition()
+
+    def read_log():
+        for line in iter(process.stderr.readline, b''):
+            match = READY.search(line.decode(errors='replace'))
+            if match:
+                with condition:
+                    ready.append(float(match.group(2)))
+                    condition.notify_all()
+
+    threading.Thread(target=read_log, daemon=True).start()
+
+    def wait_for(count):
+        with condition:
+            if not condition.wait_for(lambda: len(ready) >= count, timeout=60):
+                raise SystemExit('Gunicorn workers did not report ready; is gunicorn_config.py current?')
+
+    try:
+        wait_for(args.workers)
+        first = list(ready)
+        for restart in range(args.restarts):
+            pids = worker_pids(process.pid)
+            os.kill(pids[restart % len(pids)], signal.SIGTERM)
+            wait_for(args.workers + restart + 1)
+        time.sleep(0.5)
+        memory = [pss_mb(pid) for pid in worker_pids(process.pid)]
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+    return first, ready[args.workers:], [mb for mb in memory if mb is not None]
+
+
+def summary(seconds):
+    if not seconds:
+        return 'n/a'
+    return f'median {statistics.median(seconds) * 1000:.0f} ms, max {max(seconds) * 1000:.0f} ms'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--restarts', type=int, default=4)
+    args = parser.parse_args()
+
+    isolated_environment()
+
+    samples = import_times(args.runs)
+    print(f'Fresh interpreter ({args.runs} runs, median):')
+    for step, label in (('import_app', 'import app'), ('create_app', 'create_app()'),
+                        ('import_sdk', 'import Gemini SDK'), ('warm_client', 'build model client')):
+        print(f'    {label:<20} {statistics.median(sample[step] for sample in samples) * 1000:>8.0f} ms')
+    print(f"    SDK imported by create_app(): {any(sample['sdk_in_app'] for sample in samples)}")
+
+    for preload in (False, True):
+        first, replaced, memory = worker_boots(args, preload)
+        print(f"Gunicorn, preload_app={'on' if preload else 'off'}:")
+        print(f'    first workers        {summary(first)}')
+        print(f'    replacement workers  {summary(replaced)}')
+        if memory:
+            print(f'    worker PSS           {statistics.mean(memory):.1f} MB average')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+"""Upload -> analyze pipeline benchmarks against the fake model backend
+
+Run from the project root (no network access or API key needed):
+
+    python -m benchmarks.suite [--quick] [--workers 2] [--model-latency 0.2]
+                               [--error-429 0.05] [--error-deadline 0.02] [--error-empty 0.01]
+                               [--json results.json]
+
+Serves the app with Gunicorn (gthread profile, MODEL_BACKEND=fake) and runs:
+
+- single:     one client, sequential POST /api/upload + POST /api/analyze {"wait": true}
+- concurrent: --concurrency clients doing the same at once
+- batch:      one multipart POST /api/analyze/batch, latency measured per NDJSON line
+
+and reports p50/p95/p99 latency, requests/s and the peak resident memory of each
+Gunicorn worker, followed by the prompt variant comparison from the recorded
+fixtures (skipped, with a note, when none have been recorded). Every request
+uploads a distinct image, so nothing is answered from the result cache. The exit status is 1 when a scenario's failure rate
+exceeds --max-error-rate, so the suite can gate CI.
+"""
+import argparse
+import json
+import sys
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks import prompt_variants
+from benchmarks._stub import isolated_environment, make_image, multipart, peak_rss_mb, start_gunicorn, worker_pids
+
+
+def post(url, body, content_type):
+    request = urllib.request.Request(url, data=body, headers={'Content-Type': content_type}, method='POST')
+    with urllib.request.urlopen(request, timeout=120) as response:
+        return json.loads(response.read())
+
+
+def upload_and_analyze(base, image):
+    body, content_type = multipart({}, image)
+    filename = post(f'{base}/api/upload', body, content_type)['filename']
+    post(f'{base}/api/analyze', json.dumps({'filename': filename, 'wait': True}).encode(), 'application/json')
+
+
+class Recorder:
+    """Thread-safe collection of request latencies and failures"""
+
+    def __init__(self):
+        self.latencies = []
+        self.failures = 0
+        self._lock = threading.Lock()
+
+    def timed(self, fn, *args):
+        started = time.perf_counter()
+        try:
+            fn(*args)
+        except Exception:
+            with self._lock:
+                self.failures += 1
+            return
+        with self._lock:
+            self.latencies.append(time.perf_counter() - started)
+
+
+def percentile(ordered, pct):
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def summarize(name, latencies, failures, elapsed, master_pid):
+    ordered = sorted(latencies)
+    memory = [peak_rss_mb(pid) for pid in worker_pids(master_pid)]
+    memory = [mb for mb in memory if mb is not None]
+    total = len(latencies) + failures
+    return {
+        'scenario': name,
+        'requests': total,
+        'failed': failures,
+        'error_rate': round(failures / total, 4) if total else 1.0,
+        'rps': round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        'p50': round(percentile(ordered, 50), 4) if ordered else None,
+        'p95': round(percentile(ordered, 95), 4) if ordered else None,
+        'p99': round(percentile(ordered, 99), 4) if ordered else None,
+        'worker_peak_rss_mb': round(max(memory), 1) if memory else None,
+    }
+
+
+def scenario_single(base, images):
+    recorder = Recorder()
+    started = time.perf_counter()
+    for image in images:
+        recorder.timed(upload_and_analyze, base, image)
+    return recorder.latencies, recorder.failures, time.perf_counter() - started
+
+
+def scenario_concurrent(base, images, concurrency):
+    recorder = Recorder()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for image in images:
+            pool.submit(recorder.timed, upload_and_analyze, base, image)
+    return recorder.latencies, recorder.failures, time.perf_counter() - started
+
+
+def scenario_batch(base, images):
+    body, content_type = multipart({}, images, field='files')
+    request = urllib.request.Request(f'{base}/api/analyze/batch', data=body,
+                                     headers={'Content-Type': content_type}, method='POST')
+    latencies, failures = [], 0
+    started = time.perf_counter()
+    with urllib.request.urlopen(request, timeout=300) as response:
+        for line in response:
+            item = json.loads(line)
+            if item.get('done'):
+                break
+            if item['success']:
+                latencies.append(time.perf_counter() - started)
+            else:
+                failures += 1
+    return latencies, failures, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--quick', action='store_true', help='small run for CI')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--requests', type=int, default=None, help='requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--model-latency', type=float, default=None, help='median fake model latency (s)')
+    parser.add_argument('--latency-sigma', type=float, default=0.3)
+    parser.add_argument('--error-429', type=float, default=0.0)
+    parser.add_argument('--error-deadline', type=float, default=0.0)
+    parser.add_argument('--error-empty', type=float, default=0.0)
+    parser.add_argument('--max-error-rate', type=float, default=0.01)
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    requests = args.requests or (20 if args.quick else 100)
+    model_latency = args.model_latency if args.model_latency is not None else (0.05 if args.quick else 0.2)
+
+    isolated_environment()
+    process, base = start_gunicorn(
+        'gthread', args.workers,
+        MODEL_BACKEND='fake',
+        FAKE_MODEL_LATENCY=model_latency,
+        FAKE_MODEL_LATENCY_SIGMA=args.latency_sigma,
+        FAKE_MODEL_429_RATE=args.error_429,
+        FAKE_MODEL_DEADLINE_RATE=args.error_deadline,
+        FAKE_MODEL_EMPTY_RATE=args.error_empty,
+        GEMINI_RETRY_BASE_DELAY=0.05,
+        GEMINI_RETRY_MAX_DELAY=1,
+        BATCH_MAX_IN_FLIGHT=args.concurrency,
+    )
+
+    def images():
+        return [make_image(0.3) for _ in range(requests)]
+
+    print(f'{args.workers} gthread worker(s), fake model {model_latency * 1000:.0f} ms median, '
+          f'{requests} requests per scenario')
+    print(f"{'scenario':<11} {'ok':>5} {'failed':>6} {'req/s':>8} {'p50 s':>7} {'p95 s':>7} {'p99 s':>7} {'RSS MB':>7}")
+    results = []
+    try:
+        for name, run in (
+            ('single', lambda: scenario_single(base, images())),
+            ('concurrent', lambda: scenario_concurrent(base, images(), args.concurrency)),
+            ('batch', lambda: scenario_batch(base, images())),
+        ):
+            result = summarize(name, *run(), process.pid)
+            results.append(result)
+            print(f"{name:<11} {result['requests'] - result['failed']:>5} {result['failed']:>6} {result['rps']:>8.1f} "
+                  f"{result['p50'] or 0:>7.3f} {result['p95'] or 0:>7.3f} {result['p99'] or 0:>7.3f} "
+                  f"{result['worker_peak_rss_mb'] or 0:>7.1f}")
+    finally:
+        process.terminate()
+        process.wait()
+
+    print()
+    prompt_variants.report(prompt_variants.FIXTURE_PATH, reference='analysis')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'model_latency': model_latency, 'workers': args.workers, 'results': results}, f, indent=2)
+
+    failed = [r['scenario'] for r in results if r['error_rate'] > args.max_error_rate]
+    if failed:
+        print(f"Error rate above {args.max_error_rate:.0%} in: {', '.join(failed)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
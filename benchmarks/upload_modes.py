@@ -0,0 +1,83 @@
+"""Latency of upload-then-analyze (two requests) vs single-request analyze
+
+Run from the project root:
+
+    python -m benchmarks.upload_modes [--requests 20] [--model-latency 0.5] [--megapixels 12]
+
+Serves the app on a local port and drives it over real HTTP, answered by the
+fake model backend (MODEL_BACKEND=fake) with a fixed latency, so the
+difference between the modes is the extra round trip plus writing the upload
+to disk and reading it back. Other FAKE_MODEL_* settings in the environment
+(latency spread, error rates) apply as usual; failed requests are counted.
+"""
+import argparse
+import json
+import os
+import statistics
+import time
+import urllib.error
+import urllib.request
+
+from benchmarks._stub import isolated_environment, make_image, multipart, serve_in_thread
+
+
+def post(url, body, content_type):
+    request = urllib.request.Request(url, data=body, headers={'Content-Type': content_type}, method='POST')
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+def two_step(base, image):
+    body, content_type = multipart({}, image)
+    filename = post(f'{base}/api/upload', body, content_type)['filename']
+    post(f'{base}/api/analyze', json.dumps({'filename': filename, 'wait': True}).encode(), 'application/json')
+    urllib.request.urlopen(urllib.request.Request(f'{base}/api/delete/{filename}', method='DELETE')).read()
+
+
+def single_request(base, image):
+    body, content_type = multipart({}, image)
+    post(f'{base}/api/analyze', body, content_type)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=20)
+    parser.add_argument('--model-latency', type=float, default=0.5)
+    parser.add_argument('--megapixels', type=float, default=12)
+    args = parser.parse_args()
+
+    # Config reads the environment on import, so the backend is chosen before the app is
+    isolated_environment()
+    os.environ['MODEL_BACKEND'] = 'fake'
+    os.environ['FAKE_MODEL_LATENCY'] = str(args.model_latency)
+    os.environ.setdefault('FAKE_MODEL_LATENCY_SIGMA', '0')
+    from app import create_app
+
+    app = create_app()
+    base, server = serve_in_thread(app)
+
+    image = make_image(args.megapixels)
+    print(f"image {len(image) / 1e6:.1f} MB, fake model latency {args.model_latency * 1000:.0f} ms")
+
+    for label, fn in (('upload + analyze', two_step), ('single request', single_request)):
+        timings, failed = [], 0
+        for _ in range(args.requests):
+            start = time.perf_counter()
+            try:
+                fn(base, image)
+            except urllib.error.HTTPError:
+                failed += 1
+                continue
+            timings.append(time.perf_counter() - start)
+        if not timings:
+            print(f"{label:<18} no requests succeeded ({failed} failed)")
+            continue
+        timings.sort()
+        print(f"{label:<18} p50 {statistics.median(timings) * 1000:8.1f} ms"
+              f"   p95 {timings[int(len(timings) * 0.95) - 1] * 1000:8.1f} ms   failed {failed}")
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+"""Analyze every image under a directory offline, appending results to a JSONL manifest
+
+    python bulk.py SOURCE_DIR [--manifest analysis.jsonl] [--workers N] [--in-flight 8]
+                              [--no-resume] [--report-every 10]
+
+Images are read, hashed, decoded and preprocessed in a pool of --workers
+processes (one per core by default), and at most --in-flight of them are
+with the model at a time. Each finished image appends one line to the
+manifest: its SHA-256, path, size, status ("done" or "failed"), the answer
+and its parsed fields, the key/model that served it, and the error if it
+failed. The manifest is flushed line by line, so a crashed or interrupted
+run picks up where it stopped: images whose hash already has a "done" line
+are skipped, and failed ones are retried. Identical files are analyzed once.
+
+Uses the same configuration (.env) as the web app, including its shared
+rate limiter, so a run on the same host stays within the API quota the web
+app is using, but does not go through the web app itself.
+"""
+import argparse
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from app.utils.image_processing import preprocess_image, preprocess_tiles
+
+# Set in each pool process by _init_worker
+_skip = frozenset()
+_preprocess = None
+_tiling = None
+
+
+def _init_worker(skip, preprocess, tiling):
+    global _skip, _preprocess, _tiling
+    _skip, _preprocess, _tiling = skip, preprocess, tiling
+
+
+def prepare(path):
+    """Read, hash and preprocess one image (runs in a pool process)
+
+    Returns a dict with path, sha256 and bytes, plus 'prepared' (a
+    PreparedImage, or a list of them for a tiled image) unless the image is
+    skipped or preprocessing is off, and 'error' if it could not be read.
+    """
+    item = {'path': path, 'sha256': None, 'bytes': 0, 'prepared': None, 'error': None}
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        item['bytes'] = len(data)
+        item['sha256'] = hashlib.sha256(data).hexdigest()
+        if item['sha256'] in _skip or _preprocess is None:
+            return item
+        if _tiling is not None:
+            item['prepared'] = preprocess_tiles(io.BytesIO(data), **_tiling)
+        if item['prepared'] is None:
+            item['prepared'] = preprocess_image(io.BytesIO(data), **_preprocess)
+    except Exception as e:
+        item['error'] = f'Error reading image: {e}'
+    return item
+
+
+def find_images(root, extensions):
+    """Paths of the files under root with an allowed image extension, in a stable order"""
+    for directory, subdirectories, filenames in os.walk(root):
+        subdirectories.sort()
+        for filename in sorted(filenames):
+            if '.' in filename and filename.rsplit('.', 1)[1].lower() in extensions:
+                yield os.path.join(directory, filename)
+
+
+def completed_hashes(manifest):
+    """SHA-256s with a "done" line in the manifest; a line cut short by a crash is ignored"""
+    done = set()
+    if not os.path.exists(manifest):
+        return done
+    with open(manifest, encoding='utf-8') as f:
+        for line in f:
+            try:
+                row = json.loads(line)
+            except ValueError:
+                continue
+            if row.get('status') == 'done':
+                done.add(row['sha256'])
+    return done
+
+
+def bounded_map(pool, fn, items, lookahead):
+    """Like pool.map, but with at most lookahead items submitted ahead of the consumer"""
+    pending = deque()
+    for item in items:
+        pending.append(pool.submit(fn, item))
+        if len(pending) >= lookahead:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+class Manifest:
+    """Append-only JSONL manifest, one flushed line per analyzed image"""
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        partial = False
+        if os.path.exists(path) and os.path.getsize(path):
+            with open(path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                partial = f.read(1) != b'\n'
+        self._file = open(path, 'a', encoding='utf-8')
+        if partial:
+            # Finish the line a crash left half-written, so the next one starts cleanly
+            self._file.write('\n')
+
+    def write(self, row, result):
+        from app.utils.result_parser import jsonl_lines
+
+        line = next(jsonl_lines([dict(row, result=result)]))
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class Progress:
+    """Counters for the run, and its throughput"""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.analyzed = self.failed = self.skipped = self.bytes = 0
+        self._lock = threading.Lock()
+
+    def add(self, outcome, size=0):
+        with self._lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+            if outcome == 'analyzed':
+                self.bytes += size
+
+    def line(self):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        return (f'{self.analyzed} analyzed, {self.failed} failed, {self.skipped} skipped in {elapsed:.0f}s: '
+                f'{self.analyzed / elapsed * 60:.1f} images/min, {self.bytes / elapsed:,.0f} bytes/s')
+
+
+def run(args):
+    from app import create_app
+    from app.services.gemini_service import get_gemini_service
+    from app.utils.image_processing import preprocess_settings, tiling_settings
+    from config import Config
+
+    app = create_app(Config)
+    skip = completed_hashes(args.manifest) if args.resume else set()
+    preprocess = preprocess_settings(app.config) if app.config['PREPROCESS_ENABLED'] else None
+    tiling = tiling_settings(app.config)
+
+    progress = Progress()
+    seen = set()
+    slots = threading.BoundedSemaphore(args.in_flight)
+    manifest = Manifest(args.manifest)
+    # Spawned, so pool processes start clean rather than inheriting the app's threads and connections
+    pool = ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context('spawn'),
+                               initializer=_init_worker, initargs=(frozenset(skip), preprocess, tiling))
+
+    def analyze(item):
+        row = {'sha256': item['sha256'], 'path': os.path.relpath(item['path'], args.source), 'bytes': item['bytes']}
+        started = time.monotonic()
+        try:
+            with app.app_context():
+                served = []
+                content = get_gemini_service().analyze_image(item['path'], served=served, prepared=item['prepared'])
+            served_by = [route.served_by for route in dict.fromkeys(served)]
+            manifest.write(dict(row, status='done', served_by=served_by, seconds=round(time.monotonic() - started, 3),
+                                error=None), {'content': content})
+            progress.add('analyzed', item['bytes'])
+        except Exception as e:
+            manifest.write(dict(row, status='failed', served_by=None, seconds=round(time.monotonic() - started, 3),
+                                error=str(e)), {})
+            progress.add('failed')
+            print(f"Failed to analyze {row['path']}: {e}", file=sys.stderr)
+        finally:
+            slots.release()
+
+    last_report = time.monotonic()
+    images = find_images(args.source, app.config['ALLOWED_EXTENSIONS'])
+    try:
+        with ThreadPoolExecutor(max_workers=args.in_flight, thread_name_prefix='bulk') as threads:
+            for item in bounded_map(pool, prepare, images, lookahead=args.workers + args.in_flight):
+                if item['error'] is not None:
+                    row = {'sha256': item['sha256'], 'path': os.path.relpath(item['path'], args.source),
+                           'bytes': item['bytes'], 'status': 'failed', 'served_by': None, 'seconds': 0,
+                           'error': item['error']}
+                    if item['sha256'] is not None:
+                        manifest.write(row, {})
+                    progress.add('failed')
+                    print(f"Failed to read {row['path']}: {item['error']}", file=sys.stderr)
+                    continue
+                if item['sha256'] in skip or item['sha256'] in seen:
+                    progress.add('skipped')
+                    continue
+                seen.add(item['sha256'])
+                slots.acquire()
+                threads.submit(analyze, item)
+                if time.monotonic() - last_report >= args.report_every:
+                    last_report = time.monotonic()
+                    print(progress.line(), file=sys.stderr)
+    finally:
+        pool.shutdown(cancel_futures=True)
+        manifest.close()
+    print(progress.line())
+    return 1 if progress.failed else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('source', help='directory to walk for images')
+    parser.add_argument('--manifest', default='analysis.jsonl')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='processes decoding and preprocessing images')
+    parser.add_argument('--in-flight', type=int, default=8, help='images with the model at once')
+    parser.add_argument('--no-resume', dest='resume', action='store_false',
+                        help='analyze images that already have a "done" line again')
+    parser.add_argument('--report-every', type=float, default=10, help='seconds between progress lines')
+    args = parser.parse_args()
+    if not os.path.isdir(args.source):
+        parser.error(f'{args.source} is not a directory')
+    sys.exit(run(args))
+
+
+if __name__ == '__main__':
+    main()
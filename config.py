@@ -5,21 +5,156 @@ from dotenv import load_dotenv
 # Load environment variables from .env file
 load_dotenv()
 
+basedir = os.path.dirname(os.path.abspath(__file__))
+
 class Config:
     """Base configuration"""
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'dev-secret-key-change-in-production'
     
     # Upload settings
-    UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app', 'static', 'uploads')
+    UPLOAD_FOLDER = os.environ.get('UPLOAD_FOLDER') or os.path.join(basedir, 'app', 'static', 'uploads')
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max file size
     ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'webp'}
+    UPLOAD_MAX_PIXELS = int(os.environ.get('UPLOAD_MAX_PIXELS', 50_000_000))  # rejected while streaming
+    
+    # Upload lifecycle - abandoned uploads expire, and the folder is kept under a quota (0 disables either)
+    UPLOAD_MAX_AGE = int(os.environ.get('UPLOAD_MAX_AGE', 24 * 3600))  # seconds since last use
+    UPLOAD_QUOTA_BYTES = int(os.environ.get('UPLOAD_QUOTA_BYTES', 2 * 1024 ** 3))
+    UPLOAD_SWEEP_INTERVAL = int(os.environ.get('UPLOAD_SWEEP_INTERVAL', 600))  # seconds, 0 = no sweeper
+    
+    # Upload previews - a display-size WebP and a tiny placeholder rendered once per stored image (0 = off)
+    PREVIEW_MAX_SIDE = int(os.environ.get('PREVIEW_MAX_SIDE', 1024))  # pixels
+    PREVIEW_PLACEHOLDER_SIDE = int(os.environ.get('PREVIEW_PLACEHOLDER_SIDE', 24))  # pixels
+    PREVIEW_QUALITY = int(os.environ.get('PREVIEW_QUALITY', 75))
+    PREVIEW_WORKERS = int(os.environ.get('PREVIEW_WORKERS', 2))  # background render threads per worker
     
     # Session settings
     PERMANENT_SESSION_LIFETIME = timedelta(hours=2)
     
     # Gemini API settings - Loaded from environment variables
-    GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')
+    # GEMINI_API_KEYS (comma-separated) adds keys to spread calls over; GEMINI_API_KEY is the primary
+    GEMINI_API_KEYS = [key.strip() for key in os.environ.get('GEMINI_API_KEYS', '').split(',') if key.strip()]
+    GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY') or next(iter(GEMINI_API_KEYS), None)
     GEMINI_MODEL = os.environ.get('GEMINI_MODEL', 'gemini-3-pro-preview')
+    # Each worker reloads GEMINI_API_KEY(S), GEMINI_MODEL, GEMINI_FALLBACK_MODELS and PROMPT_VARIANT
+    # from ENV_FILE when it changes, checking at most every CONFIG_RELOAD_INTERVAL seconds (0 = off)
+    ENV_FILE = os.environ.get('ENV_FILE') or os.path.join(basedir, '.env')
+    CONFIG_RELOAD_INTERVAL = float(os.environ.get('CONFIG_RELOAD_INTERVAL', 5))
+    # Models to fall back to, in order, when GEMINI_MODEL is saturated or slow (comma-separated)
+    GEMINI_FALLBACK_MODELS = [model.strip() for model in os.environ.get('GEMINI_FALLBACK_MODELS', '').split(',')
+                              if model.strip()]
+    
+    # Key/model routing - a key is set aside after ROUTER_BREAKER_THRESHOLD 429s in a row, and a
+    # key/model averaging over ROUTER_SLOW_AFTER seconds per call (0 = never), for the cooldown
+    ROUTER_BREAKER_THRESHOLD = int(os.environ.get('ROUTER_BREAKER_THRESHOLD', 3))
+    ROUTER_BREAKER_COOLDOWN = int(os.environ.get('ROUTER_BREAKER_COOLDOWN', 60))  # seconds
+    ROUTER_SLOW_AFTER = float(os.environ.get('ROUTER_SLOW_AFTER', 0))
+    
+    # Admission control - ADMISSION_SLOTS concurrent model calls per worker (0 = off), shared by the
+    # interactive and batch lanes in proportion ADMISSION_INTERACTIVE_WEIGHT:1. A request whose
+    # projected wait exceeds its lane's deadline gets a 503 with Retry-After (0 = never reject)
+    # Unset, the slots are the calls GEMINI_RPM sustains at ADMISSION_MODEL_LATENCY seconds each,
+    # split over the Gunicorn workers, so requests beyond that wait in the lanes rather than the limiter
+    ADMISSION_SLOTS = int(os.environ['ADMISSION_SLOTS']) if os.environ.get('ADMISSION_SLOTS') else None
+    ADMISSION_MODEL_LATENCY = float(os.environ.get('ADMISSION_MODEL_LATENCY', 10))  # expected seconds per call
+    ADMISSION_INTERACTIVE_WEIGHT = int(os.environ.get('ADMISSION_INTERACTIVE_WEIGHT', 4))
+    ADMISSION_CLIENT_MAX = int(os.environ.get('ADMISSION_CLIENT_MAX', 0))  # slots one client may hold, 0 = no cap
+    ADMISSION_INTERACTIVE_DEADLINE = float(os.environ.get('ADMISSION_INTERACTIVE_DEADLINE', 60))  # seconds
+    ADMISSION_BATCH_DEADLINE = float(os.environ.get('ADMISSION_BATCH_DEADLINE', 0))  # seconds
+    
+    # Client identity - TRUSTED_PROXIES reverse proxies whose X-Forwarded-For gives the client address;
+    # X-Client-Id is only believed from callers sending X-Client-Secret equal to CLIENT_ID_SECRET
+    TRUSTED_PROXIES = int(os.environ.get('TRUSTED_PROXIES', 0))
+    CLIENT_ID_SECRET = os.environ.get('CLIENT_ID_SECRET')
+    
+    # Analysis prompt - a template from PROMPT_FOLDER by name ("analysis", "compact") or version ("analysis.v1")
+    PROMPT_FOLDER = os.path.join(basedir, 'app', 'prompts')
+    PROMPT_VARIANT = os.environ.get('PROMPT_VARIANT', 'analysis')
+    # Seconds to keep the prompt in a Gemini context cache, where the SDK supports it (0 = off)
+    PROMPT_CONTEXT_CACHE_TTL = int(os.environ.get('PROMPT_CONTEXT_CACHE_TTL', 0))
+    # Ask the model for JSON fields instead of markdown bullets, where the SDK supports response schemas
+    STRUCTURED_OUTPUT = os.environ.get('STRUCTURED_OUTPUT', 'false').lower() == 'true'
+    
+    # Model backend - "gemini", or "fake" for a local stand-in (benchmarks, offline runs)
+    MODEL_BACKEND = os.environ.get('MODEL_BACKEND', 'gemini')
+    FAKE_MODEL_LATENCY = float(os.environ.get('FAKE_MODEL_LATENCY', 1.0))  # median seconds per call
+    FAKE_MODEL_LATENCY_SIGMA = float(os.environ.get('FAKE_MODEL_LATENCY_SIGMA', 0.3))  # lognormal spread, 0 = fixed
+    FAKE_MODEL_429_RATE = float(os.environ.get('FAKE_MODEL_429_RATE', 0))  # share of calls failing with 429
+    FAKE_MODEL_DEADLINE_RATE = float(os.environ.get('FAKE_MODEL_DEADLINE_RATE', 0))
+    FAKE_MODEL_EMPTY_RATE = float(os.environ.get('FAKE_MODEL_EMPTY_RATE', 0))
+    FAKE_MODEL_OUTPUTS = os.environ.get('FAKE_MODEL_OUTPUTS')  # JSON list of canned answers
+    FAKE_MODEL_SEED = int(os.environ.get('FAKE_MODEL_SEED', 0))
+    
+    # Local state shared by all workers on this host (SQLite files etc.)
+    DATA_FOLDER = os.environ.get('DATA_FOLDER') or os.path.join(basedir, 'instance')
+    
+    # Analysis result cache - backend is "memory" (per worker), "sqlite" (shared) or "none"
+    RESULT_CACHE_BACKEND = os.environ.get('RESULT_CACHE_BACKEND', 'memory')
+    RESULT_CACHE_PATH = os.path.join(DATA_FOLDER, 'result_cache.sqlite3')
+    RESULT_CACHE_TTL = int(os.environ.get('RESULT_CACHE_TTL', 7 * 24 * 3600))  # seconds
+    RESULT_CACHE_MAX_ENTRIES = int(os.environ.get('RESULT_CACHE_MAX_ENTRIES', 1000))
+    
+    # Near-duplicate detection: off, flag (report re-scans at upload) or reuse (also answer them from the cache)
+    NEAR_DUPLICATE_MODE = os.environ.get('NEAR_DUPLICATE_MODE', 'off').lower()
+    NEAR_DUPLICATE_THRESHOLD = int(os.environ.get('NEAR_DUPLICATE_THRESHOLD', 8))  # differing bits of the 64-bit hash
+    NEAR_DUPLICATE_PATH = os.path.join(DATA_FOLDER, 'perceptual_index.sqlite3')
+    NEAR_DUPLICATE_MAX_ENTRIES = int(os.environ.get('NEAR_DUPLICATE_MAX_ENTRIES', 1_000_000))
+    
+    # Single-flight: concurrent analyses of the same image share one model call, within a worker
+    # ("worker"), across all workers on the host ("host") or not at all ("off")
+    SINGLE_FLIGHT = os.environ.get('SINGLE_FLIGHT', 'host').lower()
+    SINGLE_FLIGHT_PATH = os.path.join(DATA_FOLDER, 'single_flight.sqlite3')
+    SINGLE_FLIGHT_LEASE_TTL = int(os.environ.get('SINGLE_FLIGHT_LEASE_TTL', 300))  # seconds before a lease is taken over
+    SINGLE_FLIGHT_POLL_INTERVAL = 0.2  # seconds between checks on another worker's call
+    
+    # Background analysis jobs - each worker runs up to ANALYSIS_WORKERS analyses at once; one per
+    # gthread thread by default, since admission control, not the pool, limits concurrent model calls
+    JOB_STORE_PATH = os.path.join(DATA_FOLDER, 'jobs.sqlite3')
+    ANALYSIS_WORKERS = int(os.environ.get('ANALYSIS_WORKERS', os.environ.get('GUNICORN_THREADS', 200)))
+    JOB_STALE_AFTER = int(os.environ.get('JOB_STALE_AFTER', 300))  # seconds without a heartbeat from the job's worker
+    JOB_RETENTION = int(os.environ.get('JOB_RETENTION', 24 * 3600))  # seconds to keep finished jobs
+    JOB_EVENTS_POLL_INTERVAL = 0.5  # seconds between SSE status checks
+    EXPORT_MAX_ROWS = int(os.environ.get('EXPORT_MAX_ROWS', 10000))  # finished jobs per /api/export response
+    
+    # Speculative analysis - start analyzing each upload before /api/analyze asks for it (opt-in)
+    SPECULATIVE_ANALYSIS = os.environ.get('SPECULATIVE_ANALYSIS', 'false').lower() == 'true'
+    SPECULATION_TTL = int(os.environ.get('SPECULATION_TTL', 600))  # seconds an unclaimed result is kept for /api/analyze
+    
+    # Batch analysis - BATCH_MAX_IN_FLIGHT caps concurrent model calls per worker across all batches
+    BATCH_MAX_IN_FLIGHT = int(os.environ.get('BATCH_MAX_IN_FLIGHT', 8))
+    BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', 500))
+    
+    # Outbound Gemini rate limiting, shared by all workers (GEMINI_RPM=0 disables it)
+    GEMINI_RPM = int(os.environ.get('GEMINI_RPM', 60))
+    GEMINI_TPM = int(os.environ.get('GEMINI_TPM', 0))  # 0 = no token budget
+    RATE_LIMITER_PATH = os.path.join(DATA_FOLDER, 'rate_limiter.sqlite3')
+    RATE_LIMIT_MAX_WAIT = int(os.environ.get('RATE_LIMIT_MAX_WAIT', 60))  # seconds a call may wait for a slot
+    
+    # Retries for quota and transient errors (jittered exponential backoff)
+    GEMINI_MAX_RETRIES = int(os.environ.get('GEMINI_MAX_RETRIES', 4))
+    GEMINI_RETRY_BASE_DELAY = float(os.environ.get('GEMINI_RETRY_BASE_DELAY', 2))
+    GEMINI_RETRY_MAX_DELAY = float(os.environ.get('GEMINI_RETRY_MAX_DELAY', 30))
+    
+    # Metrics - counters and histograms aggregated across workers, served on /metrics
+    METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+    METRICS_PATH = os.path.join(DATA_FOLDER, 'metrics.sqlite3')
+    METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 5))  # seconds
+    SERVER_TIMING = os.environ.get('SERVER_TIMING', 'false').lower() == 'true'  # per-stage Server-Timing headers
+    
+    # Image preprocessing before upload to the model
+    PREPROCESS_ENABLED = os.environ.get('PREPROCESS_ENABLED', 'true').lower() == 'true'
+    PREPROCESS_MAX_SIZE = int(os.environ.get('PREPROCESS_MAX_SIZE', 1536))  # longest side in pixels
+    PREPROCESS_FORMAT = os.environ.get('PREPROCESS_FORMAT', 'JPEG')  # JPEG or WEBP
+    PREPROCESS_BYTE_BUDGET = int(os.environ.get('PREPROCESS_BYTE_BUDGET', 300 * 1024))
+    PREPROCESS_MIN_QUALITY = int(os.environ.get('PREPROCESS_MIN_QUALITY', 50))
+    PREPROCESS_MAX_QUALITY = int(os.environ.get('PREPROCESS_MAX_QUALITY', 85))
+    PREPROCESS_GRAYSCALE = os.environ.get('PREPROCESS_GRAYSCALE', 'true').lower() == 'true'  # only near-gray images
+    
+    # Tiled analysis - large images are cut into overlapping PREPROCESS_MAX_SIZE tiles analyzed concurrently
+    TILING_ENABLED = os.environ.get('TILING_ENABLED', 'false').lower() == 'true'
+    TILING_MIN_SIDE = int(os.environ.get('TILING_MIN_SIDE', 3072))  # only images with a longer side are tiled
+    TILING_OVERLAP = float(os.environ.get('TILING_OVERLAP', 0.1))  # fraction of a tile shared with neighbours
+    TILING_MAX_TILES = int(os.environ.get('TILING_MAX_TILES', 6))  # model calls per image at most
     
     # Ensure upload folder exists
     os.makedirs(UPLOAD_FOLDER, exist_ok=True)
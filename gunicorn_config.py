@@ -1,21 +1,58 @@
 # Gunicorn configuration file
 import multiprocessing
+import os
+import time
+from dotenv import load_dotenv
+
+# GUNICORN_* settings may come from .env like the app's own
+load_dotenv()
 
 # Server socket
-bind = "0.0.0.0:5000"
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:5000")
 backlog = 2048
 
 # Worker processes
-workers = multiprocessing.cpu_count() * 2 + 1
-worker_class = "sync"
-worker_connections = 1000
-timeout = 120  # 120 seconds for long-running analysis
+#
+# Requests spend nearly all their time waiting on Gemini, so the default
+# profile serves them from threads rather than processes:
+#   gthread - a few processes with many threads each (default)
+#   gevent  - a few processes with greenlets; needs `pip install gevent`
+#   sync    - one request per process, cpu_count * 2 + 1 processes
+SERVING_PROFILE = os.environ.get("GUNICORN_PROFILE", "gthread")
+
+if SERVING_PROFILE == "sync":
+    workers = multiprocessing.cpu_count() * 2 + 1
+    worker_class = "sync"
+elif SERVING_PROFILE == "gthread":
+    workers = multiprocessing.cpu_count()
+    worker_class = "gthread"
+    threads = int(os.environ.get("GUNICORN_THREADS", 200))  # in-flight requests per worker
+elif SERVING_PROFILE == "gevent":
+    workers = multiprocessing.cpu_count()
+    worker_class = "gevent"
+else:
+    raise ValueError(f"Unknown GUNICORN_PROFILE: {SERVING_PROFILE}")
+
+workers = int(os.environ.get("GUNICORN_WORKERS", workers))
+worker_connections = int(os.environ.get("GUNICORN_WORKER_CONNECTIONS", 1000))  # gevent: in-flight requests per worker
+timeout = 120  # only blocking {"wait": true} analyses run this long; jobs run in background threads
 keepalive = 5
 
 # Request handling
 max_requests = 1000
 max_requests_jitter = 50
 
+# Startup
+#
+# Workers are recycled every max_requests requests. With preload_app the
+# master imports the app and the model SDK once, and forked workers share
+# those pages copy-on-write instead of each importing them again; each worker
+# then builds its own model client before taking requests (post_worker_init).
+# Preloaded code is not reloaded on HUP, so restart the master after deploys,
+# or set GUNICORN_PRELOAD=false. Off by default for gevent, which must patch
+# the standard library before the app is imported.
+preload_app = os.environ.get("GUNICORN_PRELOAD", "false" if SERVING_PROFILE == "gevent" else "true").lower() == "true"
+
 # Logging
 accesslog = "-"
 errorlog = "-"
@@ -36,3 +73,36 @@ tmp_upload_dir = None
 # SSL
 keyfile = None
 certfile = None
+
+
+# Server hooks
+def when_ready(server):
+    """Import the model SDK in a preloading master, so workers inherit it rather than import it"""
+    if preload_app:
+        from app.services.model_backends import load_sdk
+        load_sdk(server.app.wsgi().config["MODEL_BACKEND"])
+
+
+def post_fork(server, worker):
+    worker.forked_at = time.monotonic()
+
+
+def post_worker_init(worker):
+    """Make gRPC (used by the Gemini SDK) cooperate with gevent's event loop, then warm the model client"""
+    if SERVING_PROFILE == "gevent":
+        from grpc.experimental import gevent as grpc_gevent
+        grpc_gevent.init_gevent()
+
+    from app.services.gemini_service import warm_gemini_service
+    from app.services.metrics import record_stage
+
+    app = worker.wsgi
+    try:
+        warm_gemini_service(app)
+    except Exception as e:
+        # The first request builds the client instead
+        worker.log.warning("Model client warm-up failed: %s", e)
+    ready = time.monotonic() - worker.forked_at
+    with app.app_context():
+        record_stage("worker.ready", ready)
+    worker.log.info("Worker %s ready in %.3fs", worker.pid, ready)
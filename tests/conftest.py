@@ -0,0 +1,56 @@
+import io
+import os
+
+import pytest
+from PIL import Image
+
+from app import create_app
+from config import Config
+
+
+@pytest.fixture
+def make_app(tmp_path):
+    """Build an app on the fake model backend, with its state under tmp_path"""
+
+    def make(**overrides):
+        data = tmp_path / 'data'
+        settings = {
+            'TESTING': True,
+            'UPLOAD_FOLDER': str(tmp_path / 'uploads'),
+            'DATA_FOLDER': str(data),
+            'RESULT_CACHE_PATH': str(data / 'result_cache.sqlite3'),
+            'NEAR_DUPLICATE_PATH': str(data / 'perceptual_index.sqlite3'),
+            'SINGLE_FLIGHT_PATH': str(data / 'single_flight.sqlite3'),
+            'JOB_STORE_PATH': str(data / 'jobs.sqlite3'),
+            'RATE_LIMITER_PATH': str(data / 'rate_limiter.sqlite3'),
+            'METRICS_PATH': str(data / 'metrics.sqlite3'),
+            'ENV_FILE': str(tmp_path / '.env'),
+            'MODEL_BACKEND': 'fake',
+            'FAKE_MODEL_LATENCY': 0.05,
+            'FAKE_MODEL_LATENCY_SIGMA': 0.0,
+            'GEMINI_RPM': 0,
+            'PREVIEW_MAX_SIDE': 0,
+        }
+        settings.update(overrides)
+        os.makedirs(settings['UPLOAD_FOLDER'], exist_ok=True)
+        return create_app(type('TestConfig', (Config,), settings))
+
+    return make
+
+
+@pytest.fixture
+def image_file(tmp_path):
+    """Write a small JPEG and return its path; each color gives different bytes"""
+
+    def make(color=(200, 30, 30), size=(64, 48), name='image.jpg'):
+        path = tmp_path / name
+        Image.new('RGB', size, color).save(path, 'JPEG')
+        return str(path)
+
+    return make
+
+
+def jpeg_bytes(color=(200, 30, 30), size=(64, 48), image_format='JPEG'):
+    buf = io.BytesIO()
+    Image.new('RGB', size, color).save(buf, image_format)
+    return buf.getvalue()
@@ -0,0 +1,186 @@
+import threading
+import time
+
+import pytest
+
+from app.api.routes import _client_id
+from app.services.admission import AdmissionController, AdmissionRejected
+from config import Config
+
+
+def controller(slots=1, interactive_deadline=0, batch_deadline=0, client_max=0):
+    return AdmissionController(
+        slots,
+        weights={'interactive': 4, 'batch': 1},
+        deadlines={'interactive': interactive_deadline, 'batch': batch_deadline},
+        client_max=client_max,
+    )
+
+
+def hold_slot(admission, lane='interactive', client=None):
+    """Take a slot on a thread and keep it until the returned event is set"""
+    held, release = threading.Event(), threading.Event()
+
+    def hold():
+        with admission.slot(lane, client):
+            held.set()
+            release.wait(5)
+
+    thread = threading.Thread(target=hold)
+    thread.start()
+    held.wait(5)
+    return thread, release
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.005)
+
+
+def test_freed_slots_follow_lane_weights():
+    admission = controller()
+    holder, release = hold_slot(admission)
+    order = []
+    lock = threading.Lock()
+
+    def wait_in(lane):
+        with admission.slot(lane):
+            with lock:
+                order.append(lane)
+
+    threads = []
+    for lane in ('interactive', 'batch'):
+        for _ in range(5):
+            thread = threading.Thread(target=wait_in, args=(lane,))
+            thread.start()
+            threads.append(thread)
+        wait_until(lambda: admission.stats()['lanes'][lane]['queued'] == 5)
+
+    release.set()
+    for thread in [holder] + threads:
+        thread.join(5)
+    # Interactive gets four slots for each one batch gets, and batch is not starved
+    assert order[:5].count('interactive') == 4
+    assert 'batch' in order[:5]
+    assert sorted(order) == ['batch'] * 5 + ['interactive'] * 5
+
+
+def test_client_cap_lets_other_clients_go_first():
+    admission = controller(slots=2, client_max=1)
+    holder, release = hold_slot(admission, client='a')
+    order = []
+
+    def wait_as(client):
+        with admission.slot('interactive', client):
+            order.append(client)
+
+    first = threading.Thread(target=wait_as, args=('a',))
+    first.start()
+    wait_until(lambda: admission.stats()['lanes']['interactive']['queued'] == 1)
+    second = threading.Thread(target=wait_as, args=('b',))
+    second.start()
+    second.join(5)
+    assert order == ['b']  # a's second request waits for its first to finish
+    release.set()
+    for thread in (holder, first):
+        thread.join(5)
+    assert order == ['b', 'a']
+
+
+def test_projected_wait_beyond_deadline_is_rejected_up_front():
+    admission = controller(interactive_deadline=5)
+    holder, release = hold_slot(admission)
+    admission.service_time = 10.0  # each analysis holds its slot for about 10 s
+    try:
+        with pytest.raises(AdmissionRejected) as rejected:
+            admission.check('interactive')
+        assert rejected.value.status_code == 503
+        assert rejected.value.retry_after == 10
+        with pytest.raises(AdmissionRejected):
+            with admission.slot('interactive'):
+                pass
+        # Batch has no deadline: it waits instead of being turned away
+        admission.check('batch')
+        assert admission.stats()['lanes']['interactive']['rejected'] == 2
+    finally:
+        release.set()
+        holder.join(5)
+
+
+def test_short_projected_wait_is_admitted():
+    admission = controller(interactive_deadline=60)
+    admission.service_time = 10.0
+    admission.check('interactive')  # a free slot means no wait at all
+    holder, release = hold_slot(admission)
+    admission.check('interactive')  # one slot's average hold time, under the deadline
+    release.set()
+    holder.join(5)
+
+
+@pytest.mark.parametrize('secret, headers, expected', [
+    (None, {'X-Client-Id': 'spoofed'}, '10.0.0.1'),
+    ('s3cret', {'X-Client-Id': 'spoofed', 'X-Client-Secret': 'wrong'}, '10.0.0.1'),
+    ('s3cret', {'X-Client-Id': 'tenant-7', 'X-Client-Secret': 's3cret'}, 'tenant-7'),
+])
+def test_client_id_header_needs_the_shared_secret(make_app, secret, headers, expected):
+    app = make_app(CLIENT_ID_SECRET=secret)
+    with app.test_request_context(headers=headers, environ_base={'REMOTE_ADDR': '10.0.0.1'}):
+        assert _client_id() == expected
+
+
+def test_trusted_proxy_supplies_the_client_address(make_app):
+    app = make_app(TRUSTED_PROXIES=1)
+    seen = []
+
+    @app.route('/whoami')
+    def whoami():
+        seen.append(_client_id())
+        return ''
+
+    app.test_client().get('/whoami', headers={'X-Forwarded-For': '203.0.113.9'},
+                          environ_base={'REMOTE_ADDR': '10.0.0.1'})
+    assert seen == ['203.0.113.9']
+
+
+def test_default_slots_follow_the_rate_limit(make_app, monkeypatch):
+    monkeypatch.setenv('GUNICORN_WORKERS', '4')
+    assert make_app(GEMINI_RPM=60).extensions['admission'].slots == 3
+    assert make_app(GEMINI_RPM=60, GEMINI_API_KEY='a', GEMINI_API_KEYS=['a', 'b', 'c']).extensions['admission'].slots == 8
+    assert make_app(GEMINI_RPM=0).extensions['admission'].slots == 200
+    assert make_app(GEMINI_RPM=60, ADMISSION_SLOTS=0).extensions['admission'] is None
+
+
+def test_batch_yields_to_interactive_with_default_settings(make_app, monkeypatch):
+    monkeypatch.delenv('GUNICORN_WORKERS', raising=False)
+    app = make_app(GEMINI_RPM=Config.GEMINI_RPM)
+    admission = app.extensions['admission']
+    # Fewer slots than the worker's 200 threads, or the lanes would never fill
+    assert admission.slots < 200
+    holders = [hold_slot(admission) for _ in range(admission.slots)]
+    order = []
+    lock = threading.Lock()
+
+    def wait_in(lane):
+        with admission.slot(lane):
+            with lock:
+                order.append(lane)
+
+    threads = []
+    for lane in ('batch', 'interactive'):
+        for _ in range(5):
+            thread = threading.Thread(target=wait_in, args=(lane,))
+            thread.start()
+            threads.append(thread)
+        wait_until(lambda: admission.stats()['lanes'][lane]['queued'] == 5)
+
+    # One freed slot serves the whole queue, in lane order
+    holders[0][1].set()
+    for thread in threads:
+        thread.join(5)
+    for holder, release in holders:
+        release.set()
+        holder.join(5)
+    assert order[:5].count('interactive') == 4
+    assert sorted(order) == ['batch'] * 5 + ['interactive'] * 5
@@ -0,0 +1,40 @@
+import os
+import time
+
+from app.services.gemini_service import get_gemini_service
+
+
+def rewrite(path, text):
+    mtime = os.stat(path).st_mtime_ns if os.path.exists(path) else 0
+    path.write_text(text)
+    # Coarse filesystem clocks could otherwise leave the mtime unchanged
+    os.utime(path, ns=(mtime + 10 ** 9, mtime + 10 ** 9))
+
+
+def test_changed_env_file_swaps_the_service_and_limits_the_new_route(make_app, tmp_path):
+    env_file = tmp_path / '.env'
+    rewrite(env_file, 'GEMINI_API_KEY=first-key\n')
+    app = make_app(GEMINI_RPM=60, GEMINI_API_KEY='first-key', GEMINI_MODEL='model', CONFIG_RELOAD_INTERVAL=0.01)
+    with app.app_context():
+        first = get_gemini_service()
+        assert get_gemini_service() is first
+
+        rewrite(env_file, 'GEMINI_API_KEY=second-key\nGEMINI_MODEL=other-model\nGEMINI_FALLBACK_MODELS=spare\n')
+        time.sleep(0.02)
+        second = get_gemini_service()
+
+        assert second is not first
+        assert (app.config['GEMINI_API_KEY'], app.config['GEMINI_MODEL']) == ('second-key', 'other-model')
+        assert {('second-key', 'other-model'), ('second-key', 'spare')} <= set(app.extensions['rate_limiters'])
+        assert get_gemini_service() is second
+
+
+def test_env_file_is_not_reloaded_when_checks_are_off(make_app, tmp_path):
+    env_file = tmp_path / '.env'
+    rewrite(env_file, 'GEMINI_API_KEY=first-key\n')
+    app = make_app(GEMINI_API_KEY='first-key', CONFIG_RELOAD_INTERVAL=0)
+    with app.app_context():
+        first = get_gemini_service()
+        rewrite(env_file, 'GEMINI_API_KEY=second-key\n')
+        assert get_gemini_service() is first
+        assert app.config['GEMINI_API_KEY'] == 'first-key'
@@ -0,0 +1,74 @@
+import io
+import json
+import sqlite3
+import time
+
+from conftest import jpeg_bytes
+from app.services.job_queue import JobStore, get_job_queue
+
+
+def upload(client, color):
+    response = client.post('/api/upload', data={'file': (io.BytesIO(jpeg_bytes(color)), 'photo.jpg')},
+                           content_type='multipart/form-data')
+    return response.get_json()['filename']
+
+
+def exported(client):
+    response = client.get('/api/export')
+    assert response.status_code == 200
+    return [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+
+def wait_for_job(app, job_id):
+    with app.app_context():
+        for _ in range(100):
+            if get_job_queue().get(job_id)['status'] == 'done':
+                return
+            time.sleep(0.02)
+    raise AssertionError('speculative job did not finish')
+
+
+def test_results_answered_in_the_request_are_exported(make_app):
+    app = make_app()
+    client = app.test_client()
+
+    assert client.post('/api/analyze', json={'filename': upload(client, (10, 0, 0)), 'wait': True}).status_code == 200
+    assert client.post('/api/analyze', data={'file': (io.BytesIO(jpeg_bytes((20, 0, 0))), 'direct.jpg')},
+                       content_type='multipart/form-data').status_code == 200
+    stream = client.post('/api/analyze/stream', json={'filename': upload(client, (30, 0, 0))})
+    assert 'event: done' in stream.get_data(as_text=True)
+    batch = client.post('/api/analyze/batch', json={'filenames': [upload(client, (40, 0, 0)), 'missing.jpg']})
+    assert len(batch.get_data(as_text=True).splitlines()) == 3
+
+    records = exported(client)
+    assert len(records) == 4
+    assert 'direct.jpg' in [record['filename'] for record in records]
+    assert all(record['content'] for record in records)
+
+
+def test_unclaimed_speculation_is_not_exported(make_app):
+    app = make_app(SPECULATIVE_ANALYSIS=True)
+    client = app.test_client()
+    filename = upload(client, (50, 0, 0))
+    with app.app_context():
+        job_id = app.extensions['speculator']._connections.get().execute(
+            'SELECT job_id FROM speculations WHERE filename = ?', (filename,)
+        ).fetchone()[0]
+    wait_for_job(app, job_id)
+    assert exported(client) == []
+
+    response = client.post('/api/analyze', json={'filename': filename, 'wait': True})
+    assert response.get_json()['result']['speculative'] is True
+    assert [record['job_id'] for record in exported(client)] == [job_id]
+
+
+def test_job_table_without_speculative_column_is_upgraded(tmp_path):
+    path = str(tmp_path / 'jobs.sqlite3')
+    with sqlite3.connect(path) as conn:
+        conn.execute(
+            'CREATE TABLE jobs (id TEXT PRIMARY KEY, filename TEXT NOT NULL, status TEXT NOT NULL, result TEXT,'
+            ' error TEXT, error_status INTEGER, created_at REAL NOT NULL, updated_at REAL NOT NULL)'
+        )
+        conn.execute("INSERT INTO jobs VALUES ('old', 'a.jpg', 'done', '{\"content\": \"x\"}', NULL, NULL, 1, 1)")
+    store = JobStore(path)
+    assert [job['job_id'] for job in store.finished()] == ['old']
@@ -0,0 +1,59 @@
+import io
+import os
+
+import pytest
+
+from conftest import jpeg_bytes
+
+
+def upload(client, data, name):
+    return client.post('/api/upload', data={'file': (io.BytesIO(data), name)}, content_type='multipart/form-data')
+
+
+def stored_files(app):
+    return [name for _, _, names in os.walk(app.config['UPLOAD_FOLDER']) for name in names]
+
+
+@pytest.mark.parametrize('data, name, message', [
+    (b'\xff\xd8\xff', 'x.jpg', 'not a valid image'),
+    (jpeg_bytes()[:40], 'cut.jpg', 'not a valid image'),
+    (b'not an image at all', 'x.png', 'not a supported image'),
+    (jpeg_bytes(image_format='PNG'), 'scan.jpg', 'does not match its .jpg extension'),
+    (jpeg_bytes(), 'photo.png', 'does not match its .png extension'),
+])
+def test_rejected_uploads_are_not_stored(make_app, data, name, message):
+    app = make_app()
+    response = upload(app.test_client(), data, name)
+    assert response.status_code == 400
+    assert message in response.get_json()['error']
+    assert stored_files(app) == []
+
+
+@pytest.mark.parametrize('image_format, name', [('JPEG', 'photo.jpeg'), ('PNG', 'scan.png'), ('WEBP', 'pic.webp')])
+def test_real_images_are_stored(make_app, image_format, name):
+    app = make_app()
+    response = upload(app.test_client(), jpeg_bytes(image_format=image_format), name)
+    assert response.status_code == 200
+    assert response.get_json()['filename'].endswith(os.path.splitext(name)[1])
+
+
+def test_batch_reports_a_fake_image_without_failing_the_rest(make_app):
+    app = make_app()
+    response = app.test_client().post('/api/analyze/batch', data={'files': [
+        (io.BytesIO(b'\xff\xd8\xff'), 'fake.jpg'),
+        (io.BytesIO(jpeg_bytes()), 'real.jpg'),
+    ]}, content_type='multipart/form-data')
+    lines = [line for line in response.data.decode().splitlines() if line]
+    assert response.status_code == 200
+    assert any('not a valid image' in line for line in lines)
+    assert any('"success": true' in line for line in lines)
+
+
+def test_uploads_outside_static_are_still_served(make_app):
+    app = make_app()  # UPLOAD_FOLDER is a temp directory here
+    client = app.test_client()
+    data = jpeg_bytes()
+    file_url = upload(client, data, 'photo.jpg').get_json()['file_url']
+    response = client.get(file_url.replace('http://localhost', ''))
+    assert response.status_code == 200
+    assert response.data == data
@@ -0,0 +1,43 @@
+import time
+
+from app.services.job_queue import get_job_queue
+
+
+def wait_for(queue, job_ids, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        jobs = [queue.get(job_id) for job_id in job_ids]
+        if all(job['status'] in ('done', 'failed') for job in jobs):
+            return jobs
+        time.sleep(0.05)
+    raise AssertionError('jobs did not finish')
+
+
+def test_jobs_waiting_behind_the_pool_are_not_failed_as_stale(make_app, image_file):
+    app = make_app(ANALYSIS_WORKERS=1, JOB_STALE_AFTER=0.3, FAKE_MODEL_LATENCY=0.4)
+    with app.app_context():
+        queue = get_job_queue()
+        job_ids = [queue.submit(image_file(color=(i * 40, 0, 0), name=f'{i}.jpg'), f'{i}.jpg') for i in range(3)]
+        jobs = wait_for(queue, job_ids)
+    assert [job['status'] for job in jobs] == ['done'] * 3
+
+
+def test_a_finished_job_keeps_its_status(make_app):
+    app = make_app()
+    with app.app_context():
+        store = get_job_queue().store
+        job_id = store.create('a.jpg')
+        store.update(job_id, 'failed', error='Analysis worker stopped responding. Please try again.', error_status=504)
+        store.update(job_id, 'done', result={'content': 'late'})
+        job = store.get(job_id)
+    assert job['status'] == 'failed' and job['result'] is None
+
+
+def test_a_job_failed_before_it_started_is_not_run(make_app, image_file):
+    app = make_app()
+    queue = app.extensions['job_queue']
+    job_id = queue.store.create('a.jpg')
+    queue.store.update(job_id, 'failed', error='stale', error_status=504)
+    queue._run(job_id, image_file(), True, 'interactive', None)
+    assert queue.store.get(job_id)['status'] == 'failed'
+    assert app.extensions['gemini_services'] is not None and len(app.extensions['gemini_services']) == 0
@@ -0,0 +1,52 @@
+import threading
+
+from app.services.model_router import ModelRouter, Route
+
+
+def make_router(budget):
+    routes = [Route('0', 'key-0', 'model', None, 0), Route('1', 'key-1', 'model', None, 0)]
+    return ModelRouter(routes, budget=budget)
+
+
+def test_budgets_are_read_outside_the_lock_and_reused():
+    reads = []
+    router = None
+
+    def budget(route):
+        assert not router._lock.locked()
+        reads.append(route)
+        return 10 if route.label == '1' else 5
+
+    router = make_router(budget)
+    chosen = [router.choose() for _ in range(20)]
+    assert all(route.label == '1' for route in chosen)
+    assert router.has_alternative(chosen[0]) is False
+    assert len(reads) == 2
+    assert [entry['budget'] for entry in router.stats()] == [5, 10]
+
+
+def test_slow_budget_reads_do_not_hold_up_other_calls():
+    reading, release = threading.Event(), threading.Event()
+    router = None
+
+    def budget(route):
+        if threading.current_thread().name == 'slow-reader':
+            reading.set()
+            release.wait(5)
+        return 1
+
+    router = make_router(budget)
+    router._budgets = (0.0, {})
+    slow = threading.Thread(target=router.choose, name='slow-reader')
+    slow.start()
+    assert reading.wait(5)
+    try:
+        # The slow reader holds no lock, so a call with a fresh reading still gets a route
+        router._budgets = (float('inf'), {route: 1 for route in router.routes})
+        other = threading.Thread(target=router.choose)
+        other.start()
+        other.join(1)
+        assert not other.is_alive()
+    finally:
+        release.set()
+        slow.join()
@@ -0,0 +1,31 @@
+from app.services.rate_limiter import get_rate_limiter
+
+
+def test_limiters_are_off_without_rpm(make_app):
+    app = make_app()
+    with app.app_context():
+        assert get_rate_limiter() is None
+        assert get_rate_limiter('other-key', 'other-model') is None
+
+
+def test_route_changed_on_config_is_limited(make_app):
+    app = make_app(GEMINI_RPM=60, GEMINI_API_KEY='first-key', GEMINI_MODEL='model')
+    with app.app_context():
+        first = get_rate_limiter()
+        assert first is not None
+        app.config['GEMINI_API_KEY'] = 'second-key'
+        second = get_rate_limiter()
+        assert second is not None and second is not first
+        assert get_rate_limiter('second-key', 'model') is second
+        assert get_rate_limiter('first-key', 'model') is first
+
+
+def test_new_route_shares_its_bucket_across_apps(make_app):
+    limiters = []
+    for _ in range(2):
+        app = make_app(GEMINI_RPM=60, GEMINI_API_KEY='first-key', GEMINI_MODEL='model')
+        with app.app_context():
+            limiter = get_rate_limiter('second-key', 'model')
+            limiter.acquire()
+            limiters.append(limiter)
+    assert limiters[1].stats()['granted'] == 2
@@ -0,0 +1,43 @@
+import json
+
+from app.services.gemini_service import GeminiService
+from app.utils.result_parser import Field, FieldText, fields_from_json, parse_fields
+
+
+class JsonBackend:
+    output_format = 'json'
+
+    def __init__(self, fields):
+        self.text = json.dumps(fields)
+
+    def generate(self, image_part):
+        return self.text
+
+
+def test_uncertain_flag_survives_the_markdown_round_trip():
+    fields = fields_from_json('[{"name": "Name", "value": "Ravi", "uncertain": true}]')
+    assert fields[0].uncertain and fields[0].value == 'Ravi [?]'
+    parsed = parse_fields(str(FieldText.render(fields)))
+    assert [(f.name, f.value, f.uncertain) for f in parsed] == [('Name', 'Ravi [?]', True)]
+
+
+def test_as_markdown_writes_the_marker_for_a_flagged_field():
+    assert Field('Name', 'Ravi', uncertain=True).as_markdown() == '- **Name:** Ravi [?]'
+    assert Field('Name', 'Ra[?]vi', uncertain=True).as_markdown() == '- **Name:** Ra[?]vi'
+
+
+def test_structured_answer_keeps_its_fields_without_reparsing(monkeypatch):
+    backend = JsonBackend([
+        {'name': 'Name', 'value': 'Ravi', 'uncertain': True},
+        {'name': 'Date', 'value': '12 May', 'corrections': [{'struck': '11 May', 'corrected': '12 May'}]},
+    ])
+    content = GeminiService._generate(backend, None, required=True)
+    monkeypatch.setattr('app.services.gemini_service.parse_fields', lambda text: ())
+    result = GeminiService._result(content, False)
+    assert type(result['content']) is str
+    assert [(f['name'], f['uncertain'], f['corrections']) for f in result['fields']] == [
+        ('Name', True, []),
+        ('Date', False, [{'struck': '11 May', 'corrected': '12 May'}]),
+    ]
+    # A cached copy of the text, read back without the fields, parses to the same thing
+    assert [f.as_dict() for f in parse_fields(result['content'])] == result['fields']
@@ -0,0 +1,141 @@
+import threading
+
+import pytest
+
+from app.services.gemini_service import get_gemini_service
+from app.services.single_flight import SingleFlight, get_single_flight
+
+
+@pytest.fixture(params=['worker', 'host'])
+def flights(request, tmp_path):
+    path = str(tmp_path / 'single_flight.sqlite3') if request.param == 'host' else None
+    return SingleFlight(path, poll_interval=0.01)
+
+
+def start_leader(flights, key):
+    """Join key on a thread that leads and holds the call until release is set"""
+    joined, release, outcome = threading.Event(), threading.Event(), {}
+
+    def lead():
+        with flights.join(key) as flight:
+            outcome['leader'] = flight.leader
+            joined.set()
+            release.wait(5)
+            if outcome.get('value') is not None:
+                flight.value = outcome['value']
+
+    thread = threading.Thread(target=lead)
+    thread.start()
+    joined.wait(5)
+    return thread, release, outcome
+
+
+def test_follower_gets_leaders_value(flights):
+    thread, release, outcome = start_leader(flights, 'k')
+    follower = {}
+
+    def follow():
+        with flights.join('k') as flight:
+            follower['leader'] = flight.leader
+            follower['value'] = flight.value
+
+    waiter = threading.Thread(target=follow)
+    waiter.start()
+    outcome['value'] = {'content': 'answer'}
+    release.set()
+    thread.join(5)
+    waiter.join(5)
+
+    assert outcome['leader'] is True
+    assert follower == {'leader': False, 'value': {'content': 'answer'}}
+    assert flights.stats()['calls_saved'] == 1
+    # Everything ran in this process, so nothing was saved across workers
+    assert flights.stats()['saved_across_workers'] == 0
+
+
+def test_abandoned_call_is_taken_over(flights):
+    thread, release, outcome = start_leader(flights, 'k')
+    follower = {}
+
+    def follow():
+        with flights.join('k') as flight:
+            follower['leader'] = flight.leader
+            flight.value = 'own'
+
+    waiter = threading.Thread(target=follow)
+    waiter.start()
+    release.set()  # the leader leaves without a value
+    thread.join(5)
+    waiter.join(5)
+
+    assert follower['leader'] is True
+    assert flights.stats()['calls_saved'] == 0
+
+
+def test_shared_error_reaches_followers(flights):
+    joined, release = threading.Event(), threading.Event()
+
+    def lead():
+        with pytest.raises(ValueError):
+            with flights.join('k'):
+                joined.set()
+                release.wait(5)
+                raise ValueError('model failed')
+
+    thread = threading.Thread(target=lead)
+    thread.start()
+    joined.wait(5)
+    errors = []
+
+    def follow():
+        try:
+            flights.join('k')
+        except Exception as e:
+            errors.append(str(e))
+
+    waiter = threading.Thread(target=follow)
+    waiter.start()
+    release.set()
+    thread.join(5)
+    waiter.join(5)
+    assert errors == ['model failed']
+
+
+def test_settled_call_is_not_joined(flights):
+    assert flights.run('k', lambda: 'first') == 'first'
+    # Within the linger window the next caller still starts a call of its own
+    assert flights.run('k', lambda: 'second') == 'second'
+    assert flights.stats()['leaders'] == 2
+    assert flights.stats()['calls_saved'] == 0
+
+
+def test_no_cache_analysis_after_a_flight_runs_the_model(make_app, image_file):
+    app = make_app(SINGLE_FLIGHT='host', RESULT_CACHE_BACKEND='memory')
+    path = image_file()
+    with app.app_context():
+        service = get_gemini_service()
+        first = service.analyze_file(path)
+        repeats = [service.analyze_file(path, use_cache=False) for _ in range(2)]
+        assert not first.get('coalesced')
+        assert [result.get('coalesced') for result in repeats] == [None, None]
+        assert service.backend.calls == 3
+        assert get_single_flight().stats()['calls_saved'] == 0
+
+
+def test_no_cache_analysis_does_not_join_a_running_one(make_app, image_file):
+    app = make_app(SINGLE_FLIGHT='worker', FAKE_MODEL_LATENCY=0.3)
+    path = image_file()
+    results = []
+
+    def analyze(use_cache):
+        with app.app_context():
+            results.append(get_gemini_service().analyze_file(path, use_cache=use_cache))
+
+    threads = [threading.Thread(target=analyze, args=(use_cache,)) for use_cache in (True, False)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert [result.get('coalesced') for result in results] == [None, None]
+    with app.app_context():
+        assert get_gemini_service().backend.calls == 2
@@ -0,0 +1,56 @@
+import io
+import threading
+import time
+
+from conftest import jpeg_bytes
+from app.services.gemini_service import get_gemini_service
+
+
+def upload(client, color):
+    response = client.post('/api/upload', data={'file': (io.BytesIO(jpeg_bytes(color)), 'photo.jpg')},
+                           content_type='multipart/form-data')
+    return response.get_json()['filename']
+
+
+def model_calls(app):
+    with app.app_context():
+        return get_gemini_service().backend.calls
+
+
+def test_blocking_request_waits_for_the_running_speculation(make_app):
+    app = make_app(SPECULATIVE_ANALYSIS=True, SINGLE_FLIGHT='off', FAKE_MODEL_LATENCY=0.3)
+    client = app.test_client()
+    response = client.post('/api/analyze', json={'filename': upload(client, (60, 0, 0)), 'wait': True})
+    assert response.status_code == 200
+    assert response.get_json()['result']['speculative'] is True
+    assert model_calls(app) == 1
+
+
+def test_blocking_request_waits_for_a_speculation_still_queued(make_app, image_file):
+    app = make_app(SPECULATIVE_ANALYSIS=True, SINGLE_FLIGHT='off', ANALYSIS_WORKERS=1, FAKE_MODEL_LATENCY=0.2)
+    client = app.test_client()
+    with app.app_context():
+        app.extensions['job_queue'].submit(image_file(color=(1, 2, 3)), 'other.jpg')
+    filename = upload(client, (70, 0, 0))
+    response = client.post('/api/analyze', json={'filename': filename, 'wait': True})
+    assert response.get_json()['result']['speculative'] is True
+    assert model_calls(app) == 2
+
+
+def test_streamed_request_replays_the_speculation_it_waited_for(make_app):
+    app = make_app(SPECULATIVE_ANALYSIS=True, SINGLE_FLIGHT='off', FAKE_MODEL_LATENCY=0.3)
+    client = app.test_client()
+    body = client.post('/api/analyze/stream', json={'filename': upload(client, (80, 0, 0))}).get_data(as_text=True)
+    assert '"speculative": true' in body
+    assert model_calls(app) == 1
+
+
+def test_wait_polls_a_job_of_another_worker(make_app):
+    app = make_app()
+    queue = app.extensions['job_queue']
+    job_id = queue.store.create('a.jpg')
+    threading.Timer(0.1, queue.store.update, (job_id, 'done'), {'result': {'content': 'x'}}).start()
+    started = time.time()
+    job = queue.wait(job_id, poll_interval=0.02)
+    assert job['status'] == 'done' and job['result'] == {'content': 'x'}
+    assert time.time() - started < 2
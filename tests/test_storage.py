@@ -0,0 +1,91 @@
+import hashlib
+import os
+import time
+
+import pytest
+
+from app.services.storage import ORPHAN_GRACE, INCOMING_MAX_AGE, UploadStorage
+from app.utils.file_handler import HashingFileStream
+
+
+@pytest.fixture
+def storage(tmp_path):
+    return UploadStorage(str(tmp_path / 'uploads'), str(tmp_path / 'state'))
+
+
+DATA = b'\x89PNG\r\n\x1a\n' + b'x' * 100
+DIGEST = hashlib.sha256(DATA).hexdigest()
+
+
+def incoming(storage, data=DATA):
+    """A finished upload stream on disk, as the request parser leaves it"""
+    stream = HashingFileStream(storage.root)
+    stream.write(data)
+    stream.flush()
+    return stream
+
+
+def age(path, seconds):
+    past = time.time() - seconds
+    os.utime(path, (past, past))
+
+
+def test_fresh_orphans_and_temp_files_survive_a_sweep(storage):
+    filepath, _ = storage.store(incoming(storage), 'scan', '.png')
+    blob = storage.blob_path(DIGEST)
+    os.remove(filepath)  # the blob is an orphan now, but only just
+    temp = f'{blob}.preview.webp.abc.tmp'
+    with open(temp, 'wb') as f:
+        f.write(b'half written')
+
+    report = storage.sweep()
+    assert os.path.exists(blob) and os.path.exists(temp)
+    assert report['orphaned_blobs'] == 0 and report['abandoned_partials'] == 0
+
+    age(blob, ORPHAN_GRACE + 1)
+    age(temp, INCOMING_MAX_AGE + 1)
+    report = storage.sweep()
+    assert not os.path.exists(blob) and not os.path.exists(temp)
+    assert report['orphaned_blobs'] == 1 and report['abandoned_partials'] == 1
+
+
+@pytest.mark.parametrize('on_disk', [True, False])
+def test_store_restores_a_blob_reaped_before_it_was_linked(storage, monkeypatch, on_disk):
+    first, _ = storage.store(incoming(storage), 'scan', '.png')
+    os.remove(first)
+    blob = storage.blob_path(DIGEST)
+    real_link = os.link
+    reaped = []
+
+    def link(src, dst):
+        # The sweeper removes the orphaned blob between the existence check and the link
+        if src == blob and not reaped:
+            reaped.append(src)
+            os.remove(blob)
+        return real_link(src, dst)
+
+    monkeypatch.setattr(os, 'link', link)
+    stream = incoming(storage)
+    if not on_disk:
+        stream.discard()
+        stream = HashingFileStream(None)
+        stream.write(DATA)
+    filepath, _ = storage.store(stream, 'scan', '.png')
+
+    assert reaped
+    assert os.path.samefile(filepath, blob)
+    assert not [name for name in os.listdir(storage.root) if name.startswith('.incoming-')]
+
+
+def test_quota_counts_renditions(storage):
+    storage.quota_bytes = 150
+    filepath, _ = storage.store(incoming(storage), 'scan', '.png')  # 108 bytes
+    with open(storage.derivative_path(DIGEST, 'preview'), 'wb') as f:
+        f.write(b'p' * 100)
+    assert storage.usage()['bytes'] == 208
+
+    report = storage.sweep()
+    assert report['evicted'] == 1
+    assert report['bytes_reclaimed'] == 208
+    assert storage.usage()['bytes'] == 0
+    assert not os.path.exists(filepath)